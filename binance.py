@@ -1,49 +1,67 @@
 import asyncio
-import hashlib
-import hmac
 import json
 from time import time
-from urllib.parse import urlencode
 
 import aiohttp
 import numpy as np
 import traceback
+import websockets
+from yarl import URL
 
-from pure_funcs import ts_to_date, sort_dict_keys
+from pure_funcs import ts_to_date, sort_dict_keys, sign_query
 from passivbot import Bot
 from procedures import print_
+from rate_limiter import RateLimiter, get_binance_rate_limiter, get_request_weight
 
 
 class BinanceBot(Bot):
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, session: aiohttp.ClientSession = None):
         self.exchange = 'binance'
         super().__init__(config)
         self.max_pos_size_ito_usdt = 0.0
         self.max_pos_size_ito_coin = 0.0
-        self.session = aiohttp.ClientSession()
+        # session may be shared by several bots in one process
+        self.session = aiohttp.ClientSession() if session is None else session
         self.base_endpoint = ''
+        self.request_weights = {}
+
+    def get_rate_limiter(self, base_endpoint: str) -> RateLimiter:
+        return get_binance_rate_limiter(base_endpoint)
+
+    def get_request_weight(self, url: str) -> int:
+        return get_request_weight(self.request_weights, url)
 
     async def public_get(self, url: str, params: dict = {}) -> dict:
-        async with self.session.get(self.base_endpoint + url, params=params) as response:
-            result = await response.text()
+        rate_limiter = self.get_rate_limiter(self.base_endpoint)
+        for _ in range(3):
+            await rate_limiter.acquire(self.get_request_weight(url))
+            async with self.session.get(self.base_endpoint + url, params=params) as response:
+                rate_limited = rate_limiter.update_from_response(response.status, response.headers)
+                result = await response.text()
+            if not rate_limited:
+                break
         return json.loads(result)
 
     async def private_(self, type_: str, base_endpoint: str, url: str, params: dict = {}) -> dict:
-        timestamp = int(time() * 1000)
-        params.update({'timestamp': timestamp, 'recvWindow': 5000})
-        for k in params:
-            if type(params[k]) == bool:
-                params[k] = 'true' if params[k] else 'false'
-            elif type(params[k]) == float:
-                params[k] = str(params[k])
-        params = sort_dict_keys(params)
-        params['signature'] = hmac.new(self.secret.encode('utf-8'),
-                                       urlencode(params).encode('utf-8'),
-                                       hashlib.sha256).hexdigest()
-        headers = {'X-MBX-APIKEY': self.key}
-        async with getattr(self.session, type_)(base_endpoint + url, params=params,
-                                                headers=headers) as response:
-            result = await response.text()
+        rate_limiter = self.get_rate_limiter(base_endpoint)
+        for _ in range(3):
+            await rate_limiter.acquire(self.get_request_weight(url))
+            timestamp = int(time() * 1000)
+            params.update({'timestamp': timestamp, 'recvWindow': 5000})
+            for k in params:
+                if type(params[k]) == bool:
+                    params[k] = 'true' if params[k] else 'false'
+                elif type(params[k]) == float:
+                    params[k] = str(params[k])
+            query = sign_query(sort_dict_keys(params), self.secret)
+            headers = {'X-MBX-APIKEY': self.key}
+            # encoded=True keeps the query byte for byte as signed
+            async with getattr(self.session, type_)(URL(f'{base_endpoint}{url}?{query}', encoded=True),
+                                                    headers=headers) as response:
+                rate_limited = rate_limiter.update_from_response(response.status, response.headers)
+                result = await response.text()
+            if not rate_limited:
+                break
         return json.loads(result)
 
     async def private_get(self, url: str, params: dict = {}, base_endpoint: str = None) -> dict:
@@ -58,6 +76,110 @@ class BinanceBot(Bot):
     async def private_delete(self, url: str, params: dict = {}) -> dict:
         return await self.private_('delete', self.base_endpoint, url, params)
 
+    async def listen_key_request(self, type_: str) -> dict:
+        # listenKey requests are authenticated by api key only, without signature
+        rate_limiter = self.get_rate_limiter(self.base_endpoint)
+        await rate_limiter.acquire(1)
+        async with getattr(self.session, type_)(self.base_endpoint + self.endpoints['listen_key'],
+                                                headers={'X-MBX-APIKEY': self.key}) as response:
+            rate_limiter.update_from_response(response.status, response.headers)
+            result = await response.text()
+        return json.loads(result)
+
+    async def keepalive_listen_key(self, interval: float = 60 * 30):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.listen_key_request('put')
+            except Exception as e:
+                print('error keeping user stream alive', e)
+
+    async def start_user_stream(self, bots: list = None) -> None:
+        '''
+        listenKey user data stream, keeping position, open orders and fills up to date
+        bots: bots on same account and api sharing this bot's stream, each getting events of its own symbol
+        reconnects until all bots are stopped, REST takes over while disconnected
+        '''
+        bots = [self] if bots is None else bots
+        while not all(bot.stop_websocket for bot in bots):
+            keepalive = None
+            try:
+                listen_key = (await self.listen_key_request('post'))['listenKey']
+                keepalive = asyncio.create_task(self.keepalive_listen_key())
+                async with websockets.connect(self.endpoints['user_stream'] + listen_key) as ws:
+                    print_(['user stream connected'])
+                    for bot in bots:
+                        bot.user_stream_connected = True
+                    async for msg in ws:
+                        event = json.loads(msg)
+                        if event['e'] == 'listenKeyExpired':
+                            break
+                        for bot in bots:
+                            try:
+                                events = bot.standardize_user_stream_event(event)
+                                if events:
+                                    await bot.handle_user_stream_events(events)
+                            except Exception as e:
+                                print('error handling user stream event', bot.symbol, e)
+                        if all(bot.stop_websocket for bot in bots):
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print('error in user stream', e)
+            finally:
+                for bot in bots:
+                    bot.user_stream_connected = False
+                if keepalive is not None:
+                    keepalive.cancel()
+            if not all(bot.stop_websocket for bot in bots):
+                print_(['user stream disconnected, reconnecting...'])
+                await asyncio.sleep(5)
+
+    def standardize_user_stream_event(self, event: dict) -> [dict]:
+        events = []
+        if event['e'] == 'ACCOUNT_UPDATE':
+            asset = self.quot if 'linear_perpetual' in self.market_type else self.coin
+            for b in event['a']['B']:
+                if b['a'] == asset:
+                    events.append({'wallet_balance': float(b['wb'])})
+            for p in event['a']['P']:
+                if p['s'] == self.symbol and p['ps'] in ['LONG', 'SHORT']:
+                    events.append({'position_side': p['ps'].lower().replace('short', 'shrt'),
+                                   'size': float(p['pa']),
+                                   'price': float(p['ep']),
+                                   'upnl': float(p['up'])})
+        elif event['e'] == 'ORDER_TRADE_UPDATE' and event['o']['s'] == self.symbol:
+            o = event['o']
+            position_side = o['ps'].lower().replace('short', 'shrt')
+            events.append({'order': {'order_id': int(o['i']),
+                                     'symbol': o['s'],
+                                     'price': float(o['p']),
+                                     'qty': float(o['q']),
+                                     'type': o['o'].lower(),
+                                     'side': o['S'].lower(),
+                                     'position_side': position_side,
+                                     'timestamp': int(o['T'])},
+                           'status': o['X'].lower()})
+            if o['x'] == 'TRADE':
+                price, qty = float(o['L']), float(o['l'])
+                events.append({'fill': {'symbol': o['s'],
+                                        'id': int(o['t']),
+                                        'order_id': int(o['i']),
+                                        'side': o['S'].lower(),
+                                        'price': price,
+                                        'qty': qty,
+                                        'realized_pnl': float(o['rp']),
+                                        'cost': qty * self.c_mult / price if self.inverse else qty * price,
+                                        'fee_paid': float(o['n']) if 'n' in o else 0.0,
+                                        'fee_token': o['N'] if 'N' in o else '',
+                                        'timestamp': int(o['T']),
+                                        'position_side': position_side,
+                                        'is_maker': o['m']}})
+        elif event['e'] == 'listenKeyExpired':
+            events.append({'listen_key_expired': True})
+        return events
+
     async def init_market_type(self):
         fapi_endpoint = 'https://fapi.binance.com'
         dapi_endpoint = 'https://dapi.binance.com'
@@ -78,11 +200,14 @@ class BinanceBot(Bot):
                 'income': '/fapi/v1/income',
                 'create_order': '/fapi/v1/order',
                 'cancel_order': '/fapi/v1/order',
+                'batch_orders': '/fapi/v1/batchOrders',
                 'ticks': '/fapi/v1/aggTrades',
                 'ohlcvs': '/fapi/v1/klines',
                 'margin_type': '/fapi/v1/marginType',
                 'leverage': '/fapi/v1/leverage',
                 'position_side': '/fapi/v1/positionSide/dual',
+                'listen_key': '/fapi/v1/listenKey',
+                'user_stream': 'wss://fstream.binance.com/ws/',
                 'websocket': f"wss://fstream.binance.com/ws/{self.symbol.lower()}@aggTrade"
             }
         else:
@@ -103,59 +228,80 @@ class BinanceBot(Bot):
                     'income': '/dapi/v1/income',
                     'create_order': '/dapi/v1/order',
                     'cancel_order': '/dapi/v1/order',
+                    'batch_orders': '/dapi/v1/batchOrders',
                     'ticks': '/dapi/v1/aggTrades',
                     'ohlcvs': '/dapi/v1/klines',
                     'margin_type': '/dapi/v1/marginType',
                     'leverage': '/dapi/v1/leverage',
                     'position_side': '/dapi/v1/positionSide/dual',
+                    'listen_key': '/dapi/v1/listenKey',
+                    'user_stream': 'wss://dstream.binance.com/ws/',
                     'websocket': f"wss://dstream.binance.com/ws/{self.symbol.lower()}@aggTrade"
                 }
             else:
                 raise Exception(f'unknown symbol {self.symbol}')
 
+        if self.use_book_ticker:
+            # combined stream of trades and best bid/ask
+            self.endpoints['websocket'] = self.endpoints['websocket'].replace(
+                '/ws/', '/stream?streams=') + f"/{self.symbol.lower()}@bookTicker"
+            self.ob_from_book_ticker = True
         self.spot_base_endpoint = 'https://api.binance.com'
         self.endpoints['transfer'] = '/sapi/v1/asset/transfer'
         self.endpoints['account'] = '/api/v3/account'
+        self.request_weights = {self.endpoints['ticks']: 20,
+                                self.endpoints['ohlcvs']: 10,
+                                self.endpoints['position']: 5,
+                                self.endpoints['balance']: 5,
+                                self.endpoints['fills']: 5,
+                                self.endpoints['income']: 30,
+                                self.endpoints['open_orders']: 1,
+                                self.endpoints['batch_orders']: 5}
 
     async def _init(self):
         await self.init_market_type()
-        exchange_info, leverage_bracket = await asyncio.gather(
-            self.public_get(self.endpoints['exchange_info']),
-            self.private_get(self.endpoints['leverage_bracket']),
-        )
-        for e in exchange_info['symbols']:
-            if e['symbol'] == self.symbol:
-                self.coin = e['baseAsset']
-                self.quot = e['quoteAsset']
-                self.margin_coin = e['marginAsset']
-                self.pair = e['pair']
-                if 'inverse_coin_margined' in self.market_type:
-                    self.c_mult = self.config['c_mult'] = \
-                        float(e['contractSize'])
-                price_precision = e['pricePrecision']
-                qty_precision = e['quantityPrecision']
-                for q in e['filters']:
-                    if q['filterType'] == 'LOT_SIZE':
-                        self.min_qty = self.config['min_qty'] = float(q['minQty'])
-                    elif q['filterType'] == 'MARKET_LOT_SIZE':
-                        self.qty_step = self.config['qty_step'] = float(q['stepSize'])
-                    elif q['filterType'] == 'PRICE_FILTER':
-                        self.price_step = self.config['price_step'] = float(q['tickSize'])
-                    elif q['filterType'] == 'MIN_NOTIONAL':
-                        self.min_cost = self.config['min_cost'] = float(q['notional'])
-                try:
-                    z = self.min_cost
-                except AttributeError:
-                    self.min_cost = self.config['min_cost'] = 0.0
-                break
-        max_lev = 25 # lowest max lev for any binance futures symbol, as per 2021-06-12
-        for e in leverage_bracket:
-            if ('pair' in e and e['pair'] == self.pair) or \
-                    ('symbol' in e and e['symbol'] == self.symbol):
-                for br in e['brackets']:
-                    max_lev = max(max_lev, int(br['initialLeverage']))
-                break
-        self.max_leverage = self.config['max_leverage'] = max_lev
+        snapshot = self.load_snapshot()
+        if snapshot is not None and 'pair' in snapshot['exchange_info']:
+            print('using exchange info from snapshot')
+            self.apply_exchange_info(snapshot['exchange_info'])
+        else:
+            exchange_info, leverage_bracket = await asyncio.gather(
+                self.public_get(self.endpoints['exchange_info']),
+                self.private_get(self.endpoints['leverage_bracket']),
+            )
+            for e in exchange_info['symbols']:
+                if e['symbol'] == self.symbol:
+                    self.coin = e['baseAsset']
+                    self.quot = e['quoteAsset']
+                    self.margin_coin = e['marginAsset']
+                    self.pair = e['pair']
+                    if 'inverse_coin_margined' in self.market_type:
+                        self.c_mult = self.config['c_mult'] = \
+                            float(e['contractSize'])
+                    price_precision = e['pricePrecision']
+                    qty_precision = e['quantityPrecision']
+                    for q in e['filters']:
+                        if q['filterType'] == 'LOT_SIZE':
+                            self.min_qty = self.config['min_qty'] = float(q['minQty'])
+                        elif q['filterType'] == 'MARKET_LOT_SIZE':
+                            self.qty_step = self.config['qty_step'] = float(q['stepSize'])
+                        elif q['filterType'] == 'PRICE_FILTER':
+                            self.price_step = self.config['price_step'] = float(q['tickSize'])
+                        elif q['filterType'] == 'MIN_NOTIONAL':
+                            self.min_cost = self.config['min_cost'] = float(q['notional'])
+                    try:
+                        z = self.min_cost
+                    except AttributeError:
+                        self.min_cost = self.config['min_cost'] = 0.0
+                    break
+            max_lev = 25 # lowest max lev for any binance futures symbol, as per 2021-06-12
+            for e in leverage_bracket:
+                if ('pair' in e and e['pair'] == self.pair) or \
+                        ('symbol' in e and e['symbol'] == self.symbol):
+                    for br in e['brackets']:
+                        max_lev = max(max_lev, int(br['initialLeverage']))
+                    break
+            self.max_leverage = self.config['max_leverage'] = max_lev
         await super()._init()
         await self.init_order_book()
         await self.update_position()
@@ -165,16 +311,18 @@ class BinanceBot(Bot):
             self.private_get(self.endpoints['position']),
             self.private_get(self.endpoints['open_orders'])
         )
+        # symbols traded by bots in the same process are not other positions
+        own_symbols = set(self.config['multi_bot_symbols']) if 'multi_bot_symbols' in self.config else {self.symbol}
         do_abort = False
         for e in positions:
             if float(e['positionAmt']) != 0.0:
-                if e['symbol'] != self.symbol and self.margin_coin in e['symbol']:
+                if e['symbol'] not in own_symbols and self.margin_coin in e['symbol']:
                     print('\n\nWARNING\n\n')
                     print('account has position in other symbol:', e)
                     print('\n\n')
                     do_abort = True
         for e in open_orders:
-            if e['symbol'] != self.symbol and self.margin_coin in e['symbol']:
+            if e['symbol'] not in own_symbols and self.margin_coin in e['symbol']:
                 print('\n\nWARNING\n\n')
                 print('account has open orders in other symbol:', e)
                 print('\n\n')
@@ -278,7 +426,7 @@ class BinanceBot(Bot):
                 break
         return position
 
-    async def execute_order(self, order: dict) -> dict:
+    def get_order_params(self, order: dict) -> dict:
         params = {'symbol': self.symbol,
                   'side': order['side'].upper(),
                   'positionSide': order['position_side'].replace('shrt', 'short').upper(),
@@ -290,26 +438,71 @@ class BinanceBot(Bot):
         if 'custom_id' in order:
             params['newClientOrderId'] = \
                 f"{order['custom_id']}_{str(int(time() * 1000))[8:]}_{int(np.random.random() * 1000)}"
-        o = await self.private_post(self.base_endpoint, self.endpoints['create_order'], params)
+        return params
+
+    def standardize_order(self, o: dict) -> dict:
         if 'side' in o:
-            return {'symbol': self.symbol,
+            return {'order_id': int(o['orderId']),
+                    'symbol': self.symbol,
                     'side': o['side'].lower(),
                     'position_side': o['positionSide'].lower().replace('short', 'shrt'),
                     'type': o['type'].lower(),
                     'qty': float(o['origQty']),
-                    'price': float(o['price'])}
+                    'price': float(o['price']),
+                    'timestamp': int(o['updateTime']) if 'updateTime' in o else int(time() * 1000)}
         else:
             return o
 
+    async def execute_order(self, order: dict) -> dict:
+        o = await self.private_post(self.base_endpoint, self.endpoints['create_order'], self.get_order_params(order))
+        return self.standardize_order(o)
+
+    async def execute_orders(self, orders: [dict]) -> [dict]:
+        '''
+        batchOrders takes at most 5 orders per request
+        '''
+        if len(orders) == 1:
+            return [await self.execute_order(orders[0])]
+        batches = [orders[i:i + 5] for i in range(0, len(orders), 5)]
+        responses = await asyncio.gather(*[
+            self.private_post(self.base_endpoint, self.endpoints['batch_orders'],
+                              {'batchOrders': json.dumps([self.get_order_params(o) for o in batch],
+                                                         separators=(',', ':'))})
+            for batch in batches], return_exceptions=True)
+        results = []
+        for batch, response in zip(batches, responses):
+            if isinstance(response, list):
+                results += [self.standardize_order(o) for o in response]
+            else:
+                # whole batch rejected
+                results += [response] * len(batch)
+        return results
+
     async def execute_cancellation(self, order: dict) -> [dict]:
         cancellation = await self.private_delete(self.endpoints['cancel_order'],
                                                  {'symbol': self.symbol, 'orderId': order['order_id']})
-        if 'side' in cancellation:
-            return {'symbol': self.symbol, 'side': cancellation['side'].lower(),
-                    'position_side': cancellation['positionSide'].lower().replace('short', 'shrt'),
-                    'qty': float(cancellation['origQty']), 'price': float(cancellation['price'])}
-        else:
-            return cancellation
+        return self.standardize_order(cancellation)
+
+    async def execute_cancellations(self, orders: [dict]) -> [dict]:
+        '''
+        batch cancel takes at most 10 order ids per request
+        '''
+        if len(orders) == 1:
+            return [await self.execute_cancellation(orders[0])]
+        batches = [orders[i:i + 10] for i in range(0, len(orders), 10)]
+        responses = await asyncio.gather(*[
+            self.private_delete(self.endpoints['batch_orders'],
+                                {'symbol': self.symbol,
+                                 'orderIdList': json.dumps([int(o['order_id']) for o in batch],
+                                                           separators=(',', ':'))})
+            for batch in batches], return_exceptions=True)
+        results = []
+        for batch, response in zip(batches, responses):
+            if isinstance(response, list):
+                results += [self.standardize_order(o) for o in response]
+            else:
+                results += [response] * len(batch)
+        return results
 
     async def fetch_fills(self, limit: int = 1000, from_id: int = None, start_time: int = None, end_time: int = None):
         params = {'symbol': self.symbol, 'limit': min(100, limit) if self.inverse else limit}
@@ -421,7 +614,22 @@ class BinanceBot(Bot):
         params = {'type': type_.upper(), 'amount': amount, 'asset': asset}
         return await self.private_post(self.spot_base_endpoint, self.endpoints['transfer'],  params)
 
+    def get_websocket_streams(self) -> [str]:
+        streams = [f"{self.symbol.lower()}@aggTrade"]
+        if self.use_book_ticker:
+            streams.append(f"{self.symbol.lower()}@bookTicker")
+        return streams
+
+    def update_book_ticker(self, data: dict) -> bool:
+        if data['stream'].endswith('@bookTicker'):
+            self.ob = [float(data['data']['b']), float(data['data']['a'])]
+            return True
+        return False
+
     def standardize_websocket_ticks(self, data: dict) -> [dict]:
+        if 'stream' in data:
+            # combined stream
+            data = data['data']
         try:
             return [{'timestamp': int(data['T']), 'price': float(data['p']), 'qty': float(data['q']),
                      'is_buyer_maker': data['m']}]
@@ -1,22 +1,21 @@
 import asyncio
-import hashlib
-import hmac
 import json
 from time import time
-from urllib.parse import urlencode
 
 import aiohttp
 import numpy as np
 import traceback
+from yarl import URL
 
-from pure_funcs import ts_to_date, sort_dict_keys, calc_long_pprice, format_float, get_position_fills
+from pure_funcs import ts_to_date, sort_dict_keys, sign_query, calc_long_pprice, format_float, get_position_fills
 from njit_funcs import round_dn
 from passivbot import Bot
 from procedures import print_
+from rate_limiter import RateLimiter, get_binance_rate_limiter, get_request_weight
 
 
 class BinanceBotSpot(Bot):
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, session: aiohttp.ClientSession = None):
         self.exchange = 'binance_spot'
         self.balance = {}
         super().__init__(config)
@@ -27,30 +26,48 @@ class BinanceBotSpot(Bot):
         self.hedge_mode = self.config['hedge_mode'] = False
         self.do_long = self.config['do_long'] = self.config['long']['enabled'] = True
         self.do_shrt = self.config['do_shrt'] = self.config['shrt']['enabled'] = False
-        self.session = aiohttp.ClientSession()
+        # session may be shared by several bots in one process
+        self.session = aiohttp.ClientSession() if session is None else session
         self.base_endpoint = ''
+        self.request_weights = {}
+
+    def get_rate_limiter(self, base_endpoint: str) -> RateLimiter:
+        return get_binance_rate_limiter(base_endpoint)
+
+    def get_request_weight(self, url: str) -> int:
+        return get_request_weight(self.request_weights, url)
 
     async def public_get(self, url: str, params: dict = {}) -> dict:
-        async with self.session.get(self.base_endpoint + url, params=params) as response:
-            result = await response.text()
+        rate_limiter = self.get_rate_limiter(self.base_endpoint)
+        for _ in range(3):
+            await rate_limiter.acquire(self.get_request_weight(url))
+            async with self.session.get(self.base_endpoint + url, params=params) as response:
+                rate_limited = rate_limiter.update_from_response(response.status, response.headers)
+                result = await response.text()
+            if not rate_limited:
+                break
         return json.loads(result)
 
     async def private_(self, type_: str, base_endpoint: str, url: str, params: dict = {}) -> dict:
-        timestamp = int(time() * 1000)
-        params.update({'timestamp': timestamp, 'recvWindow': 5000})
-        for k in params:
-            if type(params[k]) == bool:
-                params[k] = 'true' if params[k] else 'false'
-            elif type(params[k]) == float:
-                params[k] = str(params[k])
-        params = sort_dict_keys(params)
-        params['signature'] = hmac.new(self.secret.encode('utf-8'),
-                                       urlencode(params).encode('utf-8'),
-                                       hashlib.sha256).hexdigest()
-        headers = {'X-MBX-APIKEY': self.key}
-        async with getattr(self.session, type_)(base_endpoint + url, params=params,
-                                                headers=headers) as response:
-            result = await response.text()
+        rate_limiter = self.get_rate_limiter(base_endpoint)
+        for _ in range(3):
+            await rate_limiter.acquire(self.get_request_weight(url))
+            timestamp = int(time() * 1000)
+            params.update({'timestamp': timestamp, 'recvWindow': 5000})
+            for k in params:
+                if type(params[k]) == bool:
+                    params[k] = 'true' if params[k] else 'false'
+                elif type(params[k]) == float:
+                    params[k] = str(params[k])
+            query = sign_query(sort_dict_keys(params), self.secret)
+            headers = {'X-MBX-APIKEY': self.key}
+            # encoded=True keeps the query byte for byte as signed
+            async with getattr(self.session, type_)(URL(f'{base_endpoint}{url}?{query}', encoded=True),
+                                                    headers=headers) as response:
+                rate_limited = rate_limiter.update_from_response(response.status, response.headers)
+                result = await response.text()
+            if not rate_limited:
+                break
         return json.loads(result)
 
     async def private_get(self, url: str, params: dict = {}, base_endpoint: str = None) -> dict:
@@ -88,6 +105,13 @@ class BinanceBotSpot(Bot):
         }
         self.endpoints['transfer'] = '/sapi/v1/asset/transfer'
         self.endpoints['account'] = '/api/v3/account'
+        self.request_weights = {self.endpoints['balance']: 20,
+                                self.endpoints['exchange_info']: 20,
+                                self.endpoints['open_orders']: 6,
+                                self.endpoints['ticker']: 2,
+                                self.endpoints['fills']: 20,
+                                self.endpoints['ticks']: 4,
+                                self.endpoints['ohlcvs']: 2}
 
     async def _init(self):
         self.init_market_type()
@@ -5,20 +5,29 @@ import gc
 import os
 import sys
 import gzip
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from io import BytesIO
+from itertools import islice
 from time import sleep
 from time import time
+from urllib.error import HTTPError
 from urllib.request import urlopen
 from zipfile import ZipFile
 
+import aiohttp
 import numpy as np
 import pandas as pd
 from dateutil import parser
+from prettytable import PrettyTable
 
 from procedures import prep_config, make_get_filepath, create_binance_bot, create_bybit_bot, create_binance_bot_spot, \
     print_, add_argparse_args
-from njit_funcs import calc_samples
+from njit_funcs import is_strictly_increasing, find_trade_id_gaps
 from pure_funcs import ts_to_date, get_dummy_settings
+from trade_store import dump_chunk, load_chunk, load_chunk_columns, load_range, remove_chunk, migrate_csv_chunks, \
+    get_chunk_name, ChunkManifest
+from sample_cache import SampleCache, load_samples_view
 
 
 class Downloader:
@@ -26,11 +35,25 @@ class Downloader:
     Downloader class for tick data. Fetches data from specified time until now or specified time.
     """
 
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, session: aiohttp.ClientSession = None,
+                 download_executor: ThreadPoolExecutor = None):
+        """
+        @param config: Config of the symbol.
+        @param session: Session shared with other downloaders, None for an own session of the exchange bot.
+        @param download_executor: Thread pool shared with other downloaders for archive downloads, None for an own one.
+        """
+        self.session = session
+        self.download_executor = download_executor
         self.fetch_delay_seconds = 0.75
+        self.rate_limited = False
         self.config = config
+        self.n_concurrent_downloads = config['n_concurrent_downloads'] if 'n_concurrent_downloads' in config else 4
+        self.download_max_retries = 5
+        self.download_backoff_seconds = 1.0
+        self.download_timeout_seconds = 60.0
+        self.n_search_probes = 4
         self.spot = 'spot' in config and config['spot']
-        self.tick_filepath = os.path.join(config["caches_dirpath"], f"{config['session_name']}_ticks_cache.npy")
+        self.sample_cache = SampleCache(config["caches_dirpath"])
         try:
             self.start_time = int(parser.parse(self.config["start_date"]).replace(
                 tzinfo=datetime.timezone.utc).timestamp() * 1000)
@@ -64,61 +87,40 @@ class Downloader:
             self.filepath = make_get_filepath(
                 os.path.join("historical_data", self.config["exchange"], f"agg_trades_{'spot' if self.spot else 'futures'}",
                              self.config["symbol"], ""))
+        migrate_csv_chunks(self.filepath)
+        self.manifest = ChunkManifest(self.filepath)
 
     def validate_dataframe(self, df: pd.DataFrame) -> tuple:
         """
         Validates a dataframe and detects gaps in it. Also detects missing trades in the beginning and end.
         @param df: Dataframe to check for gaps.
-        @return: A tuple with following result: if missing values present, the cleaned dataframe, a dataframe with start and end of gaps.
+        @return: A tuple with following result: if missing values present, the cleaned dataframe,
+        an int64 array of shape (n, 2) with start and end of gaps.
         """
-        df.sort_values("trade_id", inplace=True)
-        df.drop_duplicates("trade_id", inplace=True)
+        if not is_strictly_increasing(df["trade_id"].values):
+            df.sort_values("trade_id", inplace=True)
+            df.drop_duplicates("trade_id", inplace=True)
         df.reset_index(drop=True, inplace=True)
-        missing_end_frame = df["trade_id"][df["trade_id"].diff() != 1]
-        gaps = pd.DataFrame()
-        gaps["start"] = df.iloc[missing_end_frame[1:].index - 1]["trade_id"].tolist()
-        gaps["end"] = missing_end_frame[1:].tolist()
-        if missing_ids := df["trade_id"].iloc[0] % 100000 != 0:
-            gaps.append({"start": df["trade_id"].iloc[0] - missing_ids, "end": df["trade_id"].iloc[0] - 1},
-                        ignore_index=True)
-        if missing_ids := df["trade_id"].iloc[-1] % 100000 != 99999:
-            gaps.append({"start": df["trade_id"].iloc[-1], "end": df["trade_id"].iloc[-1] + (100000 - missing_ids - 1)},
-                        ignore_index=True)
-        missing_ids = df["trade_id"].iloc[0] % 100000
-        if missing_ids != 0:
-            gaps = gaps.append({"start": df["trade_id"].iloc[0] - missing_ids, "end": df["trade_id"].iloc[0] - 1},
-                               ignore_index=True)
-        missing_ids = df["trade_id"].iloc[-1] % 100000
-        if missing_ids != 99999:
-            gaps = gaps.append(
-                {"start": df["trade_id"].iloc[-1], "end": df["trade_id"].iloc[-1] + (100000 - missing_ids - 1)},
-                ignore_index=True)
-        if gaps.empty:
-            return False, df, gaps
-        else:
-            gaps["start"] = gaps["start"].astype(np.int64)
-            gaps["end"] = gaps["end"].astype(np.int64)
-            gaps.sort_values("start", inplace=True)
-            gaps.reset_index(drop=True, inplace=True)
-            gaps["start"] = gaps["start"].replace(0, 1)
-            return True, df, gaps
+        gaps = find_trade_id_gaps(df["trade_id"].values.astype(np.int64))
+        return len(gaps) > 0, df, gaps
+
+    def is_complete_chunk(self, path) -> bool:
+        """
+        Checks the memory mapped trade ids of a chunk, without loading the other columns.
+        @param path: The path to the chunk.
+        @return: If the chunk holds exactly one sorted, gapless, full range of 100000 trade ids.
+        """
+        trade_ids = load_chunk_columns(path, ['trade_id'], mmap_mode='r')['trade_id'].view(np.ndarray)
+        return len(trade_ids) > 0 and trade_ids[-1] - trade_ids[0] < 100000 and \
+            is_strictly_increasing(trade_ids) and len(find_trade_id_gaps(trade_ids)) == 0
 
     def read_dataframe(self, path) -> pd.DataFrame:
         """
-        Reads a dataframe with correct data types.
-        @param path: The path to the dataframe.
+        Reads a chunk with correct data types.
+        @param path: The path to the chunk.
         @return: The read dataframe.
         """
-        try:
-            df = pd.read_csv(path,
-                             dtype={"trade_id": np.int64, "price": np.float64, "qty": np.float64, "timestamp": np.int64,
-                                    "is_buyer_maker": np.int8})
-        except ValueError as e:
-            df = pd.read_csv(path)
-            df = df.drop("side", axis=1).join(pd.Series(df.side == "Sell", name="is_buyer_maker", index=df.index))
-            df = df.astype({"trade_id": np.int64, "price": np.float64, "qty": np.float64, "timestamp": np.int64,
-                            "is_buyer_maker": np.int8})
-        return df
+        return load_chunk(path)
 
     def save_dataframe(self, df, filename, missing):
         """
@@ -129,19 +131,23 @@ class Downloader:
         @param missing: If the dataframe had gaps.
         @return:
         """
-        new_name = f'{df["trade_id"].iloc[0]}_{df["trade_id"].iloc[-1]}_{df["timestamp"].iloc[0]}_{df["timestamp"].iloc[-1]}.csv'
+        new_name = get_chunk_name(df)
         if new_name != filename:
             print_(['Saving file', new_name])
-            df.to_csv(os.path.join(self.filepath, new_name), index=False)
+            dump_chunk(self.filepath, df)
+            self.manifest.add(new_name)
             new_name = ""
-            try:
-                os.remove(os.path.join(self.filepath, filename))
-                print_(['Removed file', filename])
-            except:
-                pass
+            if filename:
+                try:
+                    remove_chunk(os.path.join(self.filepath, filename))
+                    self.manifest.remove(filename)
+                    print_(['Removed file', filename])
+                except:
+                    pass
         elif missing:
             print_(['Replacing file', filename])
-            df.to_csv(os.path.join(self.filepath, filename), index=False)
+            dump_chunk(self.filepath, df, filename)
+            self.manifest.add(filename)
         else:
             new_name = ""
         return new_name
@@ -166,34 +172,92 @@ class Downloader:
 
     def get_filenames(self) -> list:
         """
-        Returns a sorted list of all file names in the directory.
-        @return: Sorted list of file names.
+        Returns a list of all chunk names in the manifest, sorted by first trade id.
+        @return: Sorted list of chunk names.
         """
-        return sorted([f for f in os.listdir(self.filepath) if f.endswith(".csv")],
-                      key=lambda x: int(eval(x[:x.find("_")].replace(".cs", "").replace("v", ""))))
+        return list(self.manifest.names)
+
+    async def fetch_probe(self, trade_id: int = None) -> list:
+        """
+        Fetches one page of trades starting at trade_id, latest trades if None.
+        @param trade_id: First trade id.
+        @return: List of trades sorted by trade id.
+        """
+        try:
+            return sorted(await self.bot.fetch_ticks(from_id=None if trade_id is None else int(trade_id),
+                                                     do_print=False),
+                          key=lambda x: x['trade_id'])
+        except Exception:
+            print("Failed to fetch...")
+            return []
 
-    def new_id(self, first_timestamp, last_timestamp, first_trade_id, length, start_time, prev_div):
+    async def search_trade_id(self, timestamp: int) -> pd.DataFrame:
         """
-        Calculates a new id based on several parameters. Uses a weighted approach for more stability.
-        @param first_timestamp: First timestamp in current result.
-        @param last_timestamp: Last timestamp in current result.
-        @param first_trade_id: First trade id in current result.
-        @param length: The amount of trades in the current result.
-        @param start_time: The time to look for.
-        @param prev_div: Previous results of this function.
-        @return: Estimated trade id.
+        Interpolation search for the trades around a timestamp, probing several trade ids concurrently per round.
+        Starts from the closest trades known to the manifest and caches the trades seen as anchors for later runs.
+        @param timestamp: Time to look for.
+        @return: Dataframe with the fetched trades enclosing timestamp, or the closest trades if out of range.
         """
-        div = int((last_timestamp - first_timestamp) / length)
-        prev_div.append(div)
-        forward = int((first_timestamp - start_time) / np.mean(prev_div))
-        return max(1, int(first_trade_id - forward)), prev_div, forward
+        lower, upper = self.manifest.get_bracket(timestamp)
+        anchors = []
+        pages = []
+        if upper is None:
+            pages.append(await self.fetch_probe())
+        if lower is None:
+            pages.append(await self.fetch_probe(1))
+        probed = bool(pages)
+        n_failed = 0
+        while True:
+            loop_start = time()
+            pages = [page for page in pages if page]
+            if probed and not pages:
+                n_failed += 1
+                if n_failed >= self.download_max_retries:
+                    raise Exception(f'failed to find trade id for {timestamp}')
+            probed = True
+            for page in pages:
+                anchors += [(page[0]['trade_id'], page[0]['timestamp']), (page[-1]['trade_id'], page[-1]['timestamp'])]
+                if page[0]['timestamp'] < timestamp <= page[-1]['timestamp']:
+                    self.manifest.add_anchors(anchors)
+                    return self.transform_ticks(page)
+                for tick in [page[0], page[-1]]:
+                    if tick['timestamp'] < timestamp:
+                        if lower is None or tick['trade_id'] > lower[0]:
+                            lower = (tick['trade_id'], tick['timestamp'])
+                    elif upper is None or tick['trade_id'] < upper[0]:
+                        upper = (tick['trade_id'], tick['timestamp'])
+            if pages and (upper is None or lower is None):
+                # timestamp is out of range of trades, latest or earliest trades are closest
+                self.manifest.add_anchors(anchors)
+                return self.transform_ticks(max(pages, key=lambda x: x[0]['trade_id']) if upper is None
+                                            else min(pages, key=lambda x: x[0]['trade_id']))
+            if upper is None or lower is None:
+                pages = [await self.fetch_probe() if upper is None else await self.fetch_probe(1)]
+                await self.pace(loop_start)
+                continue
+            print_(['Searching trade id for', ts_to_date(timestamp / 1000)[:19], 'between ids', lower[0], 'and',
+                    upper[0]])
+            page_size = max([len(page) for page in pages] + [1000])
+            if upper[0] - lower[0] < page_size:
+                pages = [await self.fetch_probe(lower[0])]
+                await self.pace(loop_start)
+                continue
+            # interpolated guess centered in a page, probes around it, and the midpoint for guaranteed progress
+            ratio = (timestamp - lower[1]) / max(1, upper[1] - lower[1])
+            guess = lower[0] + ratio * (upper[0] - lower[0])
+            spread = max(page_size, (upper[0] - lower[0]) / (4 * self.n_search_probes))
+            candidates = [guess - page_size / 2, (lower[0] + upper[0]) / 2] + \
+                         [guess + spread * (i // 2 + 1) * (-1) ** i for i in range(self.n_search_probes - 2)]
+            candidates = sorted(set(int(min(max(c, lower[0] + 1), upper[0] - 1)) for c in candidates))
+            pages = await asyncio.gather(*[self.fetch_probe(c) for c in candidates])
+            await self.pace(loop_start)
 
     async def find_time(self, start_time) -> pd.DataFrame:
         """
         Finds the trades according to the time.
         Uses different approaches for exchanges depending if time based fetching is supported.
         If time based searching is supported, directly fetch the data.
-        If time based searching is not supported, start with current trades and move closer to start time based on estimation.
+        If time based searching is not supported, search the trade id by interpolation.
         @param start_time: Time to look for.
         @return: Dataframe with first trade later or equal to start time.
         """
@@ -202,97 +266,145 @@ class Downloader:
             return self.transform_ticks(ticks)
         except:
             print_(['Finding id for start time...'])
-            ticks = await self.bot.fetch_ticks()
-            df = self.transform_ticks(ticks)
-            highest_id = df["trade_id"].iloc[-1]
-            prev_div = []
-            first_ts = df["timestamp"].iloc[0]
-            last_ts = df["timestamp"].iloc[-1]
-            first_id = df["trade_id"].iloc[0]
-            length = len(df)
-            while not start_time >= first_ts or not start_time <= last_ts:
-                loop_start = time()
-                nw_id, prev_div, forward = self.new_id(first_ts, last_ts, first_id, length, start_time, prev_div)
-                print_(['Current time span from', df["timestamp"].iloc[0], 'to', df["timestamp"].iloc[-1],
-                        'with earliest trade id', df["trade_id"].iloc[0], 'estimating distance of', forward, 'trades'])
-                if nw_id > highest_id:
-                    nw_id = highest_id
-                try:
-                    ticks = await self.bot.fetch_ticks(from_id=int(nw_id), do_print=False)
-                    df = self.transform_ticks(ticks)
-                    if not df.empty:
-                        first_ts = df["timestamp"].iloc[0]
-                        last_ts = df["timestamp"].iloc[-1]
-                        first_id = df["trade_id"].iloc[0]
-                        length = len(df)
-                        if nw_id == 1 and first_ts >= start_time:
-                            break
-                except Exception:
-                    print("Failed to fetch or transform...")
-                await asyncio.sleep(max(0.0, self.fetch_delay_seconds - time() + loop_start))
+            df = await self.search_trade_id(start_time)
             print_(['Found id for start time!'])
-            return df[df["timestamp"] >= start_time]
+            tf = df[df["timestamp"] >= start_time]
+            return tf if not tf.empty else df[-1:]
+
+    async def pace(self, loop_start: float):
+        """
+        Sleeps out the fixed fetch delay, unless requests are paced by the bot's rate limiter.
+        @param loop_start: Time the request was started.
+        @return:
+        """
+        if not self.rate_limited:
+            await asyncio.sleep(max(0.0, self.fetch_delay_seconds - time() + loop_start))
+
+    async def fill_gap(self, start_id: int, end_id: int, current_time: int) -> pd.DataFrame:
+        """
+        Fetches the trades missing between two ids of a file.
+        @param start_id: First missing id.
+        @param end_id: Last missing id.
+        @param current_time: Timestamp of last trade in the file.
+        @return: Dataframe with fetched trades up to the end of the chunk containing end_id.
+        """
+        print_(['Filling gaps from id', start_id, 'to id', end_id])
+        df = pd.DataFrame(columns=['trade_id', 'price', 'qty', 'timestamp', 'is_buyer_maker'])
+        current_id = start_id
+        while current_id < end_id and int(
+                datetime.datetime.now(datetime.timezone.utc).timestamp() * 1000) - current_time > 10000:
+            loop_start = time()
+            try:
+                fetched_new_trades = await self.bot.fetch_ticks(int(current_id))
+                tf = self.transform_ticks(fetched_new_trades)
+                if tf.empty:
+                    print_(["Response empty. No new trades, exiting..."])
+                    await self.pace(loop_start)
+                    break
+                if current_id == tf["trade_id"].iloc[-1]:
+                    print_(["Same trade ID again. No new trades, exiting..."])
+                    await self.pace(loop_start)
+                    break
+                current_id = tf["trade_id"].iloc[-1]
+                df = pd.concat([df, tf[tf["trade_id"] <= end_id - end_id % 100000 + 99999]])
+                current_time = max(current_time, tf["timestamp"].iloc[-1])
+            except Exception:
+                print("Failed to fetch or transform...")
+            await self.pace(loop_start)
+        return df
 
-    def get_zip(self, base_url, symbol, date):
+    def fetch_with_retries(self, url: str) -> bytes:
         """
-        Fetches a full day of trades from the Binance repository.
+        Fetches url, retrying with exponential backoff. Missing archives (404) are not retried.
+        @param url: Url to fetch.
+        @return: Response body.
+        """
+        for k in range(self.download_max_retries):
+            try:
+                return urlopen(url, timeout=self.download_timeout_seconds).read()
+            except HTTPError as e:
+                if e.code == 404:
+                    raise
+                error = e
+            except Exception as e:
+                error = e
+            delay = self.download_backoff_seconds * 2 ** k
+            print_(['Failed to fetch', url, error, f'retrying in {delay} seconds'])
+            sleep(delay)
+        raise error
+
+    async def iter_downloads(self, jobs: list):
+        """
+        Runs blocking download jobs in threads, n_concurrent_downloads at a time.
+        @param jobs: List of (func, args) tuples.
+        @return: Async generator yielding results in the order of jobs.
+        """
+        loop = asyncio.get_event_loop()
+        jobs = iter(jobs)
+        if self.download_executor is None:
+            executor = ThreadPoolExecutor(max_workers=self.n_concurrent_downloads)
+        else:
+            executor = self.download_executor
+        try:
+            pending = deque(loop.run_in_executor(executor, func, *args)
+                            for func, args in islice(jobs, self.n_concurrent_downloads))
+            while pending:
+                result = await pending.popleft()
+                for func, args in islice(jobs, 1):
+                    pending.append(loop.run_in_executor(executor, func, *args))
+                yield result
+        finally:
+            if executor is not self.download_executor:
+                executor.shutdown()
+
+    def get_zip(self, base_url, symbol, date) -> bytes:
+        """
+        Fetches the zipped trades of a day or month from the Binance repository.
         @param symbol: Symbol to fetch.
-        @param date: Day to download.
-        @return: Dataframe with full day.
+        @param date: Day or month to download.
+        @return: Zip archive, empty if not available.
         """
         print_(['Fetching', symbol, date])
         url = "{}{}/{}-aggTrades-{}.zip".format(base_url, symbol.upper(), symbol.upper(), date)
-        df = pd.DataFrame(columns=['trade_id', 'price', 'qty', 'timestamp', 'is_buyer_maker'])
+        try:
+            return self.fetch_with_retries(url)
+        except Exception as e:
+            print('Failed to fetch', date, e)
+        return b''
+
+    def iter_zip_batches(self, archive: bytes, chunksize: int = 1000000):
+        """
+        Parses a zip archive of trades in bounded batches, so a whole month is never held as one dataframe.
+        @param archive: Zip archive as returned by get_zip.
+        @param chunksize: Maximum number of trades per batch.
+        @return: Generator of dataframes sorted by trade id.
+        """
+        if not archive:
+            return
         column_names = ['trade_id', 'price', 'qty', 'first', 'last', 'timestamp', 'is_buyer_maker']
         if self.spot:
             column_names.append('best_match')
         try:
-            resp = urlopen(url)
-            with ZipFile(BytesIO(resp.read())) as my_zip_file:
+            with ZipFile(BytesIO(archive)) as my_zip_file:
                 for contained_file in my_zip_file.namelist():
-                    tf = pd.read_csv(my_zip_file.open(contained_file),
-                                     names=column_names)
-                    tf.drop(errors='ignore', columns=['first', 'last', 'best_match'], inplace=True)
-                    tf["trade_id"] = tf["trade_id"].astype(np.int64)
-                    tf["price"] = tf["price"].astype(np.float64)
-                    tf["qty"] = tf["qty"].astype(np.float64)
-                    tf["timestamp"] = tf["timestamp"].astype(np.int64)
-                    tf["is_buyer_maker"] = tf["is_buyer_maker"].astype(np.int8)
-                    tf.sort_values("trade_id", inplace=True)
-                    tf.drop_duplicates("trade_id", inplace=True)
-                    tf.reset_index(drop=True, inplace=True)
-                    if df.empty:
-                        df = tf
-                    else:
-                        df = pd.concat([df, tf])
+                    # keep only needed columns in their final dtypes
+                    for tf in pd.read_csv(my_zip_file.open(contained_file),
+                                          names=column_names,
+                                          usecols=['trade_id', 'price', 'qty', 'timestamp', 'is_buyer_maker'],
+                                          dtype={'trade_id': np.int64, 'price': np.float64, 'qty': np.float64,
+                                                 'timestamp': np.int64},
+                                          chunksize=chunksize):
+                        tf["is_buyer_maker"] = tf["is_buyer_maker"].astype(np.int8)
+                        if not is_strictly_increasing(tf["trade_id"].values):
+                            tf.sort_values("trade_id", inplace=True)
+                            tf.drop_duplicates("trade_id", inplace=True)
+                        tf.reset_index(drop=True, inplace=True)
+                        yield tf
         except Exception as e:
-            print('Failed to fetch', date, e)
-        return df
-
-    async def find_df_enclosing_timestamp(self, timestamp, guessed_chunk=None):
-        if guessed_chunk is not None:
-            if guessed_chunk[0]['timestamp'] < timestamp < guessed_chunk[-1]['timestamp']:
-                print_(['found id'])
-                return self.transform_ticks(guessed_chunk)
-        else:
-            guessed_chunk = sorted(await self.bot.fetch_ticks(do_print=False), key=lambda x: x['trade_id'])
-            return await self.find_df_enclosing_timestamp(timestamp, guessed_chunk)
+            print('Failed to parse archive', e)
 
-
-        if timestamp < guessed_chunk[0]['timestamp']:
-            guessed_id = (guessed_chunk[0]['trade_id'] -
-                          len(guessed_chunk) * 
-                          (guessed_chunk[0]['timestamp'] - timestamp) /
-                           (guessed_chunk[-1]['timestamp'] - guessed_chunk[0]['timestamp']))
-        else:
-            guessed_id = (guessed_chunk[-1]['trade_id'] +
-                          len(guessed_chunk) * 
-                          (timestamp - guessed_chunk[-1]['timestamp']) /
-                           (guessed_chunk[-1]['timestamp'] - guessed_chunk[0]['timestamp']))
-        guessed_id = int(guessed_id - len(guessed_chunk) / 2)
-        guessed_chunk = sorted(await self.bot.fetch_ticks(guessed_id, do_print=False), key=lambda x: x['trade_id'])
-        print_([f"guessed_id {guessed_id} earliest ts {ts_to_date(guessed_chunk[0]['timestamp'] / 1000)[:19]} last ts {ts_to_date(guessed_chunk[-1]['timestamp'] / 1000)[:19]} target ts {ts_to_date(timestamp / 1000)[:19]}"])
-        return await self.find_df_enclosing_timestamp(timestamp, guessed_chunk)
+    async def find_df_enclosing_timestamp(self, timestamp):
+        return await self.search_trade_id(timestamp)
 
     def deduce_trade_ids(self, daily_ticks, df_for_id_matching):
         for idx in [0, -1]:
@@ -347,75 +459,57 @@ class Downloader:
 
         if self.config["exchange"] == "binance":
             if self.spot:
-                self.bot = await create_binance_bot_spot(get_dummy_settings(self.config))
+                self.bot = await create_binance_bot_spot(get_dummy_settings(self.config), self.session)
             else:
-                self.bot = await create_binance_bot(get_dummy_settings(self.config))
+                self.bot = await create_binance_bot(get_dummy_settings(self.config), self.session)
         elif self.config["exchange"] == "bybit":
             self.bot = await create_bybit_bot(get_dummy_settings(self.config))
         else:
             print(self.config["exchange"], 'not found')
             return
+        self.rate_limited = hasattr(self.bot, 'get_rate_limiter')
 
         filenames = self.get_filenames()
+        entries = dict(self.manifest.entries)
         mod_files = []
         highest_id = 0
-        for f in filenames:
-            try:
-                first_time = int(f.split("_")[2])
-                last_time = int(f.split("_")[3].split(".")[0])
-            except:
-                first_time = sys.maxsize
-                last_time = sys.maxsize
-            if last_time >= self.start_time and (
-                    self.end_time == -1 or (first_time <= self.end_time)) or last_time == sys.maxsize:
+        for f in self.manifest.get_range(self.start_time, self.end_time):
+            if f in self.manifest.entries:
+                if self.manifest.is_validated(f):
+                    highest_id = max(highest_id, self.manifest.entries[f]['last_id'])
+                    continue
                 print_(['Validating file', f])
+                if self.is_complete_chunk(os.path.join(self.filepath, f)):
+                    highest_id = max(highest_id, self.manifest.entries[f]['last_id'])
+                    self.manifest.set_validated(f)
+                    continue
                 df = self.read_dataframe(os.path.join(self.filepath, f))
                 missing, df, gaps = self.validate_dataframe(df)
                 exists = False
-                if gaps.empty:
+                if len(gaps) == 0:
                     first_id = df["trade_id"].iloc[0]
                 else:
-                    first_id = df["trade_id"].iloc[0] if df["trade_id"].iloc[0] < gaps["start"].iloc[0] else \
-                        gaps["start"].iloc[0]
-                if not gaps.empty and (f != filenames[-1] or str(first_id - first_id % 100000) not in f):
+                    first_id = min(df["trade_id"].iloc[0], gaps[0][0])
+                if len(gaps) > 0 and (f != filenames[-1] or str(first_id - first_id % 100000) not in f):
                     last_id = df["trade_id"].iloc[-1]
                     for i in filenames:
-                        tmp_first_id = int(i.split("_")[0])
-                        tmp_last_id = int(i.split("_")[1].replace('.csv', ''))
+                        tmp_first_id = entries[i]['first_id']
+                        tmp_last_id = entries[i]['last_id']
                         if (first_id - first_id % 100000) == tmp_first_id and (
                                 (first_id - first_id % 100000 + 99999) == tmp_last_id or (
                                 highest_id == tmp_first_id or highest_id == tmp_last_id) or highest_id > last_id) and first_id != 1 and i != f:
                             exists = True
                             break
                 if missing and df["timestamp"].iloc[-1] > self.start_time and not exists:
-                    current_time = df["timestamp"].iloc[-1]
-                    for i in gaps.index:
-                        print_(['Filling gaps from id', gaps["start"].iloc[i], 'to id', gaps["end"].iloc[i]])
-                        current_id = gaps["start"].iloc[i]
-                        while current_id < gaps["end"].iloc[i] and int(
-                                datetime.datetime.now(datetime.timezone.utc).timestamp() * 1000) - current_time > 10000:
-                            loop_start = time()
-                            try:
-                                fetched_new_trades = await self.bot.fetch_ticks(int(current_id))
-                                tf = self.transform_ticks(fetched_new_trades)
-                                if tf.empty:
-                                    print_(["Response empty. No new trades, exiting..."])
-                                    await asyncio.sleep(max(0.0, self.fetch_delay_seconds - time() + loop_start))
-                                    break
-                                if current_id == tf["trade_id"].iloc[-1]:
-                                    print_(["Same trade ID again. No new trades, exiting..."])
-                                    await asyncio.sleep(max(0.0, self.fetch_delay_seconds - time() + loop_start))
-                                    break
-                                current_id = tf["trade_id"].iloc[-1]
-                                df = pd.concat([df, tf])
-                                df.sort_values("trade_id", inplace=True)
-                                df.drop_duplicates("trade_id", inplace=True)
-                                df = df[df["trade_id"] <= gaps["end"].iloc[i] - gaps["end"].iloc[i] % 100000 + 99999]
-                                df.reset_index(drop=True, inplace=True)
-                                current_time = df["timestamp"].iloc[-1]
-                            except Exception:
-                                print("Failed to fetch or transform...")
-                            await asyncio.sleep(max(0.0, self.fetch_delay_seconds - time() + loop_start))
+                    jobs = [self.fill_gap(start, end, df["timestamp"].iloc[-1]) for start, end in gaps]
+                    if self.rate_limited:
+                        fetched = await asyncio.gather(*jobs)
+                    else:
+                        fetched = [await job for job in jobs]
+                    df = pd.concat([df] + fetched)
+                    df.sort_values("trade_id", inplace=True)
+                    df.drop_duplicates("trade_id", inplace=True)
+                    df.reset_index(drop=True, inplace=True)
                 if not df.empty:
                     if df["trade_id"].iloc[-1] > highest_id:
                         highest_id = df["trade_id"].iloc[-1]
@@ -425,19 +519,24 @@ class Downloader:
                         df = df[:tf.index[-1]]
                     nf = self.save_dataframe(df, f, missing)
                     mod_files.append(nf)
+                    _, df, gaps = self.validate_dataframe(df.copy())
+                    if len(gaps) == 0:
+                        self.manifest.set_validated(get_chunk_name(df))
                 elif df["trade_id"].iloc[0] != 1:
-                    os.remove(os.path.join(self.filepath, f))
+                    remove_chunk(os.path.join(self.filepath, f))
+                    self.manifest.remove(f)
                     print_(['Removed file fragment', f])
 
         chunk_gaps = []
-        filenames = self.get_filenames()
+        # chunks ending before start_time neither bound a gap nor are continued from
+        filenames = self.manifest.get_range(self.start_time)
         prev_last_id = 0
         prev_last_time = self.start_time
         for f in filenames:
-            first_id = int(f.split("_")[0])
-            last_id = int(f.split("_")[1])
-            first_time = int(f.split("_")[2])
-            last_time = int(f.split("_")[3].split(".")[0])
+            first_id = self.manifest.entries[f]['first_id']
+            last_id = self.manifest.entries[f]['last_id']
+            first_time = self.manifest.entries[f]['first_ts']
+            last_time = self.manifest.entries[f]['last_ts']
             if first_id - 1 != prev_last_id and f not in mod_files:
                 if first_time >= prev_last_time and first_time >= self.start_time:
                     if self.end_time != -1 and self.end_time < first_time and not prev_last_time > self.end_time:
@@ -488,42 +587,42 @@ class Downloader:
 
                 df = pd.DataFrame(columns=['trade_id', 'price', 'qty', 'timestamp', 'is_buyer_maker'])
 
-                for date in dates:
-                    if len(date.split('-')) == 2:
-                        tf = self.get_zip(self.monthly_base_url, self.config['symbol'], date)
-                    elif len(date.split('-')) == 3:
-                        tf = self.get_zip(self.daily_base_url, self.config['symbol'], date)
-                    else:
-                        print("Something wrong with the date", date)
-                        tf = pd.DataFrame()
-                    tf = tf[tf['timestamp'] >= start_time]
-                    if end_time != -1:
-                        tf = tf[tf['timestamp'] <= end_time]
-                    if start_id != 0:
-                        tf = tf[tf['trade_id'] > start_id]
-                    if end_id != 0:
-                        tf = tf[tf['trade_id'] <= end_id]
-                    if df.empty:
-                        df = tf
-                    else:
-                        df = pd.concat([df, tf])
-                    df.sort_values("trade_id", inplace=True)
-                    df.drop_duplicates("trade_id", inplace=True)
-                    df.reset_index(drop=True, inplace=True)
-
-                    if not df.empty and (
-                            (df['trade_id'].iloc[0] % 100000 == 0 and len(df) >= 100000) or df['trade_id'].iloc[
-                        0] % 100000 != 0):
-                        for index, row in df[df['trade_id'] % 100000 == 0].iterrows():
-                            if index != 0:
-                                self.save_dataframe(df[(df['trade_id'] >= row['trade_id'] - 1000000) & (
-                                        df['trade_id'] < row['trade_id'])], "", True)
-                                df = df[df['trade_id'] >= row['trade_id']]
-                    if not df.empty:
-                        start_id = df["trade_id"].iloc[0] - 1
-                        start_time = df["timestamp"].iloc[0]
-                        current_time = df["timestamp"].iloc[-1]
-                        current_id = df["trade_id"].iloc[-1] + 1
+                jobs = [(self.get_zip, (self.monthly_base_url if len(date.split('-')) == 2 else self.daily_base_url,
+                                        self.config['symbol'], date))
+                        for date in dates]
+                loop = asyncio.get_event_loop()
+                async for archive in self.iter_downloads(jobs):
+                    # batches are parsed one at a time off the event loop and dumped as chunks fill up
+                    batches = self.iter_zip_batches(archive)
+                    while (tf := await loop.run_in_executor(None, next, batches, None)) is not None:
+                        tf = tf[tf['timestamp'] >= start_time]
+                        if end_time != -1:
+                            tf = tf[tf['timestamp'] <= end_time]
+                        if start_id != 0:
+                            tf = tf[tf['trade_id'] > start_id]
+                        if end_id != 0:
+                            tf = tf[tf['trade_id'] <= end_id]
+                        if df.empty:
+                            df = tf
+                        else:
+                            df = pd.concat([df, tf])
+                        df.sort_values("trade_id", inplace=True)
+                        df.drop_duplicates("trade_id", inplace=True)
+                        df.reset_index(drop=True, inplace=True)
+
+                        if not df.empty and (
+                                (df['trade_id'].iloc[0] % 100000 == 0 and len(df) >= 100000) or df['trade_id'].iloc[
+                            0] % 100000 != 0):
+                            for index, row in df[df['trade_id'] % 100000 == 0].iterrows():
+                                if index != 0:
+                                    self.save_dataframe(df[(df['trade_id'] >= row['trade_id'] - 1000000) & (
+                                            df['trade_id'] < row['trade_id'])], "", True)
+                                    df = df[df['trade_id'] >= row['trade_id']]
+                        if not df.empty:
+                            start_id = df["trade_id"].iloc[0] - 1
+                            start_time = df["timestamp"].iloc[0]
+                            current_time = df["timestamp"].iloc[-1]
+                            current_id = df["trade_id"].iloc[-1] + 1
             elif False:#self.config['exchange'] == 'bybit':
 
                 # work in progress
@@ -613,11 +712,11 @@ class Downloader:
                 tf = self.transform_ticks(fetched_new_trades)
                 if tf.empty:
                     print_(["Response empty. No new trades, exiting..."])
-                    await asyncio.sleep(max(0.0, self.fetch_delay_seconds - time() + loop_start))
+                    await self.pace(loop_start)
                     break
                 if current_id == tf["trade_id"].iloc[-1]:
                     print_(["Same trade ID again. No new trades, exiting..."])
-                    await asyncio.sleep(max(0.0, self.fetch_delay_seconds - time() + loop_start))
+                    await self.pace(loop_start)
                     break
                 df = pd.concat([df, tf])
                 df.sort_values("trade_id", inplace=True)
@@ -633,7 +732,7 @@ class Downloader:
                     elif df["trade_id"].iloc[0] % 100000 != 0 and len(tf) == 1:
                         self.save_dataframe(df[:tf.index[-1]], "", True)
                         df = df[tf.index[-1]:]
-                await asyncio.sleep(max(0.0, self.fetch_delay_seconds - time() + loop_start))
+                await self.pace(loop_start)
             if not df.empty:
                 df = df[df["timestamp"] >= start_time]
                 if start_id != 0 and not df.empty:
@@ -645,136 +744,141 @@ class Downloader:
                 if not df.empty:
                     self.save_dataframe(df, "", True)
 
-        try:
-            await self.bot.session.close()
-        except:
-            pass
+        if self.session is None:
+            try:
+                await self.bot.session.close()
+            except:
+                pass
 
     def get_unabridged_df(self):
-        filenames = self.get_filenames()
-        start_index = 0
-        for i in range(len(filenames)):
-            if int(filenames[i].split("_")[2]) <= self.start_time <= int(filenames[i].split("_")[3].split(".")[0]):
-                start_index = i
-                break
-        end_index = -1
-        if self.end_time != -1:
-            for i in range(len(filenames)):
-                if int(filenames[i].split("_")[2]) <= self.end_time <= int(filenames[i].split("_")[3].split(".")[0]):
-                    end_index = i
-                    break
-        filenames = filenames[start_index:] if end_index == -1 else filenames[start_index:end_index + 1]
-        df = pd.DataFrame()
-        chunks = []
-        for f in filenames:
-            chunk = pd.read_csv(os.path.join(self.filepath, f)).set_index('trade_id')
-            if self.end_time != -1:
-                chunk = chunk[(chunk['timestamp'] >= self.start_time) & (chunk['timestamp'] <= self.end_time)]
-            else:
-                chunk = chunk[(chunk['timestamp'] >= self.start_time)]
-            chunks.append(chunk)
-            if len(chunks) >= 100:
-                if df.empty:
-                    df = pd.concat(chunks, axis=0)
-                else:
-                    chunks.insert(0, df)
-                    df = pd.concat(chunks, axis=0)
-                chunks = []
-            print('\rloaded chunk of data', f, ts_to_date(float(f.split("_")[2]) / 1000), end='     ')
-        print()
-        if chunks:
-            if df.empty:
-                df = pd.concat(chunks, axis=0)
-            else:
-                chunks.insert(0, df)
-                df = pd.concat(chunks, axis=0)
-            del chunks
+        """
+        Loads all trades from start to end time.
+        @return: Dataframe of trades indexed by trade id.
+        """
+        df = pd.DataFrame(load_range(self.filepath, self.manifest, self.start_time, self.end_time)).set_index('trade_id')
+        print_(['loaded', len(df), 'trades'])
         return df
 
     async def prepare_files(self, single_file: bool = False):
         """
-        Takes downloaded data and prepares numpy arrays for use in backtesting.
-        @param single_file: If a single array should be created ot multiple ones.
+        Takes downloaded data and samples it into the day segmented sample cache for use in backtesting.
+        Only days not cached yet, or whose source chunks changed, are sampled.
+        @param single_file: Kept for compatibility, samples always go to the sample cache.
         @return:
         """
-        filenames = self.get_filenames()
-        start_index = 0
-        for i in range(len(filenames)):
-            if int(filenames[i].split("_")[2]) <= self.start_time <= int(filenames[i].split("_")[3].split(".")[0]):
-                start_index = i
-                break
-        end_index = -1
-        if self.end_time != -1:
-            for i in range(len(filenames)):
-                if int(filenames[i].split("_")[2]) <= self.end_time <= int(filenames[i].split("_")[3].split(".")[0]):
-                    end_index = i
-                    break
-        filenames = filenames[start_index:] if end_index == -1 else filenames[start_index:end_index + 1]
-
-        chunks = []
-        df = pd.DataFrame()
+        self.sample_cache.update(self.manifest, self.filepath, self.start_time, self.end_time)
 
-        for f in filenames:
-            if single_file:
-                chunk = pd.read_csv(os.path.join(self.filepath, f),
-                                    dtype={"price": np.float64, "is_buyer_maker": np.float64, "timestamp": np.float64,
-                                           "qty": np.float64},
-                                    usecols=["price", "is_buyer_maker", "timestamp", "qty"])
-            else:
-                chunk = pd.read_csv(os.path.join(self.filepath, f),
-                                    dtype={"timestamp": np.int64, "price": np.float64, "is_buyer_maker": np.int8,
-                                           "qty": np.float32},
-                                    usecols=["timestamp", "price", "is_buyer_maker", "qty"])
-            if self.end_time != -1:
-                chunk = chunk[(chunk['timestamp'] >= self.start_time) & (chunk['timestamp'] <= self.end_time)]
-            else:
-                chunk = chunk[(chunk['timestamp'] >= self.start_time)]
-            chunks.append(chunk)
-            if len(chunks) >= 100:
-                if df.empty:
-                    df = pd.concat(chunks, axis=0)
-                else:
-                    chunks.insert(0, df)
-                    df = pd.concat(chunks, axis=0)
-                chunks = []
-            print('\rloaded chunk of data', f, ts_to_date(float(f.split("_")[2]) / 1000), end='     ')
-        print('\n')
-        if chunks:
-            if df.empty:
-                df = pd.concat(chunks, axis=0)
-            else:
-                chunks.insert(0, df)
-                df = pd.concat(chunks, axis=0)
-            del chunks
-
-        if True: #single_file:
-            sampled_ticks = calc_samples(df[["timestamp", "qty", "price"]].values)
-            print_(["Saving single file with", len(df), " ticks to", self.tick_filepath, "..."])
-            np.save(self.tick_filepath, sampled_ticks)
-            print_(["Saved single file!"])
+    async def get_sampled_ticks_location(self) -> (str, int, int):
+        """
+        Makes sure sampled ticks from start to end time are cached, downloading missing data if needed.
+        @return: Samples filepath, start index and end index, see sample_cache.load_samples_view.
+        """
+        if self.end_time == -1 or not self.sample_cache.covers(self.start_time, self.end_time):
+            await self.download_ticks()
+            await self.prepare_files()
+        else:
+            print_(['Loading cached tick data from', self.sample_cache.filepath])
+        return self.sample_cache.get_location(self.start_time, self.end_time)
 
     async def get_sampled_ticks(self) -> np.ndarray:
         """
-        Function for direct use in the backtester. Checks if the numpy arrays exist and if so loads them.
-        If they do not exist or if their length doesn't match, download the missing data and create them.
-        @return: numpy array.
+        Function for direct use in the backtester. Downloads and samples missing data, then returns the cached samples.
+        @return: Read only numpy array, memory mapped from the sample cache.
         """
-        if os.path.exists(self.tick_filepath):
-            print_(['Loading cached tick data from', self.tick_filepath])
-            tick_data = np.load(self.tick_filepath)
-            return tick_data
-        await self.download_ticks()
-        await self.prepare_files()
-        tick_data = np.load(self.tick_filepath)
-        return tick_data
+        return load_samples_view(await self.get_sampled_ticks_location())
+
+
+def prepare_symbol(config: dict) -> float:
+    """
+    Samples downloaded ticks of one symbol, run in a worker process.
+    @param config: Config of the symbol.
+    @return: Seconds spent sampling.
+    """
+    sts = time()
+    asyncio.run(Downloader(config).prepare_files(False))
+    return time() - sts
+
+
+async def download_symbol(config: dict, semaphore: asyncio.Semaphore, executor: ProcessPoolExecutor,
+                          download_only: bool, session: aiohttp.ClientSession = None,
+                          download_executor: ThreadPoolExecutor = None) -> dict:
+    """
+    Downloads ticks of one symbol, holding one of the download slots, then samples them in the process pool.
+    @param config: Config of the symbol.
+    @param semaphore: Limits number of symbols downloading at once.
+    @param executor: Process pool for sampling, None to skip sampling.
+    @param download_only: If sampling is skipped.
+    @param session: Session shared by all symbols.
+    @param download_executor: Thread pool for archive downloads shared by all symbols.
+    @return: Throughput report of the symbol.
+    """
+    async with semaphore:
+        # csv migration and manifest checksum sync are blocking file io
+        downloader = await asyncio.get_event_loop().run_in_executor(None, Downloader, config, session,
+                                                                    download_executor)
+        n_rows_before = sum(e['n_rows'] for e in downloader.manifest.entries.values())
+        sts = time()
+        await downloader.download_ticks()
+        download_seconds = time() - sts
+        n_trades = sum(e['n_rows'] for e in downloader.manifest.entries.values()) - n_rows_before
+        print_([config['symbol'], 'downloaded', n_trades, 'trades in', round(download_seconds, 2), 'seconds'])
+    sampling_seconds = 0.0
+    if not download_only:
+        sampling_seconds = await asyncio.get_event_loop().run_in_executor(executor, prepare_symbol, config)
+        print_([config['symbol'], 'sampled in', round(sampling_seconds, 2), 'seconds'])
+    return {'symbol': config['symbol'], 'n_trades': n_trades, 'download_seconds': download_seconds,
+            'trades_per_second': n_trades / max(download_seconds, 1e-9), 'sampling_seconds': sampling_seconds}
+
+
+async def bulk_download(configs: [dict], n_concurrent_symbols: int, download_only: bool):
+    """
+    Downloads many symbols concurrently. Binance requests of all symbols share one session and one rate limiter per
+    api, and trade archive downloads of all symbols share one pool of n_concurrent_downloads threads.
+    Sampling runs in a process pool while later symbols keep downloading.
+    @param configs: One config per symbol.
+    @param n_concurrent_symbols: Number of symbols downloading at once.
+    @param download_only: If sampling is skipped.
+    @return:
+    """
+    n_concurrent_symbols = max(1, min(n_concurrent_symbols, len(configs)))
+    semaphore = asyncio.Semaphore(n_concurrent_symbols)
+    n_concurrent_downloads = configs[0]['n_concurrent_downloads'] if 'n_concurrent_downloads' in configs[0] else 4
+    n_cpus = configs[0]['num_cpus'] if 'num_cpus' in configs[0] else os.cpu_count()
+    # bybit bots set own session headers
+    session = None if configs[0]['exchange'] == 'bybit' else \
+        aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=max(n_concurrent_downloads, n_concurrent_symbols)))
+    sts = time()
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, n_cpus)) as executor, \
+                ThreadPoolExecutor(max_workers=n_concurrent_downloads) as download_executor:
+            reports = await asyncio.gather(*[download_symbol(config, semaphore, executor, download_only, session,
+                                                             download_executor)
+                                             for config in configs])
+    finally:
+        if session is not None:
+            await session.close()
+    table = PrettyTable()
+    table.field_names = ['symbol', 'new trades', 'download seconds', 'trades per second', 'sampling seconds']
+    for r in reports:
+        table.add_row([r['symbol'], r['n_trades'], round(r['download_seconds'], 2), round(r['trades_per_second'], 1),
+                       round(r['sampling_seconds'], 2)])
+    print(table.get_string(border=True, padding_width=1))
+    print_([len(configs), 'symbols done in', round(time() - sts, 2), 'seconds'])
 
 
 async def main():
     parser = argparse.ArgumentParser(prog='Downloader', description='Download ticks from exchange API.')
     parser = add_argparse_args(parser)
+    parser.add_argument('--bulk', help='download symbols concurrently', action='store_true')
+    parser.add_argument('--n_concurrent_symbols', type=int, required=False, dest='n_concurrent_symbols', default=4,
+                        help='number of symbols downloading at once in bulk mode')
 
     args = parser.parse_args()
-    for config in await prep_config(args):
+    configs = await prep_config(args)
+    if args.bulk:
+        await bulk_download(configs, args.n_concurrent_symbols, args.download_only)
+        return
+    for config in configs:
         downloader = Downloader(config)
         await downloader.download_ticks()
         if not args.download_only:
@@ -0,0 +1,110 @@
+import argparse
+import asyncio
+import json
+import os
+from multiprocessing import Pool
+from time import time
+
+import numpy as np
+from prettytable import PrettyTable
+
+from backtest import backtest
+from downloader import Downloader
+from njit_funcs import calc_block_bootstrap_samples
+from procedures import prep_config, make_get_filepath, load_live_config, add_argparse_args
+from sample_cache import load_samples_view
+from pure_funcs import analyze_fills, ts_to_date, spotify_config, round_dynamic
+
+_data = None
+
+
+def init_worker(location: (str, int, int)):
+    global _data
+    _data = load_samples_view(location)
+
+
+def run_path(args) -> dict:
+    '''
+    path is generated inside the worker and discarded after backtesting,
+    so at most one synthetic path per worker is held in memory
+    seed None means original path
+    '''
+    config, block_size, seed = args
+    if seed is None:
+        path = _data
+    else:
+        path = calc_block_bootstrap_samples(_data, block_size, config['price_step'], seed)
+    fills, info = backtest(config, path)
+    fdf, analysis = analyze_fills(fills, {**config, **{'lowest_eqbal_ratio': info[1], 'closest_bkr': info[2]}},
+                                  path[0][0], path[-1][0])
+    if fdf.empty:
+        max_drawdown = 0.0
+    else:
+        max_drawdown = float(1 - (fdf.equity / fdf.equity.cummax()).min())
+    return {'seed': seed,
+            'average_daily_gain': analysis['average_daily_gain'],
+            'closest_bkr': analysis['closest_bkr'],
+            'lowest_eqbal_ratio': analysis['lowest_eqbal_ratio'],
+            'max_drawdown': max_drawdown,
+            'gain': analysis['gain'],
+            'n_fills': analysis['n_fills']}
+
+
+async def main():
+    parser = argparse.ArgumentParser(prog='MonteCarlo',
+                                     description='Backtest given passivbot config on block bootstrapped price paths.')
+    parser.add_argument('live_config_path', type=str, help='path to live config to test')
+    parser = add_argparse_args(parser)
+    parser.add_argument('-k', '--n_paths', type=int, required=False, dest='n_paths', default=100,
+                        help='number of synthetic price paths')
+    parser.add_argument('--block_minutes', type=float, required=False, dest='block_minutes', default=60.0,
+                        help='length of each bootstrapped block of returns in minutes')
+    parser.add_argument('--seed', type=int, required=False, dest='seed', default=0,
+                        help='seed of first path; path i uses seed + i')
+    args = parser.parse_args()
+
+    for config in await prep_config(args):
+        live_config = load_live_config(args.live_config_path)
+        if 'spot' in config['market_type']:
+            live_config = spotify_config(live_config)
+        config.update(live_config)
+        dl = Downloader(config)
+        location = await dl.get_sampled_ticks_location()
+        data = load_samples_view(location)
+        config['n_days'] = (data[-1][0] - data[0][0]) / (1000 * 60 * 60 * 24)
+        block_size = max(1, int(round(args.block_minutes * 60 * 1000 / (data[1][0] - data[0][0]))))
+        dirpath = make_get_filepath(os.path.join(config['plots_dirpath'], 'monte_carlo',
+                                                 ts_to_date(time())[:19].replace(':', ''), ''))
+
+        print(f'backtesting original path and {args.n_paths} synthetic paths on {config["num_cpus"]} cpus...')
+        sts = time()
+        results = []
+        tasks = [(config, block_size, None)] + [(config, block_size, args.seed + i) for i in range(args.n_paths)]
+        with Pool(processes=config['num_cpus'], initializer=init_worker, initargs=(location,)) as pool:
+            for i, result in enumerate(pool.imap(run_path, tasks)):
+                results.append(result)
+                if i % 10 == 0:
+                    print(f'\r{i + 1}/{len(tasks)}', end=' ')
+        print(f'\n{time() - sts:.2f} seconds elapsed')
+
+        original, results = results[0], results[1:]
+        with open(dirpath + 'monte_carlo_results.txt', 'w') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+
+        table = PrettyTable()
+        metrics = ['average_daily_gain', 'closest_bkr', 'lowest_eqbal_ratio', 'max_drawdown', 'gain']
+        table.field_names = ['percentile'] + metrics
+        table.add_row(['original'] + [round_dynamic(original[m], 6) for m in metrics])
+        for percentile in [0, 1, 5, 25, 50, 75, 95, 100]:
+            table.add_row([percentile] + [round_dynamic(np.percentile([r[m] for r in results], percentile), 6)
+                                          for m in metrics])
+        print(table.get_string(border=True, padding_width=1))
+        if 'minimum_bankruptcy_distance' in config:
+            n_below = sum(r['closest_bkr'] < config['minimum_bankruptcy_distance'] for r in results)
+            print(f"{n_below}/{len(results)} paths with closest_bkr below {config['minimum_bankruptcy_distance']}")
+        print('results dumped to', dirpath)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
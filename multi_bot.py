@@ -0,0 +1,131 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+
+import aiohttp
+import websockets
+
+from passivbot import start_bot
+from procedures import load_live_config, add_argparse_args, print_
+
+
+class MultiBotRunner:
+    '''
+    runs several binance futures bots on one event loop
+    bots share one aiohttp session, the process wide rate limiters, one combined stream websocket per api,
+    whose messages are dispatched to each bot's ingest queue by symbol, and one user data stream per api
+    '''
+    def __init__(self, bots: list):
+        self.bots = bots
+        self.stream_groups = {}
+        for bot in bots:
+            url = bot.endpoints['user_stream'].replace('/ws/', '/stream?streams=')
+            if url not in self.stream_groups:
+                self.stream_groups[url] = {}
+            self.stream_groups[url][bot.symbol.lower()] = bot
+            bot.shared_user_stream = True
+
+    def stop(self, signum=None, frame=None) -> None:
+        for bot in self.bots:
+            bot.stop()
+
+    def all_stopped(self) -> bool:
+        return all(bot.stop_websocket for bot in self.bots)
+
+    async def run_stream(self, url: str, bots: dict) -> None:
+        '''
+        bots: {symbol.lower(): bot}
+        reconnects until all bots are stopped; bots keep their state across reconnects
+        '''
+        url += '/'.join([stream for bot in bots.values() for stream in bot.get_websocket_streams()])
+        while not self.all_stopped():
+            try:
+                async with websockets.connect(url) as ws:
+                    print_([url])
+                    async for msg in ws:
+                        data = json.loads(msg)
+                        if 'stream' not in data:
+                            continue
+                        bots[data['stream'][:data['stream'].find('@')]].enqueue_ws_message(data)
+                        if self.all_stopped():
+                            return
+            except Exception as e:
+                print('error in combined stream, reconnecting...', e)
+                await asyncio.sleep(5)
+
+    async def run(self) -> None:
+        sources = [asyncio.create_task(self.run_stream(url, bots)) for url, bots in self.stream_groups.items()]
+        # one listenKey stream per api, dispatched to all bots by symbol
+        user_streams = [asyncio.create_task(list(bots.values())[0].start_user_stream(list(bots.values())))
+                        for bots in self.stream_groups.values()]
+        source_by_bot = {id(bot): source for source, bots in zip(sources, self.stream_groups.values())
+                         for bot in bots.values()}
+        await asyncio.gather(*[start_bot(bot, source_by_bot[id(bot)]) for bot in self.bots])
+        for task in sources + user_streams:
+            task.cancel()
+
+
+def get_multi_bot_argparser():
+    parser = argparse.ArgumentParser(prog='multi_bot', description='run several passivbots in one process')
+    parser.add_argument('user', type=str, help='user/account_name defined in api-keys.json')
+    parser.add_argument('live_config_path', type=str, help='live config to use for symbols given without one')
+    parser.add_argument('symbols', type=str, nargs='+',
+                        help='symbols to trade, optionally with own live config, e.g. BTCUSDT ETHUSDT=configs/live/eth.json')
+    return parser
+
+
+async def main() -> None:
+    args = add_argparse_args(get_multi_bot_argparser()).parse_args()
+    try:
+        account = json.load(open('api-keys.json'))[args.user]
+    except Exception as e:
+        print(e, 'failed to load account', args.user, 'from api-keys.json')
+        return
+    market_type = 'futures' if args.market_type is None else args.market_type
+    if account['exchange'] != 'binance' or 'spot' in market_type:
+        print('multi bot supports binance futures only')
+        return
+    configs = []
+    for arg in args.symbols:
+        symbol, live_config_path = arg.split('=') if '=' in arg else (arg, args.live_config_path)
+        try:
+            config = load_live_config(live_config_path)
+        except Exception as e:
+            print(e, 'failed to load config', live_config_path)
+            return
+        config['user'] = args.user
+        config['exchange'] = account['exchange']
+        config['symbol'] = symbol
+        config['live_config_path'] = live_config_path
+        config['market_type'] = market_type
+        configs.append(config)
+    if len({config['symbol'] for config in configs}) < len(configs):
+        print('each symbol may be given only once')
+        return
+    for config in configs:
+        config['multi_bot_symbols'] = [c['symbol'] for c in configs]
+    if 'telegram' in account and account['telegram']['enabled']:
+        print('telegram is not supported by multi bot, run symbols with passivbot.py to use telegram')
+
+    from procedures import create_binance_bot
+    session = aiohttp.ClientSession()
+    try:
+        bots = await asyncio.gather(*[create_binance_bot(config, session) for config in configs])
+        runner = MultiBotRunner(bots)
+        signal.signal(signal.SIGINT, runner.stop)
+        signal.signal(signal.SIGTERM, runner.stop)
+        await runner.run()
+    finally:
+        await session.close()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except Exception as e:
+        print(f'\nThere was an error starting the bots: {e}')
+    finally:
+        print('\nPassivbot was stopped succesfully')
+        os._exit(0)
@@ -113,6 +113,104 @@ def calc_samples(ticks: np.ndarray, sample_size_ms: int = 1000) -> np.ndarray:
     return samples
 
 
+@njit
+def fill_samples(ticks: np.ndarray, samples: np.ndarray, start_ts: float, sample_size_ms: int,
+                 k: int, price: float) -> (int, float):
+    # ticks [[timestamp, qty, price]], one batch of a stream of ticks sorted by timestamp
+    # samples preallocated [[timestamp, qty, price]], samples[i] covering start_ts + i * sample_size_ms
+    # k, price: index and price of last touched sample, carried from previous batch
+    # after the last batch samples equal calc_samples of all ticks concatenated
+    for i in range(len(ticks)):
+        idx = int((ticks[i][0] - start_ts) // sample_size_ms)
+        if idx < k:
+            samples[idx][1] += ticks[i][1]
+            continue
+        while k < idx:
+            k += 1
+            samples[k][2] = price
+        samples[k][1] += ticks[i][1]
+        samples[k][2] = ticks[i][2]
+        price = ticks[i][2]
+    return k, price
+
+
+@njit
+def is_strictly_increasing(xs: np.ndarray) -> bool:
+    for i in range(1, len(xs)):
+        if xs[i] <= xs[i - 1]:
+            return False
+    return True
+
+
+@njit
+def find_trade_id_gaps(trade_ids: np.ndarray, chunk_size: int = 100000) -> np.ndarray:
+    # trade_ids sorted and unique
+    # returns int64 [[start, end]] sorted by start: missing ids from start of chunk to first id,
+    # each gap from last present id to next present id, and from last id to end of chunk
+    n = len(trade_ids)
+    gaps = np.empty((n + 1, 2), dtype=np.int64)
+    if n == 0:
+        return gaps[:0]
+    k = 0
+    if trade_ids[0] % chunk_size != 0:
+        gaps[k][0] = trade_ids[0] - trade_ids[0] % chunk_size
+        gaps[k][1] = trade_ids[0] - 1
+        k += 1
+    for i in range(1, n):
+        if trade_ids[i] - trade_ids[i - 1] != 1:
+            gaps[k][0] = trade_ids[i - 1]
+            gaps[k][1] = trade_ids[i]
+            k += 1
+    if trade_ids[-1] % chunk_size != chunk_size - 1:
+        gaps[k][0] = trade_ids[-1]
+        gaps[k][1] = trade_ids[-1] + chunk_size - 1 - trade_ids[-1] % chunk_size
+        k += 1
+    for i in range(k):
+        if gaps[i][0] == 0:
+            gaps[i][0] = 1
+    return gaps[:k]
+
+
+@njit
+def calc_block_bootstrap_samples(samples: np.ndarray, block_size: int, price_step: float, seed: int) -> np.ndarray:
+    # samples [[timestamp, qty, price]]
+    # synthetic path with same timestamps and start price, made of randomly drawn blocks of consecutive
+    # log returns, each return paired with the qty of the same sample
+    # zero or nan prices, e.g. in sampled gaps, are forward filled, leading ones back filled with first valid price
+    np.random.seed(seed)
+    n = len(samples)
+    block_size = max(1, min(block_size, n - 1))
+    prices = samples[:, 2].copy()
+    first_valid = -1
+    for i in range(n):
+        if prices[i] > 0.0:
+            first_valid = i
+            break
+    if first_valid == -1:
+        raise ValueError('no positive prices in samples')
+    prices[:first_valid] = prices[first_valid]
+    for i in range(first_valid + 1, n):
+        if not prices[i] > 0.0:
+            prices[i] = prices[i - 1]
+    log_returns = np.log(prices[1:] / prices[:-1])
+    path = np.empty((n, 3))
+    path[:, 0] = samples[:, 0]
+    path[0][1] = samples[0][1]
+    path[0][2] = prices[0]
+    log_price = np.log(prices[0])
+    k = 1
+    while k < n:
+        start = np.random.randint(0, n - block_size)
+        for j in range(start, start + block_size):
+            if k >= n:
+                break
+            log_price += log_returns[j]
+            path[k][1] = samples[j + 1][1]
+            path[k][2] = round_(np.exp(log_price), price_step)
+            k += 1
+    return path
+
+
 @njit
 def calc_emas(xs, spans):
     emas = np.zeros((len(xs), len(spans)))
@@ -919,6 +1017,98 @@ def calc_orders(balance,
     return long_entry, shrt_entry, long_close, shrt_close, bkr_price, available_margin
 
 
+ORDER_TYPES = ('', 'long_ientry', 'long_rentry', 'long_nclose', 'long_sclose',
+               'shrt_ientry', 'shrt_rentry', 'shrt_nclose', 'shrt_sclose')
+
+
+@njit
+def get_order_type_code(order_type: str) -> int:
+    for i in range(len(ORDER_TYPES)):
+        if ORDER_TYPES[i] == order_type:
+            return i
+    return 0
+
+
+@njit
+def calc_orders_grid(balance,
+                     long_psize,
+                     long_pprice,
+                     shrt_psize,
+                     shrt_pprice,
+                     highest_bid,
+                     lowest_ask,
+                     last_price,
+                     MAs,
+                     last_price_diff_limit,
+                     n_orders_limit,
+                     do_entries,
+
+                     spot,
+                     hedge_mode,
+                     inverse,
+                     do_long,
+                     do_shrt,
+                     qty_step,
+                     price_step,
+                     min_qty,
+                     min_cost,
+                     c_mult,
+                     max_leverage,
+                     spans,
+                     pbr_stop_loss,
+                     pbr_limit,
+                     iqty_const,
+                     iprc_const,
+                     rqty_const,
+                     rprc_const,
+                     markup_const,
+                     iqty_MAr_coeffs,
+                     iprc_MAr_coeffs,
+                     rprc_PBr_coeffs,
+                     rqty_MAr_coeffs,
+                     rprc_MAr_coeffs,
+                     markup_MAr_coeffs) -> (np.ndarray, np.ndarray, np.ndarray, int):
+    # whole ladder of orders in one call: closes of current position, then entries, each entry
+    # added to the position before calculating the next, until n_orders_limit is reached
+    # returns qtys (absolute), prices, type codes indexing ORDER_TYPES and number of orders n, arrays valid up to n
+    qtys = np.zeros(n_orders_limit + 4)
+    prices = np.zeros(n_orders_limit + 4)
+    codes = np.zeros(n_orders_limit + 4, dtype=np.int64)
+    n = 0
+    long_done, shrt_done = False, False
+    for i in range(99):
+        long_entry, shrt_entry, long_close, shrt_close, _, _ = calc_orders(
+            balance, long_psize, long_pprice, shrt_psize, shrt_pprice, highest_bid, lowest_ask, last_price, MAs,
+            spot, hedge_mode, inverse, do_long, do_shrt, qty_step, price_step, min_qty, min_cost, c_mult,
+            max_leverage, spans, pbr_stop_loss, pbr_limit, iqty_const, iprc_const, rqty_const, rprc_const,
+            markup_const, iqty_MAr_coeffs, iprc_MAr_coeffs, rprc_PBr_coeffs, rqty_MAr_coeffs, rprc_MAr_coeffs,
+            markup_MAr_coeffs)
+        if i == 0:
+            for close in [long_close, shrt_close]:
+                if close[0] != 0.0 and calc_diff(close[1], last_price) < last_price_diff_limit:
+                    qtys[n], prices[n], codes[n] = abs(close[0]), close[1], get_order_type_code(close[2])
+                    n += 1
+        if not long_done and do_entries and long_entry[0] != 0.0 and \
+                calc_diff(long_entry[1], last_price) < last_price_diff_limit:
+            qtys[n], prices[n], codes[n] = long_entry[0], long_entry[1], get_order_type_code(long_entry[2])
+            n += 1
+            long_psize, long_pprice = calc_new_psize_pprice(long_psize, long_pprice, long_entry[0], long_entry[1],
+                                                            qty_step)
+        else:
+            long_done = True
+        if not shrt_done and do_entries and shrt_entry[0] != 0.0 and \
+                calc_diff(shrt_entry[1], last_price) < last_price_diff_limit:
+            qtys[n], prices[n], codes[n] = abs(shrt_entry[0]), shrt_entry[1], get_order_type_code(shrt_entry[2])
+            n += 1
+            shrt_psize, shrt_pprice = calc_new_psize_pprice(shrt_psize, shrt_pprice, shrt_entry[0], shrt_entry[1],
+                                                            qty_step)
+        else:
+            shrt_done = True
+        if n >= n_orders_limit or (long_done and shrt_done):
+            return qtys, prices, codes, n
+    raise Exception('warning -- infinite loop in calc_orders')
+
+
 
 @njit
 def calc_emas_last(xs, spans):
@@ -930,6 +1120,31 @@ def calc_emas_last(xs, spans):
     return emas
 
 
+@njit
+def update_emas_ticks(emas, alphas, alphas_, ema_sec, price, agg_qty, qty, ticks):
+    '''
+    ticks [[timestamp, qty, price]]
+    one ema step per second boundary, seconds without ticks are stepped at once in closed form
+    returns emas, ema_sec, price, agg_qty, qty
+    '''
+    for i in range(len(ticks)):
+        agg_qty += ticks[i][1]
+        ts_sec = ticks[i][0] // 1000 * 1000
+        if ts_sec <= ema_sec:
+            ema_sec = ts_sec
+            price = ticks[i][2]
+            continue
+        qty = agg_qty
+        agg_qty = 0.0
+        n_gap = (ts_sec - ema_sec) // 1000 - 1
+        if n_gap > 0:
+            emas = ticks[i][2] + (emas - ticks[i][2]) * alphas_ ** n_gap
+        emas = emas * alphas_ + price * alphas
+        ema_sec = ts_sec
+        price = ticks[i][2]
+    return emas, ema_sec, price, agg_qty, qty
+
+
 @njit
 def njit_backtest(ticks: np.ndarray,
                   starting_balance,
@@ -0,0 +1,64 @@
+import argparse
+import json
+import os
+
+import numpy as np
+from prettytable import PrettyTable
+
+from optimize import objective_function
+from procedures import load_config_files, dump_live_config
+from pure_funcs import get_pareto_objectives, calc_pareto_front, round_dynamic
+
+
+def load_results(results_fpath: str) -> [dict]:
+    results = []
+    with open(results_fpath) as f:
+        for line in f.readlines():
+            if line.strip():
+                results.append(json.loads(line))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Pareto',
+                                     description='pick best config from pareto front of optimize results, '
+                                                 'scored with thresholds from given optimize config')
+    parser.add_argument('results_fpath', type=str, help='path to results.txt or pareto_front.txt')
+    parser.add_argument('-o', '--optimize_config', type=str, required=False, dest='optimize_config_path',
+                        default='configs/optimize/default.hjson', help='optimize config hjson file')
+    parser.add_argument('-n', '--n_rows', type=int, required=False, dest='n_rows', default=20,
+                        help='number of pareto front members to print')
+    args = parser.parse_args()
+
+    config = load_config_files([args.optimize_config_path])
+    metric = config['metric'] if 'metric' in config else 'adjusted_daily_gain'
+    results = load_results(args.results_fpath)
+    if not results:
+        print('no results in', args.results_fpath)
+        return
+    front_mask = calc_pareto_front(np.array([get_pareto_objectives(r) for r in results]))
+    front = [r for r, m in zip(results, front_mask) if m]
+    scored = sorted([(objective_function(r, config, metric), r) for r in front], key=lambda x: x[0], reverse=True)
+
+    table = PrettyTable()
+    table.field_names = ['adg', 'bkr_dist', 'eqbal_ratio', 'shrp', 'hrs_no_fills',
+                         'hrs_no_fills_ss', 'mean_hrs_btwn_fills', 'score']
+    for score, r in scored[:args.n_rows]:
+        table.add_row([round_dynamic(e, 6)
+                       for e in [r['average_daily_gain'],
+                                 r['closest_bkr'],
+                                 r['lowest_eqbal_ratio'],
+                                 r['sharpe_ratio'],
+                                 r['max_hrs_no_fills'],
+                                 r['max_hrs_no_fills_same_side'],
+                                 r['mean_hrs_between_fills'],
+                                 score]])
+    print(f'{len(front)} of {len(results)} candidates on pareto front')
+    print(table.get_string(border=True, padding_width=1))
+    best_fpath = os.path.join(os.path.dirname(args.results_fpath), 'pareto_best.json')
+    dump_live_config(scored[0][1], best_fpath)
+    print('best config dumped to', best_fpath)
+
+
+if __name__ == '__main__':
+    main()
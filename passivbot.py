@@ -10,10 +10,10 @@ from pathlib import Path
 from time import time
 from procedures import load_live_config, make_get_filepath, load_exchange_key_secret, print_, add_argparse_args
 from pure_funcs import get_xk_keys, get_ids_to_fetch, flatten, calc_indicators_from_ticks_with_gaps, \
-    drop_consecutive_same_prices, filter_orders, compress_float, create_xk, round_dynamic, denumpyize, \
+    drop_consecutive_same_prices, diff_orders, compress_float, create_xk, round_dynamic, denumpyize, \
     calc_spans, spotify_config, get_position_fills
-from njit_funcs import calc_orders, calc_new_psize_pprice, qty_to_cost, calc_diff, round_, calc_emas, \
-    calc_samples, calc_emas_last
+from njit_funcs import calc_orders_grid, ORDER_TYPES, qty_to_cost, calc_diff, round_, calc_emas, \
+    calc_samples, calc_emas_last, update_emas_ticks
 import numpy as np
 import websockets
 import telegram_bot
@@ -21,6 +21,10 @@ import telegram_bot
 logging.getLogger("telegram").setLevel(logging.CRITICAL)
 
 
+SNAPSHOT_EXCHANGE_INFO_CONFIG_KEYS = ['c_mult', 'min_qty', 'qty_step', 'price_step', 'min_cost', 'max_leverage']
+SNAPSHOT_EXCHANGE_INFO_KEYS = ['coin', 'quot', 'margin_coin', 'pair'] + SNAPSHOT_EXCHANGE_INFO_CONFIG_KEYS
+
+
 class LockNotAvailableException(Exception):
     pass
 
@@ -51,6 +55,7 @@ class Bot:
         self.ts_released = {k: 1.0 for k in self.ts_locked}
 
         self.position = {}
+        self.raw_position = {}
         self.open_orders = []
         self.fills = []
         self.long_pfills = []
@@ -62,11 +67,13 @@ class Bot:
         self.agg_qty = 0.0
         self.qty = 0.0
         self.ob = [0.0, 0.0]
+        self.ob_from_book_ticker = False
 
         self.emas = np.zeros(len(self.spans))
         self.ratios = np.zeros(len(self.spans))
 
         self.n_open_orders_limit = 8
+        self.n_orders_kept_by_tolerance = 0
         self.n_orders_per_execution = 4
 
         self.c_mult = self.config['c_mult'] = 1.0
@@ -79,7 +86,20 @@ class Bot:
 
         self.stop_websocket = False
         self.process_websocket_ticks = True
+        self.user_stream_connected = False
+        self.shared_user_stream = False
+        self.reconcile_interval = 60.0
+        self.state_mismatch = False
+        self.closed_order_ids = set()
+        self.ws_queue = None
+        self.ws_batch_size = 0
+        self.ws_queue_depth = 0
+        self.ws_max_queue_depth = 0
+        self.ws_lag = 0.0
+        self.ws_n_dropped = 0
         self.lock_file = f"{str(Path.home())}/.{self.exchange}_passivbotlock"
+        self.snapshot_filepath = make_get_filepath(f"logs/{self.exchange}/{self.user}_{self.symbol}_snapshot.json")
+        self.ts_snapshot_saved = 0.0
 
     def set_config(self, config):
         config['spans'] = calc_spans(config['min_span'], config['max_span'], config['n_spans'])
@@ -91,6 +111,18 @@ class Bot:
             config['profit_trans_pct'] = 0.0
         if 'cross_wallet_pct' not in config:
             config['cross_wallet_pct'] = 1.0
+        if 'use_book_ticker' not in config:
+            config['use_book_ticker'] = False
+        if 'order_price_tolerance' not in config:
+            config['order_price_tolerance'] = 0.0
+        if 'order_qty_tolerance' not in config:
+            config['order_qty_tolerance'] = 0.0
+        if 'ws_queue_size' not in config:
+            config['ws_queue_size'] = 10000
+        if 'snapshot_interval' not in config:
+            config['snapshot_interval'] = 60.0
+        if 'snapshot_max_age_minutes' not in config:
+            config['snapshot_max_age_minutes'] = 60.0
         if config['cross_wallet_pct'] > 1.0 or config['cross_wallet_pct'] <= 0.0:
             print(f'An invalid value is provided for `cross_wallet_pct` ({config["cross_wallet_pct"]}). The value must be bigger than 0.0 and less than or equal to 1.0. The'
                   f'bot will start with the default value of 1.0, meaning it will utilize the ')
@@ -107,7 +139,30 @@ class Bot:
 
     async def _init(self):
         self.xk = create_xk(self.config)
-        self.fills = await self.fetch_fills()
+        snapshot = self.load_snapshot()
+        if snapshot is not None and 'fills' in snapshot and snapshot['fills']:
+            self.fills = await self.fetch_fills_since_snapshot(snapshot)
+        else:
+            self.fills = await self.fetch_fills()
+
+    async def fetch_fills_since_snapshot(self, snapshot: dict, max_n_fetches: int = 10) -> [dict]:
+        '''
+        fetches only fills after snapshot's fills cursor, a fill id, and merges them with fills from snapshot
+        '''
+        new_fills = []
+        from_id = snapshot['fills_cursor'] + 1
+        for _ in range(max_n_fetches):
+            fetched = await self.fetch_fills(from_id=from_id)
+            new_fills += fetched
+            if len(fetched) < 100:
+                # smallest page size of any market, so no more fills
+                break
+            from_id = fetched[-1]['id'] + 1
+        if new_fills:
+            print(f'{len(new_fills)} fills since last snapshot')
+        ids = {x['id'] for x in snapshot['fills']}
+        return sorted(snapshot['fills'] + [x for x in new_fills if x['id'] not in ids],
+                      key=lambda x: x['order_id'])[-1000:]
 
     def dump_log(self, data) -> None:
         if self.config['logging_level'] > 0:
@@ -119,21 +174,23 @@ class Bot:
             return
         try:
             open_orders = await self.fetch_open_orders()
-            open_orders = [x for x in open_orders if x['symbol'] == self.symbol]
-            self.highest_bid, self.lowest_ask = 0.0, 9.9e9
-            for o in open_orders:
-                if o['side'] == 'buy':
-                    self.highest_bid = max(self.highest_bid, o['price'])
-                elif o['side'] == 'sell':
-                    self.lowest_ask = min(self.lowest_ask, o['price'])
-            if self.open_orders != open_orders:
-                self.dump_log({'log_type': 'open_orders', 'data': open_orders})
-            self.open_orders = open_orders
+            self.set_open_orders([x for x in open_orders if x['symbol'] == self.symbol])
         except Exception as e:
             print('error with update open orders', e)
         finally:
             self.ts_released['update_open_orders'] = time()
 
+    def set_open_orders(self, open_orders: [dict]) -> None:
+        self.highest_bid, self.lowest_ask = 0.0, 9.9e9
+        for o in open_orders:
+            if o['side'] == 'buy':
+                self.highest_bid = max(self.highest_bid, o['price'])
+            elif o['side'] == 'sell':
+                self.lowest_ask = min(self.lowest_ask, o['price'])
+        if self.open_orders != open_orders:
+            self.dump_log({'log_type': 'open_orders', 'data': open_orders})
+        self.open_orders = open_orders
+
     async def update_position(self) -> None:
         # also updates open orders
         if self.ts_locked['update_position'] > self.ts_released['update_position']:
@@ -142,40 +199,125 @@ class Bot:
         try:
             position, _ = await asyncio.gather(self.fetch_position(),
                                                self.update_open_orders())
-            position['used_margin'] = \
-                ((qty_to_cost(position['long']['size'], position['long']['price'],
-                              self.xk['inverse'], self.xk['c_mult'])
-                  if position['long']['price'] else 0.0) +
-                 (qty_to_cost(position['shrt']['size'], position['shrt']['price'],
-                              self.xk['inverse'], self.xk['c_mult'])
-                  if position['shrt']['price'] else 0.0)) / self.max_leverage
-            position['equity'] -= position['wallet_balance'] * (1 - self.cross_wallet_pct)
-            position['wallet_balance'] *= self.cross_wallet_pct
-            position['available_margin'] = (position['equity'] - position['used_margin']) * 0.9
-            position['long']['liq_diff'] = calc_diff(position['long']['liquidation_price'], self.price)
-            position['shrt']['liq_diff'] = calc_diff(position['shrt']['liquidation_price'], self.price)
-            position['long']['pbr'] = (qty_to_cost(position['long']['size'], position['long']['price'],
-                                                   self.xk['inverse'], self.xk['c_mult']) /
-                                       position['wallet_balance']) if position['wallet_balance'] else 0.0
-            position['shrt']['pbr'] = (qty_to_cost(position['shrt']['size'], position['shrt']['price'],
-                                                   self.xk['inverse'], self.xk['c_mult']) /
-                                       position['wallet_balance']) if position['wallet_balance'] else 0.0
-            if self.position != position:
-                if self.position and not 'spot' in self.market_type and \
-                        (self.position['long']['size'] != position['long']['size'] or
-                         self.position['shrt']['size'] != position['shrt']['size']):
-                    # update fills if position size changed
-                    await self.update_fills()
-                self.dump_log({'log_type': 'position', 'data': position})
-            self.position = position
-            self.long_pfills, self.shrt_pfills = get_position_fills(self.position['long']['size'],
-                                                                    abs(self.position['shrt']['size']),
-                                                                    self.fills)
+            await self.set_position(position)
+            self.state_mismatch = False
         except Exception as e:
             print('error with update position', e)
         finally:
             self.ts_released['update_position'] = time()
 
+    async def set_position(self, raw_position: dict) -> None:
+        '''
+        raw_position as returned by fetch_position, kept for patching by user stream events
+        '''
+        self.raw_position = raw_position
+        position = {**raw_position, 'long': {**raw_position['long']}, 'shrt': {**raw_position['shrt']}}
+        position['used_margin'] = \
+            ((qty_to_cost(position['long']['size'], position['long']['price'],
+                          self.xk['inverse'], self.xk['c_mult'])
+              if position['long']['price'] else 0.0) +
+             (qty_to_cost(position['shrt']['size'], position['shrt']['price'],
+                          self.xk['inverse'], self.xk['c_mult'])
+              if position['shrt']['price'] else 0.0)) / self.max_leverage
+        position['equity'] -= position['wallet_balance'] * (1 - self.cross_wallet_pct)
+        position['wallet_balance'] *= self.cross_wallet_pct
+        position['available_margin'] = (position['equity'] - position['used_margin']) * 0.9
+        position['long']['liq_diff'] = calc_diff(position['long']['liquidation_price'], self.price)
+        position['shrt']['liq_diff'] = calc_diff(position['shrt']['liquidation_price'], self.price)
+        position['long']['pbr'] = (qty_to_cost(position['long']['size'], position['long']['price'],
+                                               self.xk['inverse'], self.xk['c_mult']) /
+                                   position['wallet_balance']) if position['wallet_balance'] else 0.0
+        position['shrt']['pbr'] = (qty_to_cost(position['shrt']['size'], position['shrt']['price'],
+                                               self.xk['inverse'], self.xk['c_mult']) /
+                                   position['wallet_balance']) if position['wallet_balance'] else 0.0
+        if self.position != position:
+            if self.position and not 'spot' in self.market_type and not self.user_stream_connected and \
+                    (self.position['long']['size'] != position['long']['size'] or
+                     self.position['shrt']['size'] != position['shrt']['size']):
+                # update fills if position size changed
+                await self.update_fills()
+            self.dump_log({'log_type': 'position', 'data': position})
+        self.position = position
+        self.long_pfills, self.shrt_pfills = get_position_fills(self.position['long']['size'],
+                                                                abs(self.position['shrt']['size']),
+                                                                self.fills)
+
+    def rest_update_due(self, key: str) -> bool:
+        '''
+        while the user stream is connected, local state is kept from order acks and stream events,
+        REST is only used to reconcile it every reconcile_interval seconds or after a mismatch
+        '''
+        return not self.user_stream_connected or self.state_mismatch or \
+            time() - self.ts_released[key] > self.reconcile_interval
+
+    def apply_order_acks(self, created: [dict] = [], cancelled: [dict] = []) -> None:
+        '''
+        optimistically applies acknowledged creations and cancellations to open orders
+        orders already closed according to user stream are not added back
+        '''
+        cancelled_ids = {o['order_id'] for o in cancelled if 'order_id' in o}
+        created = [o for o in created if 'order_id' in o and o['order_id'] not in self.closed_order_ids]
+        if not created and not cancelled_ids:
+            return
+        if len(self.closed_order_ids) > 10000:
+            self.closed_order_ids = set()
+        self.closed_order_ids.update(cancelled_ids)
+        created_ids = {o['order_id'] for o in created}
+        open_orders = [o for o in self.open_orders if o['order_id'] not in cancelled_ids | created_ids] + created
+        self.set_open_orders(sorted(open_orders, key=lambda x: x['price']))
+
+    async def start_user_stream(self) -> None:
+        '''
+        exchanges with a user data stream keep position, open orders and fills up to date from push events,
+        feeding them to handle_user_stream_events
+        '''
+        pass
+
+    async def handle_user_stream_events(self, events: [dict]) -> None:
+        '''
+        events standardized by exchange, each one of
+        {'order': open order, 'status': str}, {'fill': fill}, {'wallet_balance': float},
+        {'position_side': str, 'size': float, 'price': float, 'upnl': float}
+        '''
+        open_orders = self.open_orders
+        raw_position = None
+        new_fills = []
+        for event in events:
+            if 'order' in event:
+                open_orders = [o for o in open_orders if o['order_id'] != event['order']['order_id']]
+                if event['status'] in ['new', 'partially_filled']:
+                    open_orders.append(event['order'])
+                else:
+                    self.closed_order_ids.add(event['order']['order_id'])
+            elif 'fill' in event:
+                new_fills.append(event['fill'])
+            elif self.raw_position:
+                if raw_position is None:
+                    raw_position = {**self.raw_position, 'long': {**self.raw_position['long']},
+                                    'shrt': {**self.raw_position['shrt']}}
+                if 'wallet_balance' in event:
+                    raw_position['equity'] += event['wallet_balance'] - raw_position['wallet_balance']
+                    raw_position['wallet_balance'] = event['wallet_balance']
+                elif 'position_side' in event:
+                    side = raw_position[event['position_side']]
+                    raw_position['equity'] += event['upnl'] - side['upnl']
+                    side.update({k: event[k] for k in ['size', 'price', 'upnl']})
+        if open_orders is not self.open_orders:
+            self.set_open_orders(sorted(open_orders, key=lambda x: x['price']))
+        if new_fills:
+            ids_set = set([x['id'] for x in self.fills])
+            new_fills = [x for x in new_fills if x['id'] not in ids_set]
+            self.fills = sorted(self.fills + new_fills, key=lambda x: x['order_id'])[-1000:]
+        if raw_position is not None:
+            await self.set_position(raw_position)
+        elif new_fills and self.position:
+            self.long_pfills, self.shrt_pfills = get_position_fills(self.position['long']['size'],
+                                                                    abs(self.position['shrt']['size']),
+                                                                    self.fills)
+        if new_fills and self.position:
+            await self.check_long_fills(new_fills)
+            await self.check_shrt_fills(new_fills)
+
     async def update_fills(self, max_n_fills=1000) -> [dict]:
         '''
         fetches recent fills
@@ -202,33 +344,46 @@ class Bot:
 
 
 
+    async def execute_orders(self, orders: [dict]) -> [dict]:
+        '''
+        exchanges supporting batch orders override this
+        returns one result or exception per order
+        '''
+        return await asyncio.gather(*[self.execute_order(o) for o in orders], return_exceptions=True)
+
+    async def execute_cancellations(self, orders: [dict]) -> [dict]:
+        '''
+        exchanges supporting batch cancellations override this
+        returns one result or exception per order
+        '''
+        return await asyncio.gather(*[self.execute_cancellation(o) for o in orders], return_exceptions=True)
+
     async def create_orders(self, orders_to_create: [dict]) -> dict:
         if not orders_to_create:
             return {}
         if self.ts_locked['create_orders'] > self.ts_released['create_orders']:
             return {}
         self.ts_locked['create_orders'] = time()
-        creations = []
-        for oc in sorted(orders_to_create, key=lambda x: x['qty']):
-            try:
-                creations.append((oc, asyncio.create_task(self.execute_order(oc))))
-            except Exception as e:
-                print_(['error creating order a', oc, e], n=True)
+        orders_to_create = sorted(orders_to_create, key=lambda x: x['qty'])
+        try:
+            results = await self.execute_orders(orders_to_create)
+        except Exception as e:
+            print_(['error creating orders a', e], n=True)
+            results = [e] * len(orders_to_create)
         created_orders = []
-        for oc, c in creations:
-            try:
-                o = await c
-                created_orders.append(o)
-                if 'side' in o:
-                    print_(['  created order', o['symbol'], o['side'], o['position_side'], o['qty'],
-                            o['price']], n=True)
-                else:
-                    print_(['error creating order b', o, oc], n=True)
-                self.dump_log({'log_type': 'create_order', 'data': o})
-            except Exception as e:
-                print_(['error creating order c', oc, c.exception(), e], n=True)
-                self.dump_log({'log_type': 'create_order', 'data': {'result': str(c.exception()),
-                                                                    'error': repr(e), 'data': oc}})
+        for oc, o in zip(orders_to_create, results):
+            if isinstance(o, Exception):
+                print_(['error creating order c', oc, o], n=True)
+                self.dump_log({'log_type': 'create_order', 'data': {'result': str(o), 'error': repr(o), 'data': oc}})
+                continue
+            created_orders.append(o)
+            if 'side' in o:
+                print_(['  created order', o['symbol'], o['side'], o['position_side'], o['qty'],
+                        o['price']], n=True)
+            else:
+                print_(['error creating order b', o, oc], n=True)
+            self.dump_log({'log_type': 'create_order', 'data': o})
+        self.apply_order_acks(created=created_orders)
         self.ts_released['create_orders'] = time()
         return created_orders
 
@@ -238,28 +393,29 @@ class Bot:
         if self.ts_locked['cancel_orders'] > self.ts_released['cancel_orders']:
             return
         self.ts_locked['cancel_orders'] = time()
-        deletions = []
-        for oc in orders_to_cancel:
-            try:
-                deletions.append((oc,
-                                  asyncio.create_task(self.execute_cancellation(oc))))
-            except Exception as e:
-                print_(['error cancelling order a', oc, e])
+        try:
+            results = await self.execute_cancellations(orders_to_cancel)
+        except Exception as e:
+            print_(['error cancelling orders a', e], n=True)
+            results = [e] * len(orders_to_cancel)
         canceled_orders = []
-        for oc, c in deletions:
-            try:
-                o = await c
-                canceled_orders.append(o)
-                if 'side' in o:
-                    print_(['cancelled order', o['symbol'], o['side'], o['position_side'], o['qty'],
-                            o['price']], n=True)
-                else:
-                    print_(['error cancelling order', o], n=True)
-                self.dump_log({'log_type': 'cancel_order', 'data': o})
-            except Exception as e:
-                print_(['error cancelling order b', oc, c.exception(), e], n=True)
-                self.dump_log({'log_type': 'cancel_order', 'data': {'result': str(c.exception()),
-                                                                    'error': repr(e), 'data': oc}})
+        for oc, o in zip(orders_to_cancel, results):
+            if isinstance(o, Exception):
+                print_(['error cancelling order b', oc, o], n=True)
+                self.dump_log({'log_type': 'cancel_order', 'data': {'result': str(o), 'error': repr(o), 'data': oc}})
+                # order may be filled or gone already
+                self.state_mismatch = True
+                continue
+            canceled_orders.append(o)
+            if 'side' in o:
+                print_(['cancelled order', o['symbol'], o['side'], o['position_side'], o['qty'],
+                        o['price']], n=True)
+            else:
+                print_(['error cancelling order', o], n=True)
+                self.state_mismatch = True
+            self.dump_log({'log_type': 'cancel_order', 'data': o})
+        self.apply_order_acks(cancelled=[{**o, 'order_id': oc['order_id']} for oc, o in zip(orders_to_cancel, results)
+                                         if not isinstance(o, Exception) and 'side' in o])
         self.ts_released['cancel_orders'] = time()
         return canceled_orders
 
@@ -308,70 +464,44 @@ class Bot:
                                      'type': 'market', 'reduce_only': True, 'custom_id': 'shrt_panic'})
             return panic_orders
 
+        qtys, prices, codes, n = calc_orders_grid(balance,
+                                                  long_psize,
+                                                  long_pprice,
+                                                  shrt_psize,
+                                                  shrt_pprice,
+                                                  self.ob[0],
+                                                  self.ob[1],
+                                                  self.price,
+                                                  self.emas,
+                                                  self.last_price_diff_limit,
+                                                  self.n_open_orders_limit,
+                                                  self.stop_mode not in ['freeze'],
+                                                  **self.xk)
         orders = []
-        long_done, shrt_done = False, False
-
-        inf_loop_prevention = 100
-        i = 0
-
-        while True:
-            i += 1
-            if i >= inf_loop_prevention:
-                raise Exception('warning -- infinite loop in calc_orders')
-            long_entry, shrt_entry, long_close, shrt_close, bkr_price, available_margin = calc_orders(
-                balance,
-                long_psize,
-                long_pprice,
-                shrt_psize,
-                shrt_pprice,
-                self.ob[0],
-                self.ob[1],
-                self.price,
-                self.emas,
-                **self.xk)
-            if i == 1 and long_close[0] != 0.0 and \
-                    calc_diff(long_close[1], self.price) < self.last_price_diff_limit:
-                orders.append({'side': 'sell', 'position_side': 'long', 'qty': abs(float(long_close[0])),
-                               'price': float(long_close[1]), 'type': 'limit', 'reduce_only': True,
-                               'custom_id': long_close[2]})
-            if i == 1 and shrt_close[0] != 0.0 and \
-                    calc_diff(shrt_close[1], self.price) < self.last_price_diff_limit:
-                orders.append({'side': 'buy', 'position_side': 'shrt', 'qty': abs(float(shrt_close[0])),
-                               'price': float(shrt_close[1]), 'type': 'limit', 'reduce_only': True,
-                               'custom_id': shrt_close[2]})
-            if not long_done and self.stop_mode not in ['freeze'] and long_entry[0] != 0.0 and \
-                    calc_diff(long_entry[1], self.price) < self.last_price_diff_limit:
-                orders.append({'side': 'buy', 'position_side': 'long', 'qty': float(long_entry[0]),
-                               'price': float(long_entry[1]), 'type': 'limit', 'reduce_only': False,
-                               'custom_id': long_entry[2]})
-                long_psize, long_pprice = calc_new_psize_pprice(long_psize, long_pprice,
-                                                                long_entry[0], long_entry[1], self.qty_step)
-            else:
-                long_done = True
-            if not shrt_done and self.stop_mode not in ['freeze'] and shrt_entry[0] != 0.0 and \
-                    calc_diff(shrt_entry[1], self.price) < self.last_price_diff_limit:
-                orders.append({'side': 'sell', 'position_side': 'shrt', 'qty': abs(float(shrt_entry[0])),
-                               'price': float(shrt_entry[1]), 'type': 'limit', 'reduce_only': False,
-                               'custom_id': shrt_entry[2]})
-                shrt_psize, shrt_pprice = calc_new_psize_pprice(shrt_psize, shrt_pprice,
-                                                                shrt_entry[0], shrt_entry[1], self.qty_step)
-            else:
-                shrt_done = True
-            if len(orders) >= self.n_open_orders_limit or (long_done and shrt_done):
-                break
+        for qty, price, code in zip(qtys[:n], prices[:n], codes[:n]):
+            order_type = ORDER_TYPES[code]
+            position_side = order_type[:4]
+            reduce_only = order_type.endswith('close')
+            orders.append({'side': 'sell' if (position_side == 'long') == reduce_only else 'buy',
+                           'position_side': position_side, 'qty': float(qty), 'price': float(price),
+                           'type': 'limit', 'reduce_only': reduce_only, 'custom_id': order_type})
         return orders
 
-
     async def cancel_and_create(self):
         await asyncio.sleep(0.005)
-        await self.update_position()
+        if self.rest_update_due('update_position'):
+            await self.update_position()
         await asyncio.sleep(0.005)
         if any([self.ts_locked[k_] > self.ts_released[k_]
                 for k_ in [x for x in self.ts_locked if x != 'decide']]):
             return
-        to_cancel, to_create = filter_orders(self.open_orders,
-                                             self.calc_orders(),
-                                             keys=['side', 'position_side', 'qty', 'price'])
+        to_cancel, to_create, n_kept = diff_orders(self.open_orders,
+                                                   self.calc_orders(),
+                                                   self.price_step,
+                                                   self.qty_step,
+                                                   self.order_price_tolerance,
+                                                   self.order_qty_tolerance)
+        self.n_orders_kept_by_tolerance += n_kept
         to_cancel = sorted(to_cancel, key=lambda x: calc_diff(x['price'], self.price))
         to_create = sorted(to_create, key=lambda x: calc_diff(x['price'], self.price))
         results = []
@@ -382,7 +512,8 @@ class Bot:
             if to_create:
                 results.append(await self.create_orders(to_create[:self.n_orders_per_execution]))
         await asyncio.sleep(0.005)
-        await self.update_position()
+        if self.rest_update_due('update_position'):
+            await self.update_position()
         if any(results):
             print()
         return results
@@ -423,6 +554,9 @@ class Bot:
         if self.exchange == 'bybit':
             # bybit not supported
             return
+        if not self.rest_update_due('check_fills'):
+            # fills are pushed by user stream
+            return
         try:
             now = time()
             if now - self.ts_released['check_fills'] < 5.0:
@@ -551,6 +685,11 @@ class Bot:
         line += f"EMAr {[round_dynamic(r, 4) for r in self.ratios]} "
         line += f"bal {compress_float(self.position['wallet_balance'], 3)} "
         line += f"eq {compress_float(self.position['equity'], 3)} "
+        if self.n_orders_kept_by_tolerance:
+            line += f"kept {self.n_orders_kept_by_tolerance} "
+        line += f"wsq {self.ws_queue_depth}/{self.ws_max_queue_depth} lag {int(self.ws_lag * 1000)}ms "
+        if self.ws_n_dropped:
+            line += f"dropped {self.ws_n_dropped} "
         print_([line], r=True)
 
     def flush_stuck_locks(self, timeout: float = 4.0) -> None:
@@ -561,7 +700,91 @@ class Bot:
                     print('flushing', key)
                     self.ts_released[key] = now
 
+    def save_snapshot(self) -> None:
+        '''
+        dumps indicator state, recent fills with their cursor and exchange info, so that a restart needs to backfill only the gap
+        '''
+        self.ts_snapshot_saved = time()
+        if not self.ema_sec:
+            return
+        snapshot = {'timestamp': int(time() * 1000),
+                    'symbol': self.symbol,
+                    'market_type': self.market_type,
+                    'spans': [float(span) for span in self.spans],
+                    'emas': [float(ema) for ema in self.emas],
+                    'ema_sec': int(self.ema_sec),
+                    'price': float(self.price),
+                    'fills': self.fills,
+                    'fills_cursor': max([x['id'] for x in self.fills]) if self.fills else 0,
+                    'exchange_info': denumpyize({k: getattr(self, k) for k in SNAPSHOT_EXCHANGE_INFO_KEYS
+                                                 if hasattr(self, k)})}
+        try:
+            with open(self.snapshot_filepath + '.tmp', 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(self.snapshot_filepath + '.tmp', self.snapshot_filepath)
+        except Exception as e:
+            print('failed to save snapshot', e)
+
+    def load_snapshot(self) -> dict:
+        '''
+        returns snapshot if saved for same symbol and market type less than snapshot_max_age_minutes ago, else None
+        '''
+        if not os.path.exists(self.snapshot_filepath):
+            return None
+        try:
+            snapshot = json.load(open(self.snapshot_filepath))
+        except Exception as e:
+            print('failed to load snapshot', e)
+            return None
+        if snapshot['symbol'] != self.symbol or snapshot['market_type'] != self.market_type:
+            return None
+        if time() * 1000 - snapshot['timestamp'] > self.snapshot_max_age_minutes * 60 * 1000:
+            return None
+        return snapshot
+
+    def apply_exchange_info(self, exchange_info: dict) -> None:
+        for k in exchange_info:
+            setattr(self, k, exchange_info[k])
+            if k in SNAPSHOT_EXCHANGE_INFO_CONFIG_KEYS:
+                self.config[k] = exchange_info[k]
+
+    async def init_indicators_from_snapshot(self) -> bool:
+        '''
+        restores emas from snapshot and advances them over the gap with 1m ohlcvs followed by latest ticks
+        returns False if there is no usable snapshot
+        '''
+        snapshot = self.load_snapshot()
+        if snapshot is None or snapshot['spans'] != [float(span) for span in self.spans]:
+            return False
+        if time() * 1000 - snapshot['ema_sec'] > self.snapshot_max_age_minutes * 60 * 1000:
+            return False
+        ticks = await self.fetch_ticks(do_print=False)
+        if not ticks:
+            return False
+        ema_sec = snapshot['ema_sec']
+        rows = []
+        if ticks[0]['timestamp'] > ema_sec + 1000:
+            if self.exchange == 'binance':
+                ohlcvs_per_fetch = 1000 if self.spot else 1500
+            else:
+                ohlcvs_per_fetch = 200
+            millis_per_fetch = 1000 * 60 * ohlcvs_per_fetch
+            ohlcvs = flatten(await asyncio.gather(*[self.fetch_ohlcvs(start_time=ts)
+                                                    for ts in range(ema_sec, ticks[0]['timestamp'], millis_per_fetch)]))
+            rows += [[e['timestamp'], e['volume'], e['open']] for e in ohlcvs
+                     if ema_sec + 1000 <= e['timestamp'] < ticks[0]['timestamp']]
+        rows += [[e['timestamp'], e['qty'], e['price']] for e in ticks if e['timestamp'] >= ema_sec + 1000]
+        self.emas, ema_sec, self.price, self.agg_qty, self.qty = update_emas_ticks(
+            np.array(snapshot['emas']), self.ema_alpha_secs, self.ema_alpha_secs_, float(ema_sec),
+            float(snapshot['price']), 0.0, 0.0, np.array(sorted(rows), dtype=np.float64).reshape(-1, 3))
+        self.ema_sec = int(ema_sec)
+        self.ratios = np.append(self.price, self.emas[:-1]) / self.emas
+        print(f"indicators restored from snapshot, backfilled {(self.ema_sec - snapshot['ema_sec']) / 1000:.0f} seconds")
+        return True
+
     async def init_indicators(self, max_n_samples: int = 60):
+        if await self.init_indicators_from_snapshot():
+            return
         ticks = await self.fetch_ticks(do_print=False)
         if self.exchange == 'binance':
             ohlcvs_per_fetch = 1000 if self.spot else 1500
@@ -592,29 +815,33 @@ class Bot:
         self.ratios = np.append(self.price, self.emas[:-1]) / self.emas
         self.ema_sec = int(combined[-1][0] // 1000 * 1000)
 
+    def update_book_ticker(self, data: dict) -> bool:
+        '''
+        exchanges subscribed to a book ticker stream set ob_from_book_ticker and update self.ob from its messages
+        returns True if data was a book ticker message
+        '''
+        return False
+
     def update_indicators(self, ticks):
-        for tick in ticks:
-            self.agg_qty += tick['qty']
-            if tick['is_buyer_maker']:
-                self.ob[0] = tick['price']
-            else:
-                self.ob[1] = tick['price']
-            ts_sec = int(tick['timestamp'] // 1000 * 1000)
-            if ts_sec <= self.ema_sec:
-                self.ema_sec = ts_sec
-                self.price = tick['price']
-                continue
-            self.qty = self.agg_qty
-            self.agg_qty = 0.0
-            while self.ema_sec < ts_sec - 1000:
-                self.emas = self.emas * self.ema_alpha_secs_ + tick['price'] * self.ema_alpha_secs
-                self.ema_sec += 1000
-            self.emas = self.emas * self.ema_alpha_secs_ + self.price * self.ema_alpha_secs
-            self.ema_sec += 1000
-            self.price = tick['price']
-            self.ratios = np.append(self.price, self.emas[:-1]) / self.emas
-
-    async def start_websocket(self) -> None:
+        if not ticks:
+            return
+        if not self.ob_from_book_ticker:
+            for tick in ticks:
+                if tick['is_buyer_maker']:
+                    self.ob[0] = tick['price']
+                else:
+                    self.ob[1] = tick['price']
+        self.emas, ema_sec, self.price, self.agg_qty, self.qty = update_emas_ticks(
+            self.emas, self.ema_alpha_secs, self.ema_alpha_secs_, float(self.ema_sec), float(self.price),
+            float(self.agg_qty), float(self.qty), np.array([[t['timestamp'], t['qty'], t['price']] for t in ticks],
+                                                           dtype=np.float64).reshape(-1, 3))
+        self.ema_sec = int(ema_sec)
+        self.ratios = np.append(self.price, self.emas[:-1]) / self.emas
+
+    async def start_websocket(self, source: asyncio.Task = None) -> None:
+        '''
+        source: task feeding self.ws_queue from a websocket shared with other bots; bot connects its own if None
+        '''
         self.stop_websocket = False
         self.process_websocket_ticks = True
         print_([self.endpoints['websocket']])
@@ -624,36 +851,109 @@ class Bot:
             return
         await self.init_indicators()
         await self.init_order_book()
-        k = 1
+        # a user stream shared with other bots is run by their runner
+        user_stream = None if self.shared_user_stream else asyncio.create_task(self.start_user_stream())
+        try:
+            if source is None:
+                await self.consume_websocket()
+            else:
+                self.ws_queue = asyncio.Queue(maxsize=self.ws_queue_size)
+                await self.consume_ws_queue(source)
+        finally:
+            if source is not None:
+                self.ws_queue = None
+            if user_stream is not None:
+                user_stream.cancel()
+                self.user_stream_connected = False
+            self.save_snapshot()
+
+    async def consume_websocket(self) -> None:
+        self.ws_queue = asyncio.Queue(maxsize=self.ws_queue_size)
         async with websockets.connect(self.endpoints['websocket']) as ws:
             await self.subscribe_ws(ws)
-            async for msg in ws:
-                if msg is None:
+            reader = asyncio.create_task(self.read_websocket(ws))
+            try:
+                await self.consume_ws_queue(reader)
+            finally:
+                reader.cancel()
+
+    async def read_websocket(self, ws) -> None:
+        '''
+        enqueues raw messages with their receive time; when the queue is full, stops reading until it is drained
+        '''
+        async for msg in ws:
+            if msg is None:
+                continue
+            await self.ws_queue.put((time(), msg))
+
+    def enqueue_ws_message(self, msg) -> None:
+        '''
+        non blocking, for sources shared with other bots
+        when queue is full the oldest message is dropped, so a slow bot loses only its own stale messages
+        '''
+        if self.ws_queue is None:
+            return
+        if self.ws_queue.full():
+            self.ws_queue.get_nowait()
+            self.ws_n_dropped += 1
+        self.ws_queue.put_nowait((time(), msg))
+
+    async def consume_ws_queue(self, source: asyncio.Task) -> None:
+        '''
+        drains all pending messages per batch until source task finishes or bot is stopped
+        '''
+        k = 1
+        while True:
+            if self.ws_queue.empty() and source.done():
+                source.result()
+                return
+            try:
+                batch = [await asyncio.wait_for(self.ws_queue.get(), timeout=1.0)]
+            except asyncio.TimeoutError:
+                batch = []
+            while not self.ws_queue.empty():
+                batch.append(self.ws_queue.get_nowait())
+            if batch:
+                self.process_ws_batch(batch)
+            if k % 10 == 0:
+                self.flush_stuck_locks()
+                k = 1
+            if time() - self.ts_snapshot_saved > self.snapshot_interval:
+                self.save_snapshot()
+            if self.stop_websocket:
+                if self.telegram is not None:
+                    self.telegram.send_msg("<pre>Bot stopped</pre>")
+                return
+            k += 1
+
+    def process_ws_batch(self, batch: [(float, str)]) -> None:
+        '''
+        updates indicators once with all ticks in batch and triggers at most one decision
+        '''
+        self.ws_batch_size = len(batch)
+        self.ws_queue_depth = len(batch) + self.ws_queue.qsize()
+        self.ws_max_queue_depth = max(self.ws_max_queue_depth, self.ws_queue_depth)
+        self.ws_lag = time() - batch[0][0]
+        ticks = []
+        for _, msg in batch:
+            try:
+                data = json.loads(msg) if isinstance(msg, str) else msg
+                if self.ob_from_book_ticker and self.update_book_ticker(data):
                     continue
-                try:
-                    ticks = self.standardize_websocket_ticks(json.loads(msg))
-                    if self.process_websocket_ticks:
-                        if ticks:
-                            self.update_indicators(ticks)
-                        if self.ts_locked['decide'] < self.ts_released['decide']:
-                            asyncio.create_task(self.decide())
-                    if k % 10 == 0:
-                        self.flush_stuck_locks()
-                        k = 1
-                    if self.stop_websocket:
-                        if self.telegram is not None:
-                            self.telegram.send_msg("<pre>Bot stopped</pre>")
-                        break
-                    k += 1
-
-                except Exception as e:
-                    if 'success' not in msg:
-                        print('error in websocket', e, msg)
-
-async def start_bot(bot):
+                ticks += self.standardize_websocket_ticks(data)
+            except Exception as e:
+                if 'success' not in str(msg):
+                    print('error in websocket', e, msg)
+        if self.process_websocket_ticks:
+            if ticks:
+                self.update_indicators(ticks)
+            if self.ts_locked['decide'] < self.ts_released['decide']:
+                asyncio.create_task(self.decide())
+
+async def start_bot(bot, source: asyncio.Task = None):
     while not bot.stop_websocket:
         try:
-            await bot.start_websocket()
+            await bot.start_websocket(source)
         except Exception as e:
             print('Websocket connection has been lost, attempting to reinitialize the bot...', e)
             traceback.print_exc()
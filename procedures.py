@@ -2,13 +2,13 @@ import json
 import pprint
 import os
 import hjson
-import pandas as pd
 import numpy as np
 import glob
 from time import time
 from pure_funcs import numpyize, denumpyize, candidate_to_live_config, ts_to_date, get_dummy_settings, calc_spans, \
     config_pretty_str, date_to_ts
-from njit_funcs import calc_samples
+from njit_funcs import calc_samples, fill_samples
+from trade_store import load_range, migrate_csv_chunks, ChunkManifest
 
 
 def load_live_config(live_config_path: str) -> dict:
@@ -183,16 +183,16 @@ async def fetch_market_specific_settings(config: dict):
     return settings_from_exchange
 
 
-async def create_binance_bot(config: dict):
+async def create_binance_bot(config: dict, session=None):
     from binance import BinanceBot
-    bot = BinanceBot(config)
+    bot = BinanceBot(config, session)
     await bot._init()
     return bot
 
 
-async def create_binance_bot_spot(config: dict):
+async def create_binance_bot_spot(config: dict, session=None):
     from binance_spot import BinanceBotSpot
-    bot = BinanceBotSpot(config)
+    bot = BinanceBotSpot(config, session)
     await bot._init()
     return bot
 
@@ -251,24 +251,45 @@ def make_tick_samples(config: dict, sec_span: int = 1):
     ticks_filepath = os.path.join('historical_data', config['exchange'], f"agg_trades_{'spot' if config['spot'] else 'futures'}", config['symbol'], '')
     if not os.path.exists(ticks_filepath):
         return
-    ticks_filenames = sorted([f for f in os.listdir(ticks_filepath) if f.endswith('.csv')])
-    ticks = np.empty((0, 3))
+    migrate_csv_chunks(ticks_filepath)
     sts = time()
-    for f in ticks_filenames:
-        _, _, first_ts, last_ts = map(int, f.replace('.csv', '').split('_'))
-        if first_ts > end_ts or last_ts < start_ts:
-            continue
-        print(f'\rloading chunk {ts_to_date(first_ts / 1000)}', end='  ')
-        tdf = pd.read_csv(ticks_filepath + f)
-        tdf = tdf[(tdf.timestamp >= start_ts) & (tdf.timestamp <= end_ts)]
-        ticks = np.concatenate((ticks, tdf[['timestamp', 'qty', 'price']].values))
-        del tdf
-    samples = calc_samples(ticks[ticks[:, 0].argsort()], sec_span * 1000)
+    loaded = load_range(ticks_filepath, ChunkManifest(ticks_filepath), start_ts, end_ts, ['timestamp', 'qty', 'price'])
+    ticks = np.stack([loaded['timestamp'], loaded['qty'], loaded['price']], axis=1).astype(np.float64, copy=False)
+    del loaded
+    if not (ticks[1:, 0] >= ticks[:-1, 0]).all():
+        ticks = ticks[ticks[:, 0].argsort(kind='stable')]
+    samples = calc_samples(ticks, sec_span * 1000)
     print(f'took {time() - sts:.2f} seconds to load {len(ticks)} ticks, creating {len(samples)} samples')
     del ticks
     return samples
 
 
+class StreamingSampler:
+    '''
+    samples batches of ticks sorted by timestamp straight into a preallocated array, e.g. a memmapped .npy file,
+    carrying last sample index and price across batches
+    samples must be zeroed and have room for every sample from first_ts through last tick
+    price: price carried into samples before first tick
+    '''
+
+    def __init__(self, samples: np.ndarray, first_ts: float, sample_size_ms: int = 1000, price: float = 0.0):
+        self.samples = samples.view(np.ndarray)
+        self.sample_size_ms = sample_size_ms
+        self.start_ts = first_ts // sample_size_ms * sample_size_ms
+        block_size = 1000000
+        for i in range(0, len(self.samples), block_size):
+            n = min(block_size, len(self.samples) - i)
+            self.samples[i:i + n, 0] = self.start_ts + np.arange(i, i + n) * sample_size_ms
+        self.samples[0, 2] = price
+        self.k = 0
+        self.price = price
+
+    def update(self, ticks: np.ndarray):
+        if len(ticks) > 0:
+            self.k, self.price = fill_samples(ticks, self.samples, self.start_ts, self.sample_size_ms,
+                                              self.k, self.price)
+
+
 def get_starting_configs(config) -> [dict]:
     starting_configs = []
     if config['starting_configs'] is not None:
@@ -5,8 +5,9 @@ from plotting import plot_fills
 from downloader import Downloader, prep_config
 from pure_funcs import denumpyize, numpyize, get_template_live_config, candidate_to_live_config, calc_spans, \
     get_template_live_config, unpack_config, pack_config, analyze_fills, ts_to_date, denanify, round_dynamic, \
-    tuplify
+    tuplify, get_pareto_objectives, calc_crowding_distances
 from procedures import dump_live_config, load_live_config, make_get_filepath, add_argparse_args, get_starting_configs
+from sample_cache import load_samples_view
 from time import time, sleep
 from optimize import get_expanded_ranges, single_sliding_window_run, objective_function
 from bisect import bisect
@@ -35,12 +36,23 @@ def pso_multiprocess(reward_func: Callable,
                      initial_positions: [np.ndarray] = [],
                      n_cpus: int = 3,
                      iters: int = 10000,
-                     post_processing_func: Callable = lambda x: x):
+                     post_processing_func: Callable = lambda x: x,
+                     surrogate=None,
+                     leader_func: Callable = None):
     '''
     if len(initial_positions) <= n_particles: use initial positions as particles, let remainder be random
     else: let n_particles = len(initial_positions)
+    if surrogate is given, candidates it predicts to be clearly worse are moved on without being backtested
+    if leader_func is given, particles are pulled towards its returned position instead of gbest
     '''
 
+    def get_leader() -> np.ndarray:
+        if leader_func is not None:
+            leader = leader_func()
+            if leader is not None:
+                return leader
+        return gbest
+
     def get_new_velocity_and_position(velocity, position, lbest_, gbest_) -> (np.ndarray, np.ndarray):
 
         new_velocity = (
@@ -76,6 +88,8 @@ def pso_multiprocess(reward_func: Callable,
     itr_counter = 0
     worker_cycler = 0
     pos_cycler = 0
+    n_skipped = 0
+    n_consecutive_skips = 0
 
     workers = [None for _ in range(n_cpus)]
     working = set()
@@ -99,20 +113,37 @@ def pso_multiprocess(reward_func: Callable,
                             get_new_velocity_and_position(velocities[pos_cycler],
                                                           positions[pos_cycler],
                                                           lbests[pos_cycler],
-                                                          gbest)
+                                                          get_leader())
                         pos_hash = sha256(str(positions[pos_cycler]).encode('utf-8')).hexdigest()
                     else:
                         print('too many duplicates, choosing random position')
                         positions[pos_cycler] = numpyize([np.random.uniform(bounds[0][i], bounds[1][i])
                                                           for i in range(len(bounds[0]))])
                         #raise Exception('too many duplicate candidates')
-                    tested.add(pos_hash)
-                    workers[worker_cycler] = (pos_cycler, pool.apply_async(reward_func, args=(positions[pos_cycler],)))
-                    working = set([e[0] for e in workers if e is not None])
+                    if surrogate is not None and n_consecutive_skips < len(positions) and \
+                            surrogate.is_clearly_worse(positions[pos_cycler]):
+                        # don't let the surrogate starve the workers; force a backtest after a full round of skips
+                        n_skipped += 1
+                        n_consecutive_skips += 1
+                        print(f'surrogate skipped candidate, {n_skipped} backtests saved so far')
+                        velocities[pos_cycler], positions[pos_cycler] = \
+                            get_new_velocity_and_position(velocities[pos_cycler],
+                                                          positions[pos_cycler],
+                                                          lbests[pos_cycler],
+                                                          get_leader())
+                    else:
+                        n_consecutive_skips = 0
+                        tested.add(pos_hash)
+                        workers[worker_cycler] = (pos_cycler,
+                                                  pool.apply_async(reward_func, args=(positions[pos_cycler],)),
+                                                  positions[pos_cycler].copy())
+                        working = set([e[0] for e in workers if e is not None])
                 pos_cycler = (pos_cycler + 1) % len(positions)
         if workers[worker_cycler] is not None and workers[worker_cycler][1].ready():
             score = post_processing_func(workers[worker_cycler][1].get())
             pos_idx = workers[worker_cycler][0]
+            if surrogate is not None:
+                surrogate.add(workers[worker_cycler][2], score)
             workers[worker_cycler] = None
             working = set([e[0] for e in workers if e is not None])
             itr_counter += 1
@@ -124,15 +155,83 @@ def pso_multiprocess(reward_func: Callable,
                 get_new_velocity_and_position(velocities[pos_cycler],
                                               positions[pos_cycler],
                                               lbests[pos_cycler],
-                                              gbest)
+                                              get_leader())
         worker_cycler = (worker_cycler + 1) % len(workers)
         sleep(0.001)
+    pool.terminate()
+    if surrogate is not None:
+        print(f'surrogate saved {n_skipped} backtests out of {itr_counter + n_skipped} candidates')
     return gbest, gbest_score
 
 
+class Surrogate:
+    '''
+    gaussian process regression model trained on the scores evaluated so far
+    predicts score (lower is better) and uncertainty of new candidates
+    a candidate is clearly worse if even its optimistic estimate, mean - kappa * std,
+    is worse than the given percentile of scores evaluated so far
+    '''
+
+    def __init__(self, bounds: np.ndarray, percentile: float = 75.0, kappa: float = 1.0,
+                 min_samples: int = 50, max_samples: int = 500):
+        self.lower = bounds[0]
+        self.span = np.where(bounds[1] > bounds[0], bounds[1] - bounds[0], 1.0)
+        self.percentile = percentile
+        self.kappa = kappa
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.xs = []
+        self.ys = []
+        self.fitted = False
+
+    def normalize(self, xs: np.ndarray) -> np.ndarray:
+        return (xs - self.lower) / self.span
+
+    def add(self, position: np.ndarray, score: float):
+        if not np.isfinite(score):
+            return
+        self.xs.append(self.normalize(position))
+        self.ys.append(score)
+        self.fitted = False
+
+    def fit(self):
+        # fit on most recent max_samples only, keeping the cholesky decomposition cheap
+        xs = np.array(self.xs[-self.max_samples:])
+        ys = np.array(self.ys[-self.max_samples:])
+        self.y_mean = ys.mean()
+        self.y_std = ys.std() if ys.std() > 0.0 else 1.0
+        sq_dists = ((xs[:, None, :] - xs[None, :, :]) ** 2).sum(axis=2)
+        # median heuristic for rbf length scale
+        self.length_scale_sq = max(1e-6, np.median(sq_dists[np.triu_indices(len(xs), k=1)]))
+        kernel = np.exp(-0.5 * sq_dists / self.length_scale_sq) + np.eye(len(xs)) * 1e-2
+        self.chol = np.linalg.cholesky(kernel)
+        self.alpha = np.linalg.solve(self.chol.T, np.linalg.solve(self.chol, (ys - self.y_mean) / self.y_std))
+        self.fit_xs = xs
+        self.threshold = np.percentile(ys, self.percentile)
+        self.fitted = True
+
+    def predict(self, position: np.ndarray) -> (float, float):
+        if not self.fitted:
+            self.fit()
+        x = self.normalize(position)
+        k = np.exp(-0.5 * ((self.fit_xs - x) ** 2).sum(axis=1) / self.length_scale_sq)
+        mean = k @ self.alpha
+        v = np.linalg.solve(self.chol, k)
+        std = np.sqrt(max(0.0, 1.0 - v @ v))
+        return mean * self.y_std + self.y_mean, std * self.y_std
+
+    def is_clearly_worse(self, position: np.ndarray) -> bool:
+        if len(self.ys) < self.min_samples:
+            return False
+        mean, std = self.predict(position)
+        return mean - self.kappa * std > self.threshold
+
+
 class PostProcessing:
-    def __init__(self):
+    def __init__(self, pareto_archive=None, config_to_xs: Callable = None):
         self.all_backtest_analyses = []
+        self.pareto_archive = pareto_archive
+        self.config_to_xs = config_to_xs
 
     def process(self, result):
         score, analysis, config = result
@@ -165,9 +264,50 @@ class PostProcessing:
             f.write(json.dumps(to_dump) + '\n')
         if score < best_score:
             dump_live_config(to_dump, config['optimize_dirpath'] + 'current_best.json')
+        if self.pareto_archive is not None:
+            if self.pareto_archive.add(get_pareto_objectives(analysis), self.config_to_xs(config), to_dump):
+                print(f'added to pareto front, {len(self.pareto_archive.entries)} non-dominated candidates')
         return score
 
 
+class ParetoArchive:
+    '''
+    keeps the non-dominated candidates over the objectives given by get_pareto_objectives
+    when full, the most crowded candidate is dropped, as in NSGA-II
+    '''
+
+    def __init__(self, max_size: int = 100, dump_path: str = None):
+        self.max_size = max_size
+        self.dump_path = dump_path
+        self.entries = []  # [(objectives, position, to_dump)]
+
+    def add(self, objectives: np.ndarray, position: np.ndarray, to_dump: dict) -> bool:
+        for e in self.entries:
+            if np.all(e[0] >= objectives):
+                return False
+        self.entries = [e for e in self.entries
+                        if not (np.all(objectives >= e[0]) and np.any(objectives > e[0]))]
+        self.entries.append((objectives, position, to_dump))
+        if len(self.entries) > self.max_size:
+            distances = calc_crowding_distances([e[0] for e in self.entries])
+            del self.entries[int(np.argmin(distances))]
+        if self.dump_path is not None:
+            with open(self.dump_path, 'w') as f:
+                for e in self.entries:
+                    f.write(json.dumps(e[2]) + '\n')
+        return True
+
+    def select_leader(self):
+        '''
+        binary tournament on crowding distance, favouring sparse regions of the front
+        '''
+        if not self.entries:
+            return None
+        distances = calc_crowding_distances([e[0] for e in self.entries])
+        i, j = np.random.randint(0, len(self.entries), size=2)
+        return self.entries[i if distances[i] >= distances[j] else j][1]
+
+
 def get_bounds(ranges: dict) -> tuple:     
     return np.array([np.array([float(v[0]) for k, v in ranges.items()]),
                      np.array([float(v[1]) for k, v in ranges.items()])])
@@ -216,6 +356,28 @@ class BacktestWrap:
         return score, analysis, config
 
 
+class MmapBacktestWrap(BacktestWrap):
+    '''
+    BacktestWrap over rows [start_idx, end_idx) of sampled ticks at location, see sample_cache.load_samples_view
+    data is not pickled along with rf; each worker process memory maps the cache once and reuses it
+    '''
+
+    def __init__(self, location: (str, int, int), start_idx: int, end_idx: int, config: dict):
+        self.location = location
+        self.start_idx = start_idx
+        self.end_idx = end_idx
+        super().__init__(load_samples_view(location)[start_idx:end_idx], config)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['data']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data = load_samples_view(self.location)[self.start_idx:self.end_idx]
+
+
 async def main():
     parser = argparse.ArgumentParser(prog='Optimize', description='Optimize passivbot config.')
     parser = add_argparse_args(parser)
@@ -247,12 +409,26 @@ async def main():
             print()
 
             backtest_wrap = BacktestWrap(shdata, config)
-            post_processing = PostProcessing()
+            if 'pareto_mode' in config and config['pareto_mode']:
+                pareto_archive = ParetoArchive(max_size=config['pareto_archive_size'],
+                                               dump_path=config['optimize_dirpath'] + 'pareto_front.txt')
+                post_processing = PostProcessing(pareto_archive, backtest_wrap.config_to_xs)
+                leader_func = pareto_archive.select_leader
+            else:
+                post_processing = PostProcessing()
+                leader_func = None
             if config['starting_configs']:
                 starting_configs = get_starting_configs(config)
                 initial_positions = [backtest_wrap.config_to_xs(cfg) for cfg in starting_configs]
             else:
                 initial_positions = []
+            if 'surrogate_prescreen' in config and config['surrogate_prescreen']:
+                surrogate = Surrogate(backtest_wrap.bounds,
+                                      percentile=config['surrogate_percentile'],
+                                      kappa=config['surrogate_kappa'],
+                                      min_samples=config['surrogate_min_samples'])
+            else:
+                surrogate = None
             pso_multiprocess(backtest_wrap.rf,
                              config['n_particles'],
                              backtest_wrap.bounds,
@@ -262,7 +438,9 @@ async def main():
                              n_cpus=config['num_cpus'],
                              iters=config['iters'],
                              initial_positions=initial_positions,
-                             post_processing_func=post_processing.process)
+                             post_processing_func=post_processing.process,
+                             surrogate=surrogate,
+                             leader_func=leader_func)
         finally:
             del shdata
             shm.close()
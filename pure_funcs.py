@@ -1,4 +1,7 @@
 import datetime
+import hashlib
+import hmac
+from urllib.parse import urlencode
 
 import numpy as np
 import pandas as pd
@@ -232,6 +235,16 @@ def sort_dict_keys(d):
     return {key: sort_dict_keys(d[key]) for key in sorted(d)}
 
 
+def sign_query(params: dict, secret: str) -> str:
+    '''
+    urlencoded query string with hmac sha256 signature of exactly that string appended
+    must be sent as is, without being encoded again
+    '''
+    query = urlencode(params)
+    signature = hmac.new(secret.encode('utf-8'), query.encode('utf-8'), hashlib.sha256).hexdigest()
+    return f'{query}&signature={signature}'
+
+
 def filter_orders(actual_orders: [dict],
                   ideal_orders: [dict],
                   keys: [str] = ('symbol', 'side', 'qty', 'price')) -> ([dict], [dict]):
@@ -255,6 +268,80 @@ def filter_orders(actual_orders: [dict],
     return actual_orders, orders_to_create
 
 
+def diff_orders(actual_orders: [dict],
+                ideal_orders: [dict],
+                price_step: float,
+                qty_step: float,
+                price_tolerance: float = 0.0,
+                qty_tolerance: float = 0.0) -> ([dict], [dict], int):
+    '''
+    orders are keyed by (side, position_side, price tick index, qty step index), exact matches are kept
+    an unmatched actual order within price_tolerance and qty_tolerance (relative) of an unmatched ideal order
+    of same side and position side is also kept; candidates are bucketed by log price, or by price tick if
+    price_tolerance is zero, so diff is linear time
+    returns (orders_to_cancel, orders_to_create, n_kept_by_tolerance)
+    '''
+    if not actual_orders or not ideal_orders:
+        return actual_orders, ideal_orders, 0
+
+    def get_key(o: dict) -> tuple:
+        return o['side'], o['position_side'], int(round(o['price'] / price_step)), int(round(o['qty'] / qty_step))
+
+    unmatched_actual = {}
+    for i, o in enumerate(actual_orders):
+        unmatched_actual.setdefault(get_key(o), []).append(i)
+    kept = set()
+    unmatched_ideal = []
+    for o in ideal_orders:
+        key = get_key(o)
+        if key in unmatched_actual and unmatched_actual[key]:
+            kept.add(unmatched_actual[key].pop())
+        else:
+            unmatched_ideal.append(o)
+
+    n_kept_by_tolerance = 0
+    if unmatched_ideal and (price_tolerance > 0.0 or qty_tolerance > 0.0) and len(kept) < len(actual_orders):
+        if price_tolerance > 0.0:
+            band_width = np.log1p(price_tolerance)
+
+            def get_bucket(price: float) -> int:
+                return int(np.floor(np.log(price) / band_width))
+
+            neighbours = [0, -1, 1]
+        else:
+            # qty tolerance only, prices must match to the tick
+            def get_bucket(price: float) -> int:
+                return int(round(price / price_step))
+
+            neighbours = [0]
+        buckets = {}
+        for i, o in enumerate(actual_orders):
+            if i not in kept and o['price'] > 0.0:
+                buckets.setdefault((o['side'], o['position_side'], get_bucket(o['price'])), []).append(i)
+        still_unmatched = []
+        for o in unmatched_ideal:
+            match = None
+            if o['price'] > 0.0:
+                bucket = get_bucket(o['price'])
+                for b in [bucket + n for n in neighbours]:
+                    for i in buckets.get((o['side'], o['position_side'], b), []):
+                        ao = actual_orders[i]
+                        if i not in kept and \
+                                abs(ao['price'] - o['price']) <= o['price'] * price_tolerance + price_step * 0.5 and \
+                                abs(ao['qty'] - o['qty']) <= o['qty'] * qty_tolerance + qty_step * 0.5:
+                            match = i
+                            break
+                    if match is not None:
+                        break
+            if match is None:
+                still_unmatched.append(o)
+            else:
+                kept.add(match)
+                n_kept_by_tolerance += 1
+        unmatched_ideal = still_unmatched
+    return [o for i, o in enumerate(actual_orders) if i not in kept], unmatched_ideal, n_kept_by_tolerance
+
+
 def get_dummy_settings(config: dict):
     dummy_settings = get_template_live_config(n_spans=3)
     dummy_settings.update({k: 1.0 for k in get_xk_keys() + ['stop_loss_liq_diff', 'ema_span']})
@@ -493,6 +580,72 @@ def analyze_fills(fills: list, bc: dict, first_ts: float, last_ts: float) -> (pd
     return fdf, result
 
 
+def latin_hypercube(n_samples: int, n_dims: int) -> np.ndarray:
+    '''
+    n_samples points in [0, 1)**n_dims, exactly one point in each of n_samples strata along every dimension
+    '''
+    samples = (np.random.random((n_samples, n_dims)) + np.arange(n_samples)[:, None]) / n_samples
+    for j in range(n_dims):
+        samples[:, j] = samples[np.random.permutation(n_samples), j]
+    return samples
+
+
+def calc_rank_correlation(xs: np.ndarray, ys: np.ndarray) -> float:
+    '''
+    spearman rank correlation, ties not averaged
+    '''
+    x_ranks = np.argsort(np.argsort(xs))
+    y_ranks = np.argsort(np.argsort(ys))
+    if x_ranks.std() == 0.0 or y_ranks.std() == 0.0:
+        return 0.0
+    return float(np.corrcoef(x_ranks, y_ranks)[0, 1])
+
+
+def get_pareto_objectives(analysis: dict) -> np.ndarray:
+    '''
+    objectives for multi-objective optimization, all to be maximized
+    [adg, closest_bkr, lowest_eqbal_ratio, sharpe_ratio, -max_hrs_no_fills]
+    '''
+    return np.array([analysis['average_daily_gain'],
+                     analysis['closest_bkr'],
+                     analysis['lowest_eqbal_ratio'],
+                     analysis['sharpe_ratio'],
+                     -analysis['max_hrs_no_fills']])
+
+
+def calc_pareto_front(points: np.ndarray) -> np.ndarray:
+    '''
+    points: [[objective0, objective1, ...]], all objectives maximized
+    returns boolean mask, True for non-dominated points
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    mask = np.ones(len(points), dtype=bool)
+    for i in range(len(points)):
+        if mask[i]:
+            dominated = np.all(points[i] >= points, axis=1) & np.any(points[i] > points, axis=1)
+            mask[dominated] = False
+    return mask
+
+
+def calc_crowding_distances(points: np.ndarray) -> np.ndarray:
+    '''
+    NSGA-II crowding distance of each point to its neighbours on the front
+    boundary points get infinite distance
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    distances = np.zeros(len(points))
+    if len(points) < 3:
+        distances[:] = np.inf
+        return distances
+    for j in range(points.shape[1]):
+        order = np.argsort(points[:, j])
+        distances[order[0]] = distances[order[-1]] = np.inf
+        span = points[order[-1], j] - points[order[0], j]
+        if span > 0.0:
+            distances[order[1:-1]] += (points[order[2:], j] - points[order[:-2], j]) / span
+    return distances
+
+
 def calc_pprice_from_fills(coin_balance, fills, n_fills_limit=100):
     # assumes fills are sorted old to new
     if coin_balance == 0.0 or len(fills) == 0:
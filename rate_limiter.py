@@ -0,0 +1,89 @@
+'''
+token bucket of request weight, shared by everything in the process talking to the same exchange api
+synced with the weight the exchange reports as used, so requests from other processes on the same ip are accounted for
+'''
+import asyncio
+from time import time
+
+_rate_limiters = {}
+
+
+def get_rate_limiter(key: str, weight_limit: int, window_seconds: float = 60.0):
+    if key not in _rate_limiters:
+        _rate_limiters[key] = RateLimiter(weight_limit, window_seconds)
+    return _rate_limiters[key]
+
+
+def get_binance_rate_limiter(base_endpoint: str) -> 'RateLimiter':
+    '''
+    limiter of a binance api host, spot api (api.binance.com) allows 1200 weight per minute, futures apis 2400
+    '''
+    return get_rate_limiter(base_endpoint, 1200 if base_endpoint.startswith('https://api.') else 2400)
+
+
+def get_request_weight(request_weights: dict, url: str) -> int:
+    '''
+    request_weights: {url: weight}, unlisted urls weigh 1
+    '''
+    return request_weights[url] if url in request_weights else 1
+
+
+class RateLimiter:
+    def __init__(self, weight_limit: int, window_seconds: float = 60.0, safety_margin: float = 0.9):
+        self.capacity = weight_limit * safety_margin
+        self.rate = self.capacity / window_seconds
+        self.window_seconds = window_seconds
+        self.tokens = self.capacity
+        self.last_refill = time()
+        self.paused_until = 0.0
+
+    def refill(self):
+        now = time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    async def acquire(self, weight: float = 1.0):
+        while True:
+            now = time()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.refill()
+            if self.tokens >= weight:
+                self.tokens -= weight
+                return
+            await asyncio.sleep((weight - self.tokens) / self.rate)
+
+    def update_used_weight(self, used_weight: float):
+        '''
+        used_weight as reported by exchange for current window
+        only ever lowers tokens: weight of requests still in flight is not yet counted in the report,
+        and reports may arrive out of order
+        '''
+        self.refill()
+        self.tokens = min(self.tokens, self.capacity - used_weight)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time() + seconds)
+        self.tokens = min(self.tokens, 0.0)
+
+    def update_from_response(self, status: int, headers) -> bool:
+        '''
+        binance reports used weight in X-MBX-USED-WEIGHT-1M, and responds 429, or 418 when banned, with Retry-After
+        returns True if request was rate limited
+        '''
+        used_weight = headers.get('X-MBX-USED-WEIGHT-1M')
+        if used_weight is not None:
+            try:
+                self.update_used_weight(float(used_weight))
+            except ValueError:
+                pass
+        if status in (418, 429):
+            try:
+                retry_after = float(headers.get('Retry-After', self.window_seconds))
+            except ValueError:
+                retry_after = self.window_seconds
+            print(f'rate limited, status {status}, pausing requests for {retry_after} seconds')
+            self.pause(retry_after)
+            return True
+        return False
@@ -0,0 +1,128 @@
+import argparse
+import asyncio
+import json
+import os
+from multiprocessing import Pool
+from time import time
+
+import numpy as np
+from prettytable import PrettyTable
+
+from backtest import backtest
+from downloader import Downloader
+from optimize import get_expanded_ranges, objective_function
+from procedures import prep_config, make_get_filepath, load_live_config, add_argparse_args
+from sample_cache import load_samples_view
+from pure_funcs import unpack_config, pack_config, analyze_fills, denumpyize, ts_to_date, spotify_config, \
+    round_dynamic, latin_hypercube, calc_rank_correlation
+
+_data = None
+
+
+def init_worker(location: (str, int, int)):
+    global _data
+    _data = load_samples_view(location)
+
+
+def run_variant(config: dict) -> dict:
+    fills, info = backtest(config, _data)
+    _, analysis = analyze_fills(fills, {**config, **{'lowest_eqbal_ratio': info[1], 'closest_bkr': info[2]}},
+                                _data[0][0], _data[-1][0])
+    metric = config['metric'] if 'metric' in config else 'adjusted_daily_gain'
+    analysis['score'] = objective_function(analysis, config, metric)
+    return analysis
+
+
+def make_variants(config: dict, live_config: dict, n_variants: int, pct: float, latency_pct: float,
+                  fee_pct: float) -> ([dict], [str], np.ndarray):
+    '''
+    latin hypercube of n_variants within +-pct of each optimizable parameter,
+    +-latency_pct of latency_simulation_ms and +-fee_pct of maker_fee
+    returns variants, perturbed keys and relative deviations of shape (n_variants, n_keys)
+    '''
+    ranges = get_expanded_ranges(config)
+    unpacked = unpack_config(live_config)
+    keys = [k for k in ranges if k in unpacked and type(unpacked[k]) != bool and unpacked[k] != 0.0]
+    pcts = [pct] * len(keys) + [latency_pct, fee_pct]
+    deviations = (latin_hypercube(n_variants, len(pcts)) * 2 - 1) * np.array(pcts) / 100
+    variants = []
+    for deviation in deviations:
+        perturbed = unpacked.copy()
+        for k, d in zip(keys, deviation):
+            perturbed[k] = min(max(unpacked[k] * (1 + d), ranges[k][0]), ranges[k][1])
+            if type(unpacked[k]) == int:
+                perturbed[k] = int(round(perturbed[k]))
+        variant = {**config, **pack_config(perturbed)}
+        variant['latency_simulation_ms'] = max(0.0, config['latency_simulation_ms'] * (1 + deviation[-2]))
+        variant['maker_fee'] = config['maker_fee'] * (1 + deviation[-1])
+        variants.append(variant)
+    return variants, keys + ['latency_simulation_ms', 'maker_fee'], deviations
+
+
+async def main():
+    parser = argparse.ArgumentParser(prog='Robustness',
+                                     description='Backtest random perturbations of given passivbot config.')
+    parser.add_argument('live_config_path', type=str, help='path to live config to test')
+    parser = add_argparse_args(parser)
+    parser.add_argument('-n', '--n_variants', type=int, required=False, dest='n_variants', default=200,
+                        help='number of perturbed configs to backtest')
+    parser.add_argument('--pct', type=float, required=False, dest='pct', default=10.0,
+                        help='perturb each parameter within +-pct percent')
+    parser.add_argument('--latency_pct', type=float, required=False, dest='latency_pct', default=50.0,
+                        help='perturb latency_simulation_ms within +-latency_pct percent')
+    parser.add_argument('--fee_pct', type=float, required=False, dest='fee_pct', default=50.0,
+                        help='perturb maker_fee within +-fee_pct percent')
+    args = parser.parse_args()
+
+    for config in await prep_config(args):
+        live_config = load_live_config(args.live_config_path)
+        if 'spot' in config['market_type']:
+            live_config = spotify_config(live_config)
+        config.update(live_config)
+        dl = Downloader(config)
+        location = await dl.get_sampled_ticks_location()
+        data = load_samples_view(location)
+        config['n_days'] = (data[-1][0] - data[0][0]) / (1000 * 60 * 60 * 24)
+        dirpath = make_get_filepath(os.path.join(config['plots_dirpath'], 'robustness',
+                                                 ts_to_date(time())[:19].replace(':', ''), ''))
+
+        variants, keys, deviations = make_variants(config, live_config, args.n_variants, args.pct,
+                                                   args.latency_pct, args.fee_pct)
+        print(f'backtesting original config and {len(variants)} variants on {config["num_cpus"]} cpus...')
+        sts = time()
+        analyses = []
+        with Pool(processes=config['num_cpus'], initializer=init_worker, initargs=(location,)) as pool:
+            for i, analysis in enumerate(pool.imap(run_variant, [config] + variants)):
+                analyses.append(analysis)
+                if i % 10 == 0:
+                    print(f'\r{i + 1}/{len(variants) + 1}', end=' ')
+        print(f'\n{time() - sts:.2f} seconds elapsed')
+
+        original, analyses = analyses[0], analyses[1:]
+        with open(dirpath + 'robustness_results.txt', 'w') as f:
+            for analysis, variant in zip(analyses, variants):
+                f.write(json.dumps(denumpyize({**analysis, **pack_config(variant)})) + '\n')
+
+        table = PrettyTable()
+        metrics = ['score', 'average_daily_gain', 'closest_bkr', 'lowest_eqbal_ratio', 'max_hrs_no_fills']
+        table.field_names = ['percentile'] + metrics
+        table.add_row(['original'] + [round_dynamic(original[m], 6) for m in metrics])
+        for percentile in [0, 5, 25, 50, 75, 95, 100]:
+            table.add_row([percentile] + [round_dynamic(np.percentile([a[m] for a in analyses], percentile), 6)
+                                          for m in metrics])
+        print(table.get_string(border=True, padding_width=1))
+
+        scores = np.array([a['score'] for a in analyses])
+        sensitivities = sorted([(calc_rank_correlation(deviations[:, j], scores), k) for j, k in enumerate(keys)],
+                               key=lambda x: abs(x[0]), reverse=True)
+        table = PrettyTable()
+        table.field_names = ['parameter', 'rank corr with score']
+        for corr, k in sensitivities[:15]:
+            table.add_row([k, round_dynamic(corr, 3)])
+        print('most sensitive parameters')
+        print(table.get_string(border=True, padding_width=1))
+        print('results dumped to', dirpath)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,197 @@
+'''
+append only cache of sampled ticks [[timestamp, qty, price]], segmented by utc day
+samples live in one raw float64 file starting at origin_ts, row index being (timestamp - origin_ts) // sample_size_ms,
+so any date range is a zero-copy slice of one memmap
+meta.json records per day the checksums of the trade chunks it was sampled from and whether the day was complete;
+days whose source chunks changed, and the trailing incomplete day, are sampled again
+'''
+import json
+import os
+
+import numpy as np
+
+from procedures import StreamingSampler
+from trade_store import load_chunk_columns, load_range
+
+DAY_MS = 1000 * 60 * 60 * 24
+
+_memmaps = {}
+
+
+def load_samples_view(location: (str, int, int)) -> np.ndarray:
+    '''
+    location: (samples filepath, start_idx, end_idx)
+    read only zero-copy view, file is memory mapped once per process and mapped again, replacing old map, when it grew
+    '''
+    filepath, start_idx, end_idx = location
+    size = os.path.getsize(filepath)
+    if filepath not in _memmaps or _memmaps[filepath][0] != size:
+        _memmaps[filepath] = (size, np.memmap(filepath, dtype=np.float64, mode='r').reshape(-1, 3))
+    return _memmaps[filepath][1][start_idx:end_idx].view(np.ndarray)
+
+
+class SampleCache:
+    def __init__(self, dirpath: str, sample_size_ms: int = 1000):
+        self.sample_size_ms = sample_size_ms
+        self.rows_per_day = DAY_MS // sample_size_ms
+        self.dirpath = os.path.join(dirpath, f'samples_{sample_size_ms}ms', '')
+        os.makedirs(self.dirpath, exist_ok=True)
+        self.filepath = os.path.join(self.dirpath, 'samples.f64')
+        self.meta_filepath = os.path.join(self.dirpath, 'meta.json')
+        self.meta = {'sample_size_ms': sample_size_ms, 'origin_ts': None, 'first_tick_ts': None,
+                     'last_tick_ts': None, 'days': []}
+        if os.path.exists(self.meta_filepath) and os.path.exists(self.filepath):
+            try:
+                meta = json.load(open(self.meta_filepath))
+                if meta['sample_size_ms'] == sample_size_ms:
+                    self.meta = meta
+            except Exception as e:
+                print('failed to load sample cache meta, rebuilding', e)
+        self.truncate(len(self.meta['days']))
+
+    def save_meta(self):
+        with open(self.meta_filepath + '.tmp', 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(self.meta_filepath + '.tmp', self.meta_filepath)
+
+    def truncate(self, n_days: int):
+        self.meta['days'] = self.meta['days'][:n_days]
+        with open(self.filepath, 'ab') as f:
+            f.truncate(n_days * self.rows_per_day * 3 * 8)
+        if n_days == 0:
+            self.meta['origin_ts'] = None
+            self.meta['first_tick_ts'] = None
+        self.save_meta()
+
+    def covers(self, start_ts: int, end_ts: int) -> bool:
+        if not self.meta['days']:
+            return False
+        n_complete = next((i for i, d in enumerate(self.meta['days']) if not d['complete']), len(self.meta['days']))
+        complete_until = self.meta['origin_ts'] + n_complete * DAY_MS
+        return start_ts >= self.meta['origin_ts'] and end_ts < complete_until
+
+    def get_location(self, start_ts: int, end_ts: int = -1) -> (str, int, int):
+        '''
+        rows from first sample at or after start_ts through last sample at or before end_ts, -1 meaning last sampled
+        '''
+        start_ts = max(start_ts, self.meta['first_tick_ts'])
+        end_ts = self.meta['last_tick_ts'] if end_ts == -1 else min(end_ts, self.meta['last_tick_ts'])
+        start_idx = int((start_ts - self.meta['origin_ts']) // self.sample_size_ms)
+        end_idx = int((end_ts - self.meta['origin_ts']) // self.sample_size_ms) + 1
+        return self.filepath, start_idx, max(start_idx, end_idx)
+
+    def get_day_checksums(self, manifest, day_ts: int) -> [str]:
+        return [manifest.entries[name]['checksum'] for name in manifest.get_range(day_ts, day_ts + DAY_MS - 1)]
+
+    def get_price_before(self, manifest, trades_dirpath: str, ts: int) -> float:
+        names = manifest.get_range(ts - 1, ts - 1)
+        names = names if names else [name for name in manifest.names if manifest.entries[name]['last_ts'] < ts][-1:]
+        for name in names[::-1]:
+            columns = load_chunk_columns(os.path.join(trades_dirpath, name), ['timestamp', 'price'], mmap_mode='r')
+            mask = columns['timestamp'] < ts
+            if mask.any():
+                return float(columns['price'][mask][-1])
+        return 0.0
+
+    def prepend_days(self, n_days: int):
+        '''
+        moves existing samples n_days later, making room for earlier days, which are marked as stale
+        all days are marked stale on disk until shifted file and new origin_ts are both saved, and prepended days stay
+        stale until sampled, so an interrupted run never serves moved rows as valid samples
+        '''
+        days = self.meta['days']
+        self.meta['days'] = [{**day, 'complete': False} for day in days]
+        self.save_meta()
+        tmp_filepath = self.filepath + '.tmp'
+        with open(tmp_filepath, 'wb') as f:
+            f.truncate(n_days * self.rows_per_day * 3 * 8)
+            f.seek(n_days * self.rows_per_day * 3 * 8)
+            with open(self.filepath, 'rb') as old:
+                while block := old.read(1024 * 1024 * 64):
+                    f.write(block)
+        os.replace(tmp_filepath, self.filepath)
+        self.meta['origin_ts'] -= n_days * DAY_MS
+        self.meta['days'] = [{'checksums': None, 'complete': False} for _ in range(n_days)] + days
+        self.save_meta()
+
+    def sample_days(self, samples: np.ndarray, manifest, trades_dirpath: str, first_day: int, last_day: int):
+        '''
+        samples days [first_day, last_day) in place, then carries last price into leading empty rows of next day
+        '''
+        rows = samples[first_day * self.rows_per_day:last_day * self.rows_per_day]
+        rows[:] = 0.0
+        from_ts = self.meta['origin_ts'] + first_day * DAY_MS
+        to_ts = self.meta['origin_ts'] + last_day * DAY_MS
+        if first_day > 0:
+            price = float(samples[first_day * self.rows_per_day - 1][2])
+        else:
+            price = self.get_price_before(manifest, trades_dirpath, from_ts)
+            self.meta['first_tick_ts'] = None
+        sampler = StreamingSampler(rows, from_ts, self.sample_size_ms, price)
+        for day_ts in range(from_ts, to_ts, DAY_MS):
+            loaded = load_range(trades_dirpath, manifest, day_ts, day_ts + DAY_MS - 1, ['timestamp', 'qty', 'price'])
+            ticks = np.stack([loaded['timestamp'], loaded['qty'], loaded['price']], axis=1).astype(np.float64,
+                                                                                                     copy=False)
+            del loaded
+            if not (ticks[1:, 0] >= ticks[:-1, 0]).all():
+                ticks = ticks[ticks[:, 0].argsort(kind='stable')]
+            if self.meta['first_tick_ts'] is None and len(ticks) > 0:
+                self.meta['first_tick_ts'] = int(ticks[0][0])
+            sampler.update(ticks)
+            del ticks
+        # forward fill after last tick
+        sampler.samples[sampler.k + 1:, 2] = sampler.price
+        following = samples[last_day * self.rows_per_day:].view(np.ndarray)
+        if len(following) > 0:
+            has_qty = following[:, 1] > 0.0
+            n_leading = int(np.argmax(has_qty)) if has_qty.any() else len(following)
+            following[:n_leading, 2] = sampler.price
+
+    def update(self, manifest, trades_dirpath: str, start_ts: int, end_ts: int = -1):
+        '''
+        samples any days through end_ts not yet cached, days whose source chunks changed and the trailing incomplete day
+        '''
+        if not manifest.names:
+            return
+        avail_first_ts = manifest.entries[manifest.names[0]]['first_ts']
+        avail_last_ts = manifest.entries[manifest.names[-1]]['last_ts']
+        start_ts = max(start_ts, avail_first_ts)
+        end_ts = avail_last_ts if end_ts == -1 else min(end_ts, avail_last_ts)
+        first_day_ts = start_ts // DAY_MS * DAY_MS
+        last_day_ts = end_ts // DAY_MS * DAY_MS
+
+        if self.meta['origin_ts'] is None:
+            self.meta['origin_ts'] = first_day_ts
+        elif first_day_ts < self.meta['origin_ts']:
+            self.prepend_days(int((self.meta['origin_ts'] - first_day_ts) // DAY_MS))
+        n_days = max(len(self.meta['days']), int((last_day_ts - self.meta['origin_ts']) // DAY_MS) + 1)
+        checksums = [self.get_day_checksums(manifest, self.meta['origin_ts'] + i * DAY_MS) for i in range(n_days)]
+        stale = [i >= len(self.meta['days']) or not self.meta['days'][i]['complete'] or
+                 self.meta['days'][i]['checksums'] != checksums[i]
+                 for i in range(n_days)]
+        if not any(stale):
+            return
+        print(f'sampling {sum(stale)} days of ticks into {self.filepath}')
+        with open(self.filepath, 'ab') as f:
+            f.truncate(n_days * self.rows_per_day * 3 * 8)
+        samples = np.memmap(self.filepath, dtype=np.float64, mode='r+').reshape(-1, 3)
+        i = 0
+        while i < n_days:
+            if stale[i]:
+                j = i
+                while j < n_days and stale[j]:
+                    j += 1
+                self.sample_days(samples.view(np.ndarray), manifest, trades_dirpath, i, j)
+                i = j
+            else:
+                i += 1
+        samples.flush()
+        del samples
+
+        self.meta['days'] = [{'checksums': checksums[i],
+                              'complete': self.meta['origin_ts'] + (i + 1) * DAY_MS - 1 <= avail_last_ts}
+                             for i in range(n_days)]
+        self.meta['last_tick_ts'] = int(min(avail_last_ts, self.meta['origin_ts'] + n_days * DAY_MS - 1))
+        if self.meta['first_tick_ts'] is None:
+            self.meta['first_tick_ts'] = int(max(avail_first_ts, self.meta['origin_ts']))
+        self.save_meta()
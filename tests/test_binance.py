@@ -0,0 +1,82 @@
+import asyncio
+import hashlib
+import hmac
+import json
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('pandas')
+pytest.importorskip('numba')
+yarl = pytest.importorskip('yarl')
+
+from pure_funcs import sign_query
+
+
+class CaptureSession:
+    def __init__(self):
+        self.urls = []
+
+    def post(self, url, headers=None, **kwargs):
+        assert not kwargs, 'params must not be passed separately from the signed query'
+        self.urls.append(url)
+        return CaptureResponse()
+
+
+class CaptureResponse:
+    status = 200
+    headers = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    async def text(self):
+        return '[]'
+
+
+class DummyRateLimiter:
+    async def acquire(self, weight=1.0):
+        pass
+
+    def update_from_response(self, status, headers):
+        return False
+
+
+def assert_signed(query: str, secret: str):
+    unsigned, signature = query.rsplit('&signature=', 1)
+    assert signature == hmac.new(secret.encode(), unsigned.encode(), hashlib.sha256).hexdigest()
+
+
+def test_sign_query_signs_exact_query():
+    params = {'batchOrders': json.dumps([{'symbol': 'BTCUSDT', 'price': '40000.1', 'quantity': '0.001'}],
+                                        separators=(',', ':')),
+              'recvWindow': 5000,
+              'timestamp': 1620000000000}
+    query = sign_query(params, 'secret')
+    assert_signed(query, 'secret')
+    url = yarl.URL('https://fapi.binance.com/fapi/v1/batchOrders?' + query, encoded=True)
+    assert url.raw_query_string == query
+
+
+def test_private_sends_signed_query_unchanged():
+    pytest.importorskip('aiohttp')
+    pytest.importorskip('websockets')
+    pytest.importorskip('telegram')
+    from binance import BinanceBot
+    session = CaptureSession()
+    bot = SimpleNamespace(session=session, secret='secret', key='key',
+                          get_rate_limiter=lambda base_endpoint: DummyRateLimiter(),
+                          get_request_weight=lambda url: 5)
+    batch = json.dumps([{'symbol': 'BTCUSDT', 'side': 'BUY', 'positionSide': 'LONG', 'type': 'LIMIT',
+                         'quantity': '0.001', 'timeInForce': 'GTX', 'price': '40000.1'}], separators=(',', ':'))
+    asyncio.run(BinanceBot.private_(bot, 'post', 'https://fapi.binance.com', '/fapi/v1/batchOrders',
+                                    {'batchOrders': batch}))
+    url = session.urls[0]
+    sent_query = url.raw_query_string
+    assert str(url) == 'https://fapi.binance.com/fapi/v1/batchOrders?' + sent_query
+    assert_signed(sent_query, 'secret')
+    assert yarl.URL('?' + sent_query).query['batchOrders'] == batch
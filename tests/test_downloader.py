@@ -0,0 +1,189 @@
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.error import HTTPError
+from zipfile import ZipFile
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('pandas')
+pytest.importorskip('numba')
+pytest.importorskip('prettytable')
+pytest.importorskip('aiohttp')
+
+from downloader import Downloader
+
+
+def make_zip(name: str, rows: [str]) -> bytes:
+    buf = BytesIO()
+    with ZipFile(buf, 'w') as z:
+        z.writestr(name, '\n'.join(rows) + '\n')
+    return buf.getvalue()
+
+
+class FixtureServer:
+    '''
+    serves /<name> from files, optionally failing the first n requests per path with 503 or by stalling
+    '''
+    def __init__(self, files: dict, delays: dict = {}, n_failures: dict = {}, n_stalls: dict = {}):
+        self.files = files
+        self.delays = delays
+        self.n_failures = dict(n_failures)
+        self.n_stalls = dict(n_stalls)
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                path = self.path.lstrip('/')
+                with fixture.lock:
+                    fixture.requests.append(path)
+                    fixture.active += 1
+                    fixture.max_active = max(fixture.max_active, fixture.active)
+                    stall = fixture.n_stalls.get(path, 0) > 0
+                    if stall:
+                        fixture.n_stalls[path] -= 1
+                    fail = not stall and fixture.n_failures.get(path, 0) > 0
+                    if fail:
+                        fixture.n_failures[path] -= 1
+                try:
+                    time.sleep(1.0 if stall else fixture.delays.get(path, 0.0))
+                    if path not in fixture.files:
+                        self.send_response(404)
+                        self.end_headers()
+                    elif fail:
+                        self.send_response(503)
+                        self.end_headers()
+                    else:
+                        body = fixture.files[path]
+                        self.send_response(200)
+                        self.send_header('Content-Length', str(len(body)))
+                        self.end_headers()
+                        self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    with fixture.lock:
+                        fixture.active -= 1
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_downloader(n_concurrent_downloads: int = 2) -> Downloader:
+    dl = Downloader.__new__(Downloader)
+    dl.n_concurrent_downloads = n_concurrent_downloads
+    dl.download_max_retries = 3
+    dl.download_backoff_seconds = 0.01
+    dl.download_timeout_seconds = 0.3
+    dl.download_executor = None
+    return dl
+
+
+async def collect(dl: Downloader, jobs: list) -> list:
+    return [result async for result in dl.iter_downloads(jobs)]
+
+
+def test_iter_downloads_bounded_and_in_order():
+    names = [f'BTCUSDT-aggTrades-2021-0{i}.zip' for i in range(1, 7)]
+    files = {name: make_zip(name.replace('.zip', '.csv'), [f'{i},1.0,1.0,{i},{i},{i},true'])
+             for i, name in enumerate(names)}
+    # earlier months take longer, so completion order is reversed
+    delays = {name: 0.03 * (len(names) - i) for i, name in enumerate(names)}
+    dl = make_downloader(2)
+    with FixtureServer(files, delays) as server:
+        results = asyncio.run(collect(dl, [(dl.fetch_with_retries, (server.url + name,)) for name in names]))
+    assert results == [files[name] for name in names]
+    assert server.max_active == 2
+
+
+def test_shared_download_executor_bounds_all_downloaders():
+    from concurrent.futures import ThreadPoolExecutor
+    names = [f'{symbol}-aggTrades-2021-0{i}.zip' for symbol in ['BTCUSDT', 'ETHUSDT'] for i in range(1, 5)]
+    files = {name: make_zip('a.csv', ['1,1.0,1.0,1,1,1,true']) for name in names}
+    with FixtureServer(files, {name: 0.05 for name in names}) as server, \
+            ThreadPoolExecutor(max_workers=2) as executor:
+        dls = [make_downloader(2), make_downloader(2)]
+        for dl in dls:
+            dl.download_executor = executor
+
+        async def run():
+            return await asyncio.gather(*[collect(dl, [(dl.fetch_with_retries, (server.url + name,))
+                                                       for name in names[i * 4:(i + 1) * 4]])
+                                          for i, dl in enumerate(dls)])
+        results = asyncio.run(run())
+    assert results == [[files[name] for name in names[:4]], [files[name] for name in names[4:]]]
+    assert server.max_active <= 2
+
+
+def test_fetch_with_retries_retries_5xx():
+    name = 'BTCUSDT-aggTrades-2021-01.zip'
+    files = {name: make_zip('a.csv', ['1,1.0,1.0,1,1,1,true'])}
+    dl = make_downloader()
+    with FixtureServer(files, n_failures={name: 2}) as server:
+        assert dl.fetch_with_retries(server.url + name) == files[name]
+    assert server.requests == [name] * 3
+
+
+def test_fetch_with_retries_retries_timeouts():
+    name = 'BTCUSDT-aggTrades-2021-01.zip'
+    files = {name: make_zip('a.csv', ['1,1.0,1.0,1,1,1,true'])}
+    dl = make_downloader()
+    with FixtureServer(files, n_stalls={name: 1}) as server:
+        assert dl.fetch_with_retries(server.url + name) == files[name]
+    assert server.requests == [name] * 2
+
+
+def test_fetch_with_retries_gives_up_after_max_retries():
+    name = 'BTCUSDT-aggTrades-2021-01.zip'
+    dl = make_downloader()
+    with FixtureServer({name: b''}, n_failures={name: 10}) as server:
+        with pytest.raises(HTTPError):
+            dl.fetch_with_retries(server.url + name)
+    assert len(server.requests) == dl.download_max_retries
+
+
+def test_missing_month_is_not_retried():
+    name = 'BTCUSDT-aggTrades-2099-01.zip'
+    dl = make_downloader()
+    with FixtureServer({}) as server:
+        with pytest.raises(HTTPError) as e:
+            dl.fetch_with_retries(server.url + name)
+    assert e.value.code == 404
+    assert server.requests == [name]
+
+
+def test_iter_zip_batches_yields_bounded_sorted_batches():
+    dl = make_downloader()
+    dl.spot = False
+    rows = [f'{i},{100.0 + i},1.0,{i},{i},{1000 + i},{str(i % 2 == 0).lower()}' for i in [3, 1, 2, 5, 4]]
+    batches = list(dl.iter_zip_batches(make_zip('a.csv', rows), chunksize=2))
+    assert [len(b) for b in batches] == [2, 2, 1]
+    for b in batches:
+        assert list(b.columns) == ['trade_id', 'price', 'qty', 'timestamp', 'is_buyer_maker']
+        assert (b['trade_id'].diff().dropna() > 0).all()
+    assert sorted(t for b in batches for t in b['trade_id']) == [1, 2, 3, 4, 5]
+
+
+def test_iter_zip_batches_empty_archive():
+    dl = make_downloader()
+    dl.spot = False
+    assert list(dl.iter_zip_batches(b'')) == []
@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pandas')
+pytest.importorskip('numba')
+
+from njit_funcs import update_emas_ticks
+
+SPANS = np.array([60.0, 600.0, 6000.0])
+ALPHAS = 2.0 / (SPANS + 1.0)
+ALPHAS_ = 1.0 - ALPHAS
+
+
+def step_per_second(emas, ema_sec, price, ticks):
+    # previous per second loop of Bot.update_indicators
+    for ts, qty, tick_price in ticks:
+        ts_sec = ts // 1000 * 1000
+        if ts_sec <= ema_sec:
+            ema_sec = ts_sec
+            price = tick_price
+            continue
+        while ema_sec < ts_sec - 1000:
+            emas = emas * ALPHAS_ + tick_price * ALPHAS
+            ema_sec += 1000
+        emas = emas * ALPHAS_ + price * ALPHAS
+        ema_sec += 1000
+        price = tick_price
+    return emas, ema_sec, price
+
+
+def test_closed_form_gap_matches_per_second_steps():
+    emas = np.array([100.0, 101.0, 102.0])
+    ticks = np.array([[1000500.0, 1.0, 100.5], [1001200.0, 2.0, 100.7], [1900000.0, 1.0, 99.0],
+                      [1900400.0, 1.0, 99.2], [1905000.0, 1.0, 99.1]])
+    expected_emas, expected_ema_sec, expected_price = step_per_second(emas.copy(), 1000000, 100.0, ticks)
+    new_emas, ema_sec, price, agg_qty, qty = update_emas_ticks(emas.copy(), ALPHAS, ALPHAS_, 1000000.0, 100.0,
+                                                               0.0, 0.0, ticks)
+    assert np.allclose(new_emas, expected_emas, rtol=1e-12)
+    assert ema_sec == expected_ema_sec
+    assert price == expected_price
+
+
+def test_empty_batch_leaves_state_unchanged():
+    emas = np.array([100.0, 101.0, 102.0])
+    new_emas, ema_sec, price, agg_qty, qty = update_emas_ticks(emas.copy(), ALPHAS, ALPHAS_, 1000000.0, 100.0,
+                                                               0.5, 1.0, np.zeros((0, 3)))
+    assert np.array_equal(new_emas, emas)
+    assert (ema_sec, price, agg_qty, qty) == (1000000.0, 100.0, 0.5, 1.0)
+
+
+def test_bot_update_indicators_with_no_ticks():
+    pytest.importorskip('websockets')
+    pytest.importorskip('telegram')
+    from passivbot import Bot
+    emas = np.array([100.0, 101.0, 102.0])
+    bot = SimpleNamespace(emas=emas.copy(), ema_sec=1000000, price=100.0, agg_qty=0.0, qty=0.0, ob=[99.0, 101.0],
+                          ob_from_book_ticker=False, ema_alpha_secs=ALPHAS, ema_alpha_secs_=ALPHAS_,
+                          ratios=np.ones(3))
+    Bot.update_indicators(bot, [])
+    assert np.array_equal(bot.emas, emas)
+    assert bot.ema_sec == 1000000 and bot.price == 100.0 and bot.ob == [99.0, 101.0]
@@ -0,0 +1,24 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('numba')
+
+from njit_funcs import calc_block_bootstrap_samples
+
+
+def make_samples(prices: [float]) -> np.ndarray:
+    return np.array([[1000.0 * i, 1.0, p] for i, p in enumerate(prices)])
+
+
+def test_bootstrap_path_is_finite_with_missing_prices():
+    samples = make_samples([0.0, 100.0, 101.0, 0.0, np.nan, 102.0, 101.5, 0.0, 100.5, 101.0])
+    path = calc_block_bootstrap_samples(samples, 3, 0.1, 0)
+    assert np.isfinite(path).all()
+    assert (path[:, 2] > 0.0).all()
+    assert path[0][2] == 100.0
+    assert np.array_equal(path[:, 0], samples[:, 0])
+
+
+def test_bootstrap_without_positive_prices_raises():
+    with pytest.raises(ValueError):
+        calc_block_bootstrap_samples(make_samples([0.0, 0.0, 0.0]), 2, 0.1, 0)
@@ -0,0 +1,48 @@
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('pandas')
+pytest.importorskip('numba')
+
+from pure_funcs import diff_orders
+
+
+def make_order(price: float, qty: float, side: str = 'buy', position_side: str = 'long') -> dict:
+    return {'symbol': 'BTCUSDT', 'side': side, 'position_side': position_side, 'price': price, 'qty': qty,
+            'type': 'limit', 'reduce_only': False, 'custom_id': 'long_entry'}
+
+
+def test_exact_matches_are_kept():
+    actual = [make_order(100.0, 1.0), make_order(99.0, 2.0)]
+    ideal = [make_order(99.0, 2.0), make_order(100.0, 1.0)]
+    assert diff_orders(actual, ideal, 0.1, 0.001) == ([], [], 0)
+
+
+def test_qty_tolerance_without_price_tolerance():
+    actual = [make_order(100.0, 1.0), make_order(99.0, 2.0)]
+    ideal = [make_order(100.0, 1.02), make_order(99.0, 2.5)]
+    to_cancel, to_create, n_kept = diff_orders(actual, ideal, 0.1, 0.001, price_tolerance=0.0, qty_tolerance=0.05)
+    # first within 5% qty, second not
+    assert n_kept == 1
+    assert to_cancel == [actual[1]]
+    assert to_create == [ideal[1]]
+
+
+def test_qty_tolerance_requires_same_price_tick():
+    actual = [make_order(100.0, 1.0)]
+    ideal = [make_order(100.1, 1.0)]
+    to_cancel, to_create, n_kept = diff_orders(actual, ideal, 0.1, 0.001, price_tolerance=0.0, qty_tolerance=0.05)
+    assert (to_cancel, to_create, n_kept) == (actual, ideal, 0)
+
+
+def test_price_tolerance():
+    actual = [make_order(100.0, 1.0)]
+    ideal = [make_order(100.03, 1.0)]
+    assert diff_orders(actual, ideal, 0.01, 0.001, price_tolerance=0.0005) == ([], [], 1)
+    assert diff_orders(actual, [make_order(100.1, 1.0)], 0.01, 0.001, price_tolerance=0.0005)[2] == 0
+
+
+def test_no_tolerance_replaces_drifted_orders():
+    actual = [make_order(100.0, 1.0)]
+    ideal = [make_order(100.0, 1.02)]
+    assert diff_orders(actual, ideal, 0.1, 0.001) == (actual, ideal, 0)
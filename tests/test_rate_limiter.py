@@ -0,0 +1,45 @@
+import asyncio
+
+from rate_limiter import RateLimiter, get_binance_rate_limiter, get_request_weight
+
+
+def test_used_weight_report_never_raises_tokens():
+    limiter = RateLimiter(1000, safety_margin=1.0)
+    asyncio.run(limiter.acquire(300))
+    # report sent before the 300 weight in flight was counted
+    limiter.update_used_weight(100)
+    assert limiter.tokens <= 700.1
+
+
+def test_stale_report_does_not_restore_budget():
+    limiter = RateLimiter(1000, safety_margin=1.0)
+    limiter.update_used_weight(800)
+    limiter.update_used_weight(200)
+    assert limiter.tokens <= 200.1
+
+
+def test_higher_report_lowers_tokens():
+    limiter = RateLimiter(1000, safety_margin=1.0)
+    asyncio.run(limiter.acquire(10))
+    limiter.update_used_weight(500)
+    assert limiter.tokens <= 500.1
+
+
+def test_rate_limited_response_pauses():
+    limiter = RateLimiter(1000)
+    assert limiter.update_from_response(429, {'Retry-After': '2'})
+    assert limiter.tokens <= 0.0
+    assert limiter.paused_until > 0.0
+
+
+def test_binance_hosts_get_own_limits_shared_per_host():
+    spot = get_binance_rate_limiter('https://api.binance.com')
+    futures = get_binance_rate_limiter('https://fapi.binance.com')
+    assert spot is get_binance_rate_limiter('https://api.binance.com')
+    assert spot.capacity == 1200 * 0.9
+    assert futures.capacity == 2400 * 0.9
+
+
+def test_unlisted_urls_weigh_one():
+    assert get_request_weight({'/api/v3/account': 20}, '/api/v3/account') == 20
+    assert get_request_weight({'/api/v3/account': 20}, '/api/v3/order') == 1
@@ -0,0 +1,69 @@
+import json
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pandas')
+pytest.importorskip('numba')
+
+import sample_cache
+from sample_cache import DAY_MS, SampleCache, load_samples_view
+
+SAMPLE_SIZE_MS = 60000
+ORIGIN_TS = 100 * DAY_MS
+
+
+class FakeManifest:
+    def __init__(self, first_ts: int, last_ts: int):
+        self.names = ['chunk']
+        self.entries = {'chunk': {'first_ts': first_ts, 'last_ts': last_ts, 'checksum': 'abc'}}
+
+    def get_range(self, start_ts: int, end_ts: int = -1) -> [str]:
+        return []
+
+
+def make_cache(dirpath: str, n_days: int) -> (SampleCache, np.ndarray):
+    cache = SampleCache(dirpath, SAMPLE_SIZE_MS)
+    n_rows = n_days * cache.rows_per_day
+    samples = np.stack([ORIGIN_TS + np.arange(n_rows) * SAMPLE_SIZE_MS, np.ones(n_rows),
+                        100.0 + np.arange(n_rows)], axis=1).astype(np.float64)
+    samples.tofile(cache.filepath)
+    cache.meta.update({'origin_ts': ORIGIN_TS, 'first_tick_ts': ORIGIN_TS,
+                       'last_tick_ts': ORIGIN_TS + n_days * DAY_MS - 1,
+                       'days': [{'checksums': [], 'complete': True} for _ in range(n_days)]})
+    cache.save_meta()
+    return cache, samples
+
+
+def test_interrupted_prepend_is_not_served_as_valid(tmp_path, monkeypatch):
+    cache, samples = make_cache(str(tmp_path), 2)
+    assert cache.covers(ORIGIN_TS, ORIGIN_TS + 2 * DAY_MS - 1)
+
+    def abort(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(cache, 'sample_days', abort)
+    with pytest.raises(KeyboardInterrupt):
+        cache.update(FakeManifest(ORIGIN_TS - DAY_MS, ORIGIN_TS + 2 * DAY_MS - 1), '', ORIGIN_TS - DAY_MS)
+
+    reloaded = SampleCache(str(tmp_path), SAMPLE_SIZE_MS)
+    meta = json.load(open(reloaded.meta_filepath))
+    assert meta['origin_ts'] == ORIGIN_TS - DAY_MS
+    assert [day['complete'] for day in meta['days']] == [False, True, True]
+    assert not reloaded.covers(ORIGIN_TS - DAY_MS, ORIGIN_TS + 2 * DAY_MS - 1)
+    assert not reloaded.covers(ORIGIN_TS, ORIGIN_TS + 2 * DAY_MS - 1)
+    assert os.path.getsize(reloaded.filepath) == 3 * reloaded.rows_per_day * 3 * 8
+    filepath, start_idx, end_idx = reloaded.get_location(ORIGIN_TS, ORIGIN_TS + 2 * DAY_MS - 1)
+    assert start_idx == reloaded.rows_per_day
+    assert np.array_equal(load_samples_view((filepath, start_idx, end_idx)), samples)
+
+
+def test_samples_view_remaps_grown_file_in_place(tmp_path):
+    filepath = str(tmp_path / 'samples.f64')
+    np.arange(6, dtype=np.float64).tofile(filepath)
+    assert len(load_samples_view((filepath, 0, 2))) == 2
+    np.arange(12, dtype=np.float64).tofile(filepath)
+    assert np.array_equal(load_samples_view((filepath, 0, 4))[3], [9.0, 10.0, 11.0])
+    assert [key for key in sample_cache._memmaps if key == filepath] == [filepath]
+    assert sample_cache._memmaps[filepath][0] == 12 * 8
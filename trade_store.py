@@ -0,0 +1,280 @@
+'''
+columnar on disk store of aggregated trades
+each chunk is a directory named {first_id}_{last_id}_{first_ts}_{last_ts} holding one .npy file per column
+columns may be memory mapped
+'''
+import hashlib
+import json
+import os
+import shutil
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+COLUMNS = {'trade_id': np.int64,
+           'price': np.float64,
+           'qty': np.float32,
+           'timestamp': np.int64,
+           'is_buyer_maker': np.int8}
+
+
+def get_chunk_name(df: pd.DataFrame) -> str:
+    return f'{df["trade_id"].iloc[0]}_{df["trade_id"].iloc[-1]}_{df["timestamp"].iloc[0]}_{df["timestamp"].iloc[-1]}'
+
+
+def parse_chunk_name(name: str) -> (int, int, int, int):
+    '''
+    returns first_id, last_id, first_ts, last_ts
+    '''
+    first_id, last_id, first_ts, last_ts = map(int, name.split('_'))
+    return first_id, last_id, first_ts, last_ts
+
+
+def list_chunks(dirpath: str) -> [str]:
+    '''
+    chunk names sorted by first trade id
+    '''
+    if not os.path.exists(dirpath):
+        return []
+    names = []
+    for name in os.listdir(dirpath):
+        if os.path.isdir(os.path.join(dirpath, name)) and name.count('_') == 3:
+            try:
+                parse_chunk_name(name)
+                names.append(name)
+            except ValueError:
+                pass
+    return sorted(names, key=lambda x: parse_chunk_name(x)[0])
+
+
+def dump_chunk(dirpath: str, df: pd.DataFrame, name: str = None) -> str:
+    '''
+    writes columns to a temporary directory first, replacing any existing chunk of the same name when done
+    returns chunk name
+    '''
+    name = get_chunk_name(df) if name is None else name
+    chunk_path = os.path.join(dirpath, name)
+    tmp_path = chunk_path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for column, dtype in COLUMNS.items():
+        np.save(os.path.join(tmp_path, f'{column}.npy'), df[column].values.astype(dtype))
+    if os.path.exists(chunk_path):
+        shutil.rmtree(chunk_path)
+    os.replace(tmp_path, chunk_path)
+    return name
+
+
+def load_chunk_columns(chunk_path: str, columns: [str] = None, mmap_mode: str = None) -> dict:
+    columns = list(COLUMNS) if columns is None else columns
+    return {column: np.load(os.path.join(chunk_path, f'{column}.npy'), mmap_mode=mmap_mode) for column in columns}
+
+
+def load_chunk(chunk_path: str, columns: [str] = None) -> pd.DataFrame:
+    return pd.DataFrame(load_chunk_columns(chunk_path, columns))
+
+
+def remove_chunk(chunk_path: str):
+    # refuse anything not named like a chunk, e.g. the symbol directory itself
+    parse_chunk_name(os.path.basename(os.path.normpath(chunk_path)))
+    shutil.rmtree(chunk_path)
+
+
+def get_chunk_fingerprint(chunk_path: str) -> [int]:
+    '''
+    [total size, latest mtime_ns] of column files, cheap check whether chunk changed on disk
+    '''
+    stats = [os.stat(os.path.join(chunk_path, f'{column}.npy')) for column in COLUMNS]
+    return [sum(st.st_size for st in stats), max(st.st_mtime_ns for st in stats)]
+
+
+def calc_chunk_checksum(chunk_path: str) -> str:
+    sha = hashlib.sha256()
+    for column in COLUMNS:
+        with open(os.path.join(chunk_path, f'{column}.npy'), 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+class ChunkManifest:
+    '''
+    per symbol index of chunks, kept in manifest.json next to the chunks
+    {'chunks': {name: {first_id, last_id, first_ts, last_ts, n_rows, checksum, validated, fingerprint}},
+     'anchors': [[trade_id, timestamp]]}
+    entries of chunks changed on disk since they were indexed are re-indexed and lose their validated flag
+    anchors are trades seen while searching for trade ids by timestamp
+    '''
+
+    def __init__(self, dirpath: str):
+        self.dirpath = dirpath
+        self.filepath = os.path.join(dirpath, 'manifest.json')
+        self.entries = {}
+        self.anchors = []
+        if os.path.exists(self.filepath):
+            try:
+                manifest = json.load(open(self.filepath))
+                if 'chunks' in manifest:
+                    self.entries = manifest['chunks']
+                    self.anchors = manifest['anchors'] if 'anchors' in manifest else []
+                else:
+                    # flat {name: entry} of earlier versions
+                    self.entries = manifest
+            except Exception as e:
+                print('failed to load chunk manifest, rebuilding', e)
+        self.sync()
+
+    def make_entry(self, name: str, validated: bool = False) -> dict:
+        first_id, last_id, first_ts, last_ts = parse_chunk_name(name)
+        chunk_path = os.path.join(self.dirpath, name)
+        return {'first_id': first_id,
+                'last_id': last_id,
+                'first_ts': first_ts,
+                'last_ts': last_ts,
+                'n_rows': len(np.load(os.path.join(chunk_path, 'trade_id.npy'), mmap_mode='r')),
+                'checksum': calc_chunk_checksum(chunk_path),
+                'validated': validated,
+                'fingerprint': get_chunk_fingerprint(chunk_path)}
+
+    def sync(self):
+        names = list_chunks(self.dirpath)
+        changed = False
+        for name in set(self.entries) - set(names):
+            del self.entries[name]
+            changed = True
+        for name in names:
+            if name not in self.entries or \
+                    self.entries[name]['fingerprint'] != get_chunk_fingerprint(os.path.join(self.dirpath, name)):
+                self.entries[name] = self.make_entry(name)
+                changed = True
+        self.reindex()
+        if changed:
+            self.save()
+
+    def reindex(self):
+        self.names = sorted(self.entries, key=lambda x: self.entries[x]['first_id'])
+        self.first_tss = [self.entries[name]['first_ts'] for name in self.names]
+        self.last_tss = [self.entries[name]['last_ts'] for name in self.names]
+
+    def save(self):
+        with open(self.filepath + '.tmp', 'w') as f:
+            json.dump({'chunks': self.entries, 'anchors': self.anchors}, f)
+        os.replace(self.filepath + '.tmp', self.filepath)
+
+    def add(self, name: str, validated: bool = False):
+        self.entries[name] = self.make_entry(name, validated)
+        self.reindex()
+        self.save()
+
+    def remove(self, name: str):
+        if name in self.entries:
+            del self.entries[name]
+            self.reindex()
+            self.save()
+
+    def is_validated(self, name: str) -> bool:
+        return name in self.entries and self.entries[name]['validated']
+
+    def set_validated(self, name: str):
+        if name in self.entries and not self.entries[name]['validated']:
+            self.entries[name]['validated'] = True
+            self.save()
+
+    def get_range(self, start_ts: int, end_ts: int = -1) -> [str]:
+        '''
+        names of chunks overlapping [start_ts, end_ts], end_ts -1 meaning open ended
+        '''
+        start_idx = bisect_left(self.last_tss, start_ts)
+        end_idx = len(self.names) if end_ts == -1 else bisect_right(self.first_tss, end_ts)
+        return self.names[start_idx:end_idx]
+
+    def add_anchors(self, anchors: [(int, int)], max_anchors: int = 10000):
+        merged = {int(trade_id): int(timestamp) for trade_id, timestamp in self.anchors}
+        merged.update({int(trade_id): int(timestamp) for trade_id, timestamp in anchors})
+        self.anchors = sorted([trade_id, timestamp] for trade_id, timestamp in merged.items())[-max_anchors:]
+        self.save()
+
+    def get_bracket(self, timestamp: int) -> ((int, int), (int, int)):
+        '''
+        closest known trades (trade_id, timestamp) before and at or after timestamp, from anchors and chunk bounds
+        either is None if not known
+        '''
+        lower, upper = None, None
+        known = self.anchors + [[e[k + '_id'], e[k + '_ts']] for e in self.entries.values() for k in ['first', 'last']]
+        for trade_id, ts in known:
+            if ts < timestamp:
+                if lower is None or trade_id > lower[0]:
+                    lower = (trade_id, ts)
+            elif upper is None or trade_id < upper[0]:
+                upper = (trade_id, ts)
+        return lower, upper
+
+
+def load_range(dirpath: str, manifest: ChunkManifest, start_ts: int, end_ts: int = -1, columns: [str] = None,
+               n_threads: int = 4) -> dict:
+    '''
+    columns of trades with start_ts <= timestamp <= end_ts in chunk order, end_ts -1 meaning open ended
+    first pass counts rows, taken from manifest for chunks entirely in range, so each column is allocated once
+    second pass fills columns in place, reading chunks in threads
+    '''
+    columns = list(COLUMNS) if columns is None else columns
+    end_ts = np.iinfo(np.int64).max if end_ts == -1 else end_ts
+    names = manifest.get_range(start_ts, end_ts)
+
+    def get_mask(name: str):
+        entry = manifest.entries[name]
+        if entry['first_ts'] >= start_ts and entry['last_ts'] <= end_ts:
+            return None
+        timestamps = load_chunk_columns(os.path.join(dirpath, name), ['timestamp'], mmap_mode='r')['timestamp']
+        return (timestamps >= start_ts) & (timestamps <= end_ts)
+
+    def fill(args):
+        name, mask, offset = args
+        chunk = load_chunk_columns(os.path.join(dirpath, name), columns, mmap_mode='r')
+        for column in columns:
+            values = chunk[column] if mask is None else chunk[column][mask]
+            loaded[column][offset:offset + len(values)] = values
+
+    masks = [get_mask(name) for name in names]
+    n_rows = [manifest.entries[name]['n_rows'] if mask is None else int(mask.sum())
+              for name, mask in zip(names, masks)]
+    offsets = np.concatenate([[0], np.cumsum(n_rows, dtype=np.int64)])
+    loaded = {column: np.empty(offsets[-1], dtype=COLUMNS[column]) for column in columns}
+    with ThreadPoolExecutor(max_workers=max(1, n_threads)) as executor:
+        list(executor.map(fill, zip(names, masks, offsets[:-1])))
+    return loaded
+
+
+def read_csv_chunk(path: str) -> pd.DataFrame:
+    '''
+    reads legacy csv chunk, either binance or bybit format
+    '''
+    try:
+        df = pd.read_csv(path,
+                         dtype={"trade_id": np.int64, "price": np.float64, "qty": np.float64, "timestamp": np.int64,
+                                "is_buyer_maker": np.int8})
+    except ValueError:
+        df = pd.read_csv(path)
+        df = df.drop("side", axis=1).join(pd.Series(df.side == "Sell", name="is_buyer_maker", index=df.index))
+        df = df.astype({"trade_id": np.int64, "price": np.float64, "qty": np.float64, "timestamp": np.int64,
+                        "is_buyer_maker": np.int8})
+    return df
+
+
+def migrate_csv_chunks(dirpath: str) -> int:
+    '''
+    converts legacy {first_id}_{last_id}_{first_ts}_{last_ts}.csv chunks to columnar chunks, removing the csvs
+    returns number of migrated chunks
+    '''
+    if not os.path.exists(dirpath):
+        return 0
+    filenames = sorted([f for f in os.listdir(dirpath) if f.endswith('.csv')])
+    for i, f in enumerate(filenames):
+        print(f'\rmigrating csv chunk {i + 1}/{len(filenames)} {f}', end='     ')
+        dump_chunk(dirpath, read_csv_chunk(os.path.join(dirpath, f)), f.replace('.csv', ''))
+        os.remove(os.path.join(dirpath, f))
+    if filenames:
+        print(f'\nmigrated {len(filenames)} csv chunks in {dirpath}')
+    return len(filenames)
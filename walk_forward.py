@@ -0,0 +1,157 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from time import time
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+from backtest import backtest
+from downloader import Downloader
+from procedures import prep_config, make_get_filepath, add_argparse_args, get_starting_configs, dump_live_config
+from pso_custom import pso_multiprocess, PostProcessing, MmapBacktestWrap
+from pure_funcs import get_template_live_config, analyze_fills, denumpyize, pack_config, ts_to_date
+from sample_cache import load_samples_view
+
+
+def get_windows(timestamps: np.ndarray, train_days: float, test_days: float) -> [(int, int, int)]:
+    '''
+    returns [(train_start_idx, train_end_idx == test_start_idx, test_end_idx)]
+    windows are rolled forward by test_days
+    '''
+    day_ms = 1000 * 60 * 60 * 24
+    windows = []
+    train_start_ts = timestamps[0]
+    while (test_end_ts := train_start_ts + (train_days + test_days) * day_ms) <= timestamps[-1]:
+        train_end_ts = train_start_ts + train_days * day_ms
+        windows.append(tuple(int(i) for i in np.searchsorted(timestamps, [train_start_ts, train_end_ts, test_end_ts])))
+        train_start_ts += test_days * day_ms
+    return windows
+
+
+def optimize_window(config: dict, window_idx: int, train_start_idx: int, train_end_idx: int,
+                    starting_configs: [dict], n_cpus: int) -> (dict, float):
+    '''
+    runs in its own process, output of the optimization goes to optimize.log in the window's dir
+    '''
+    data = load_samples_view(config['ticks_location'])
+    train_config = {**config,
+                    'n_days': (data[train_end_idx - 1][0] - data[train_start_idx][0]) / (1000 * 60 * 60 * 24),
+                    'optimize_dirpath': make_get_filepath(os.path.join(config['optimize_dirpath'],
+                                                                       f'window_{window_idx:03}', ''))}
+    log_filepath = train_config['optimize_dirpath'] + 'optimize.log'
+    print(f'window {window_idx + 1} optimizing, output in {log_filepath}')
+    with open(log_filepath, 'w', buffering=1) as log, redirect_stdout(log):
+        backtest_wrap = MmapBacktestWrap(config['ticks_location'], train_start_idx, train_end_idx, train_config)
+        post_processing = PostProcessing()
+        gbest, gbest_score = pso_multiprocess(backtest_wrap.rf,
+                                              config['n_particles'],
+                                              backtest_wrap.bounds,
+                                              config['options']['c1'],
+                                              config['options']['c2'],
+                                              config['options']['w'],
+                                              n_cpus=n_cpus,
+                                              iters=config['iters'],
+                                              initial_positions=[backtest_wrap.config_to_xs(cfg)
+                                                                 for cfg in starting_configs],
+                                              post_processing_func=post_processing.process)
+    best_config = backtest_wrap.xs_to_config(gbest)
+    dump_live_config(best_config, train_config['optimize_dirpath'] + 'best.json')
+    return best_config, -gbest_score
+
+
+def test_window(config: dict, data: np.ndarray, warmup_idx: int) -> (pd.DataFrame, dict):
+    '''
+    data[:warmup_idx] precedes test window and only warms up emas, stats are accounted from data[warmup_idx]
+    '''
+    fills, info = backtest(config, data)
+    return analyze_fills(fills, {**config, **{'lowest_eqbal_ratio': info[1], 'closest_bkr': info[2]}},
+                         data[warmup_idx][0], data[-1][0])
+
+
+async def main():
+    parser = argparse.ArgumentParser(prog='WalkForward', description='Walk-forward optimize passivbot config.')
+    parser = add_argparse_args(parser)
+    parser.add_argument('-t', '--start', type=str, required=False, dest='starting_configs',
+                        default=None,
+                        help='start first windows with given live configs.  single json file or dir with multiple json files')
+    args = parser.parse_args()
+    for config in await prep_config(args):
+        template_live_config = get_template_live_config(config['n_spans'])
+        config = {**template_live_config, **config}
+        dl = Downloader(config)
+        config['ticks_location'] = await dl.get_sampled_ticks_location()
+        data = load_samples_view(config['ticks_location'])
+        windows = get_windows(data[:, 0], config['wf_train_days'], config['wf_test_days'])
+        if not windows:
+            print('not enough data for a single train and test window')
+            continue
+        config['optimize_dirpath'] = make_get_filepath(os.path.join(config['optimize_dirpath'], 'walk_forward',
+                                                                    ts_to_date(time())[:19].replace(':', ''), ''))
+        n_concurrent = max(1, min(int(config['wf_n_concurrent']), config['num_cpus']))
+        print(f"{len(windows)} windows, train {config['wf_train_days']} days, test {config['wf_test_days']} days, "
+              f"{n_concurrent} optimized at once")
+
+        user_starting_configs = get_starting_configs(config)
+        starting_configs = user_starting_configs
+        equity_dfs = []
+        equity_multiplier = 1.0
+        for wave_start in range(0, len(windows), n_concurrent):
+            wave = list(range(wave_start, min(wave_start + n_concurrent, len(windows))))
+            n_cpus = max(1, config['num_cpus'] // len(wave))
+            # windows run in spawned processes, as pso_multiprocess forks a pool, which must not happen from one
+            # of several threads
+            spawn_context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=len(wave), mp_context=spawn_context) as executor:
+                futures = [executor.submit(optimize_window, config, i, windows[i][0], windows[i][1],
+                                           starting_configs, n_cpus)
+                           for i in wave]
+                results = [future.result() for future in futures]
+            for i, (best_config, train_score) in zip(wave, results):
+                train_start_idx, test_start_idx, test_end_idx = windows[i]
+                # prepend max_span of samples preceding test window, as optimize.py does for its sliding windows,
+                # so that test window is traded on converged emas
+                max_span_ito_n_samples = int(best_config['max_span'] * 60 / ((data[1][0] - data[0][0]) / 1000))
+                warmup_start_idx = max(0, test_start_idx - max_span_ito_n_samples)
+                warmup_idx = test_start_idx - warmup_start_idx
+                test_data = np.array(data[warmup_start_idx:test_end_idx])
+                fdf, test_analysis = test_window(best_config, test_data, warmup_idx)
+                if fdf.empty:
+                    equity = pd.DataFrame({'timestamp': [test_data[warmup_idx][0], test_data[-1][0]],
+                                           'equity': [1.0, 1.0]})
+                else:
+                    equity = pd.DataFrame({'timestamp': [test_data[warmup_idx][0]] + list(fdf.timestamp),
+                                           'equity': [1.0] + list(fdf.equity / config['starting_balance'])})
+                equity.equity *= equity_multiplier
+                equity_multiplier = equity.equity.iloc[-1]
+                equity_dfs.append(equity)
+                print(f"window {i + 1}/{len(windows)} train score {train_score:.6f} "
+                      f"test adg {test_analysis['average_daily_gain']:.6f} "
+                      f"test closest_bkr {test_analysis['closest_bkr']:.6f}")
+                with open(config['optimize_dirpath'] + 'walk_forward_results.txt', 'a') as f:
+                    f.write(json.dumps(denumpyize({'window': i,
+                                                   'train_start': ts_to_date(data[train_start_idx][0] / 1000),
+                                                   'test_start': ts_to_date(data[test_start_idx][0] / 1000),
+                                                   'test_end': ts_to_date(data[test_end_idx - 1][0] / 1000),
+                                                   'train_score': train_score,
+                                                   **test_analysis,
+                                                   **pack_config(best_config)})) + '\n')
+            starting_configs = [results[-1][0]] + user_starting_configs
+
+        edf = pd.concat(equity_dfs, ignore_index=True)
+        edf.equity *= config['starting_balance']
+        edf.to_csv(config['optimize_dirpath'] + 'oos_equity.csv', index=False)
+        plt.clf()
+        plt.plot(pd.to_datetime(edf.timestamp, unit='ms'), edf.equity)
+        plt.title('out of sample equity')
+        plt.savefig(config['optimize_dirpath'] + 'oos_equity.png')
+        print('out of sample gain', round(equity_multiplier, 6), 'results dumped to', config['optimize_dirpath'])
+
+
+if __name__ == '__main__':
+    asyncio.run(main())